@@ -1,17 +1,20 @@
 import os
-from flask import Flask, flash, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, flash, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context
 from flask_socketio import SocketIO, join_room, leave_room, emit
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_mail import Mail
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from werkzeug.utils import secure_filename
 from flask import current_app
 import uuid
 import time
-from sqlalchemy import desc
+import threading
+import atexit
+from sqlalchemy import and_, desc, or_, select, update
+from sqlalchemy.orm import joinedload
 from flask import send_file
 import csv
 import io
@@ -39,14 +42,29 @@ except ImportError:
     print("Flask-Admin not installed. Admin features disabled.")
 
 from config import Config
-from models import AuditLog, PasswordResetRequest, UserWarningLog, db, User, OTP, ChatSession, Message, Connection, Notification, Report, Admin
+from matchmaking import make_queue_entry, is_opposite_gender
+from state import SessionCache, create_chat_state
+from message_pipeline import IdBlockAllocator, MessageWriter, session_messages_update
+from user_stats import backfill_user_stats, record_chat_ended, record_chats_started, record_messages
+from moderation import report_counts, warning_counts
+from rollups import backfill_rollups, daily_sum, hour_start, install_rollup_tracking, prune_hourly, series, totals
+from media_store import BlobStore, ChunkedUploads, UploadError, blob_ref, parse_data_url
+from image_pipeline import RENDITIONS, ImagePipeline
+from realtime import PresenceBroadcaster, SignalRelay, TypingTracker
+from database import configure_database
+from migrations import pending_migrations, run_migrations
+from models import AuditLog, PasswordResetRequest, UserWarningLog, db, User, OTP, ChatSession, Message, Connection, Notification, Report, Admin, UserChatStats
 from email_utils import mail, send_otp_email, send_notification_email, send_password_reset_email, send_ban_notification_email
 from flask_mail import Message as MailMessage
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
-db.init_app(app)
+# Pooled engine with SQLite WAL pragmas for the configured database
+configure_database(app)
+
+# Dashboard counters in stats_rollups follow every ORM write
+install_rollup_tracking(db.session)
 mail.init_app(app)
 
 # Initialize Login Manager
@@ -55,151 +73,165 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # Initialize SocketIO with threading only (for PythonAnywhere compatibility)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
-
-online_users = set()  
-active_chats = {}     
-waiting_users = {    
-    'text': [],       
-    'video': []       
-}
-
-def attempt_gender_based_matchmaking(chat_type):
-    """Enhanced gender-based matchmaking with global support"""
-    if len(waiting_users[chat_type]) < 2:
-        return
+# With REDIS_URL set, emits and rooms are shared across workers through Redis
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode='threading',
+    message_queue=app.config.get('REDIS_URL')
+)
 
-    # Group users by gender with enhanced categorization
-    male_users = []
-    female_users = []
-    other_users = []
-    
-    for user_data in waiting_users[chat_type]:
-        user = User.query.get(user_data['user_id'])
-        if user and user.gender:
-            gender_lower = user.gender.lower().strip()
-            
-            # Enhanced gender categorization
-            if gender_lower in ['male', 'm', 'man', 'boy', 'gentleman']:
-                male_users.append(user_data)
-            elif gender_lower in ['female', 'f', 'woman', 'girl', 'lady', 'female']:
-                female_users.append(user_data)
-            else:
-                other_users.append(user_data)
-        else:
-            other_users.append(user_data)
+# Presence, waiting queues and active chats, in Redis when REDIS_URL is set
+chat_state = create_chat_state(app.config.get('REDIS_URL'))
 
-    print(f"Matchmaking: {len(male_users)} male, {len(female_users)} female, {len(other_users)} other users waiting")
+# Session membership for hot socket events, so they do not query chat_sessions
+session_cache = SessionCache()
 
-    # Priority 1: Male-Female matching
-    matches_found = 0
-    while male_users and female_users:
-        male_data = male_users.pop(0)
-        female_data = female_users.pop(0)
-        
-        # Remove from main waiting list
-        waiting_users[chat_type] = [u for u in waiting_users[chat_type] 
-                                  if u['user_id'] not in [male_data['user_id'], female_data['user_id']]]
-        
-        create_chat_session(male_data, female_data, chat_type)
-        matches_found += 1
-        print(f"✓ Gender-based match: Male {male_data['user_id']} + Female {female_data['user_id']}")
+# Chat messages get their ids up front and are written to the database in batches
+message_ids = IdBlockAllocator('messages', Message, block_size=app.config.get('MESSAGE_ID_BLOCK_SIZE'))
+message_writer = MessageWriter(
+    app,
+    max_queue=app.config.get('MESSAGE_WRITE_QUEUE_SIZE'),
+    batch_size=app.config.get('MESSAGE_WRITE_BATCH_SIZE'),
+    interval=app.config.get('MESSAGE_WRITE_INTERVAL')
+)
+atexit.register(message_writer.close)
 
-    # Priority 2: If no gender matches, use interest-based matching for remaining users
-    if len(waiting_users[chat_type]) >= 2 and matches_found == 0:
-        print("No gender matches found, using interest-based matching")
-        attempt_interest_based_matchmaking(chat_type)
+# Shared media lives on disk by content hash; messages only keep a reference
+media_store = BlobStore(app.config.get('MEDIA_STORE_FOLDER'))
+media_uploads = ChunkedUploads(media_store, chunk_size=app.config.get('MEDIA_UPLOAD_CHUNK_SIZE'))
 
-def attempt_interest_based_matchmaking(chat_type):
-    """Match users based on common interests when gender matching isn't possible"""
-    if len(waiting_users[chat_type]) < 2:
-        return
+# Resized, metadata-free renditions of shared images and avatars, made on a process pool
+image_pipeline = ImagePipeline(media_store, max_workers=app.config.get('IMAGE_PIPELINE_WORKERS'))
+atexit.register(image_pipeline.shutdown)
 
-    # Create a copy of waiting users for matching
-    available_users = waiting_users[chat_type][:]
-    
-    # Try to find users with common interests
-    matched_pairs = []
-    
-    for i, user1_data in enumerate(available_users):
-        if user1_data.get('matched'):
-            continue
-            
-        user1_interests = set(user1_data.get('interests', []))
-        best_match_index = -1
-        best_match_score = 0
-        
-        # Find best match based on interests
-        for j, user2_data in enumerate(available_users[i+1:], i+1):
-            if user2_data.get('matched'):
-                continue
-                
-            user2_interests = set(user2_data.get('interests', []))
-            common_interests = user1_interests.intersection(user2_interests)
-            match_score = len(common_interests)
-            
-            # Bonus for different genders even in interest-based matching
-            user1 = User.query.get(user1_data['user_id'])
-            user2 = User.query.get(user2_data['user_id'])
-            
-            if user1 and user2 and user1.gender and user2.gender:
-                gender1 = user1.gender.lower()
-                gender2 = user2.gender.lower()
-                
-                # Add bonus for male-female pairs
-                if (gender1 in ['male', 'm', 'man'] and gender2 in ['female', 'f', 'woman']) or \
-                   (gender1 in ['female', 'f', 'woman'] and gender2 in ['male', 'm', 'man']):
-                    match_score += 3
-            
-            if match_score > best_match_score:
-                best_match_score = match_score
-                best_match_index = j
-        
-        if best_match_index != -1:
-            user2_data = available_users[best_match_index]
-            matched_pairs.append((user1_data, user2_data))
-            user1_data['matched'] = True
-            user2_data['matched'] = True
-    
-    # Create sessions for matched pairs
-    for user1_data, user2_data in matched_pairs:
-        waiting_users[chat_type] = [u for u in waiting_users[chat_type] 
-                                  if u['user_id'] not in [user1_data['user_id'], user2_data['user_id']]]
-        create_chat_session(user1_data, user2_data, chat_type)
-        print(f"✓ Interest-based match: {user1_data['user_id']} + {user2_data['user_id']}")
-
-def create_chat_session(user1_data, user2_data, chat_type):
-    """Create a chat session between two users with enhanced matching info"""
-    user1_id = user1_data['user_id']
-    user2_id = user2_data['user_id']
+# Online/offline changes, coalesced and sent only to related users
+presence_broadcaster = PresenceBroadcaster(
+    app, socketio, chat_state,
+    interval=app.config.get('PRESENCE_BROADCAST_INTERVAL')
+)
 
-    # Create chat session
-    chat_session = ChatSession(
-        user1_id=user1_id,
-        user2_id=user2_id,
-        session_type=chat_type,
-        started_at=datetime.utcnow()
-    )
-    db.session.add(chat_session)
-    db.session.commit()
+# Typing indicators, throttled per sender and stopped automatically when idle
+typing_tracker = TypingTracker(
+    socketio,
+    window=app.config.get('TYPING_WINDOW'),
+    idle_timeout=app.config.get('TYPING_IDLE_TIMEOUT')
+)
 
-    # Store in active chats
-    active_chats[user1_id] = {
-        'session_id': chat_session.id,
-        'partner': user2_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': chat_type
-    }
-    active_chats[user2_id] = {
-        'session_id': chat_session.id,
-        'partner': user1_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': chat_type
-    }
+# WebRTC signaling between chat partners, with trickle ICE candidates batched
+signal_relay = SignalRelay(socketio, batch_window=app.config.get('ICE_BATCH_WINDOW'))
+
+background_tasks_started = False
+background_tasks_lock = threading.Lock()
+
+def run_matchmaking_tick():
+    """Pair everyone currently waiting and announce the matches in one batch"""
+    max_pairs = app.config.get('MATCHMAKING_BATCH_SIZE')
 
-    # Get user info for notification
-    user1 = User.query.get(user1_id)
-    user2 = User.query.get(user2_id)
+    for chat_type in ['text', 'video']:
+        matches = chat_state.claim_matches(chat_type, max_pairs=max_pairs)
+        if matches:
+            create_chat_sessions(matches, chat_type)
+
+def create_chat_sessions(matches, chat_type):
+    """Create chat sessions for a batch of claimed matches and notify both sides"""
+    started_at = datetime.utcnow()
+
+    # Create all chat sessions with a single commit
+    chat_sessions = [
+        ChatSession(
+            id=session_id,
+            user1_id=user1_data['user_id'],
+            user2_id=user2_data['user_id'],
+            session_type=chat_type,
+            started_at=started_at
+        )
+        for user1_data, user2_data, session_id in matches
+    ]
+    try:
+        db.session.add_all(chat_sessions)
+        record_chats_started(
+            user_data['user_id'] for match in matches for user_data in match[:2]
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # Release the claimed users so they are not stuck in a chat that does not exist
+        for user1_data, _, _ in matches:
+            chat_state.end_chat(user1_data['user_id'])
+        raise
+
+    # A user who ended the chat or disconnected before the commit found no row
+    # to close, so close the sessions whose chat is already gone here
+    live_matches = []
+    for match, chat_session in zip(matches, chat_sessions):
+        user1_data, user2_data, session_id = match
+        if all(
+            (chat_state.get_chat(user_data['user_id']) or {}).get('session_id') == session_id
+            for user_data in (user1_data, user2_data)
+        ):
+            live_matches.append(match)
+        else:
+            end_chat_session(chat_session, 'user_left')
+    if len(live_matches) < len(matches):
+        db.session.commit()
+
+    for user1_data, user2_data, session_id in live_matches:
+        session_cache.add(session_id, user1_data['user_id'], user2_data['user_id'])
+        if chat_type == 'video':
+            notify_video_chat_match(user1_data, user2_data, session_id)
+        else:
+            notify_chat_match(user1_data, user2_data, session_id, chat_type)
+
+    print(f"Matchmaking tick created {len(chat_sessions)} {chat_type} chat sessions")
+
+def end_chat_session(chat_session, reason):
+    """Mark a chat session ended and add its duration to both users' stats; the caller commits"""
+    chat_session.ended_at = datetime.utcnow()
+    chat_session.end_reason = reason
+    if chat_session.started_at:
+        duration = (chat_session.ended_at - chat_session.started_at).total_seconds()
+        chat_session.duration = int(duration)
+    record_chat_ended(chat_session)
+
+def get_session_partner(session_id, user_id):
+    """Partner of a user in a chat session, or None if they are not a participant.
+
+    Membership only, for things that stay valid after the chat ends (receipts,
+    reports); relaying to the partner goes through ``get_active_partner``.
+    """
+    session = session_cache.load(session_id, ChatSession.query.get)
+    if not session:
+        return None
+    return session['partners'].get(user_id)
+
+def chat_is_active(session_id, user_id, partner_id):
+    """Whether the shared chat state still has the user in this session with this partner.
+
+    The session cache only knows about chats this process ended; a chat
+    ended or banned on another worker is only visible in ``chat_state``.
+    A mismatch is remembered as ended in the local cache.
+    """
+    chat_data = chat_state.get_chat(user_id)
+    if chat_data and chat_data['session_id'] == session_id and chat_data['partner'] == partner_id:
+        return True
+    session_cache.mark_ended(session_id)
+    return False
+
+def get_active_partner(session_id, user_id):
+    """Partner of a user in a chat session that has not ended, or None"""
+    session = session_cache.load(session_id, ChatSession.query.get)
+    if not session or session['ended']:
+        return None
+    partner_id = session['partners'].get(user_id)
+    if not partner_id or not chat_is_active(session_id, user_id, partner_id):
+        return None
+    return partner_id
+
+def notify_chat_match(user1_data, user2_data, session_id, chat_type):
+    """Send enhanced match details to both users of a new chat session"""
+    user1_id = user1_data['user_id']
+    user2_id = user2_data['user_id']
 
     # Calculate common interests
     interests1 = set(user1_data.get('interests', []))
@@ -212,141 +244,39 @@ def create_chat_session(user1_data, user2_data, chat_type):
 
     # Notify both users with enhanced match details
     match_data = {
-        'session_id': chat_session.id,
+        'session_id': session_id,
         'partner_id': user2_id,
-        'partner_name': user2.display_name if user2 else 'Anonymous',
-        'partner_gender': user2.gender if user2 else 'Not specified',
+        'partner_name': user2_data.get('display_name') or 'Anonymous',
+        'partner_gender': user2_data.get('gender') or 'Not specified',
         'partner_interests': user2_data.get('interests', []),
         'partner_location': user2_location,
         'common_interests': common_interests,
         'chat_type': chat_type,
-        'match_type': 'gender_based' if user1 and user2 and 
-                       ((user1.gender and user1.gender.lower() in ['male', 'm', 'man'] and 
-                         user2.gender and user2.gender.lower() in ['female', 'f', 'woman']) or
-                        (user1.gender and user1.gender.lower() in ['female', 'f', 'woman'] and 
-                         user2.gender and user2.gender.lower() in ['male', 'm', 'man'])) else 'interest_based',
+        'match_type': 'gender_based' if is_opposite_gender(user1_data, user2_data) else 'interest_based',
         'timestamp': datetime.utcnow().isoformat()
     }
 
-    emit('chat_match_found', match_data, room=user1_id)
+    socketio.emit('chat_match_found', match_data, room=user1_id)
 
     # Prepare data for user2
     match_data['partner_id'] = user1_id
-    match_data['partner_name'] = user1.display_name if user1 else 'Anonymous'
-    match_data['partner_gender'] = user1.gender if user1 else 'Not specified'
+    match_data['partner_name'] = user1_data.get('display_name') or 'Anonymous'
+    match_data['partner_gender'] = user1_data.get('gender') or 'Not specified'
     match_data['partner_interests'] = user1_data.get('interests', [])
     match_data['partner_location'] = user1_location
 
-    emit('chat_match_found', match_data, room=user2_id)
+    socketio.emit('chat_match_found', match_data, room=user2_id)
 
     # Log the match
-    user1_gender = user1.gender if user1 else 'Unknown'
-    user2_gender = user2.gender if user2 else 'Unknown'
-    print(f"✓ Matched users {user1_id} ({user1_gender}) from {user1_location} and {user2_id} ({user2_gender}) from {user2_location} for {chat_type} chat. Session: {chat_session.id}")
-
-def attempt_video_matchmaking():
-    """Attempt to match users in video chat queue with gender preferences"""
-    if len(waiting_users['video']) < 2:
-        return
-
-    # Group users by gender and media readiness
-    male_users = []
-    female_users = []
-    other_users = []
-    
-    for user_data in waiting_users['video']:
-        user = User.query.get(user_data['user_id'])
-        if user and user.gender:
-            gender_lower = user.gender.lower()
-            if gender_lower in ['male', 'm', 'man']:
-                male_users.append(user_data)
-            elif gender_lower in ['female', 'f', 'woman', 'female']:
-                female_users.append(user_data)
-            else:
-                other_users.append(user_data)
-        else:
-            other_users.append(user_data)
-
-    # Prioritize users with media ready
-    ready_males = [u for u in male_users if u.get('media_ready', False)]
-    ready_females = [u for u in female_users if u.get('media_ready', False)]
-    
-    # Try to match ready male with ready female first
-    while ready_males and ready_females:
-        male_data = ready_males.pop(0)
-        female_data = ready_females.pop(0)
-        
-        # Remove from original lists
-        male_users = [u for u in male_users if u['user_id'] != male_data['user_id']]
-        female_users = [u for u in female_users if u['user_id'] != female_data['user_id']]
-        
-        # Remove from waiting list
-        waiting_users['video'] = [u for u in waiting_users['video'] 
-                                if u['user_id'] not in [male_data['user_id'], female_data['user_id']]]
-        
-        create_video_chat_session(male_data, female_data)
-        return
-
-    # If no ready matches, try any male-female combination
-    while male_users and female_users:
-        male_data = male_users.pop(0)
-        female_data = female_users.pop(0)
-        
-        waiting_users['video'] = [u for u in waiting_users['video'] 
-                                if u['user_id'] not in [male_data['user_id'], female_data['user_id']]]
-        
-        create_video_chat_session(male_data, female_data)
-        return
-
-    # Fallback to original matching if no gender-based matches possible
-    if len(waiting_users['video']) >= 2:
-        ready_users = [u for u in waiting_users['video'] if u.get('media_ready', False)]
-        if len(ready_users) < 2:
-            ready_users = waiting_users['video'][:2]
+    user1_gender = user1_data.get('gender') or 'Unknown'
+    user2_gender = user2_data.get('gender') or 'Unknown'
+    print(f"✓ Matched users {user1_id} ({user1_gender}) from {user1_location} and {user2_id} ({user2_gender}) from {user2_location} for {chat_type} chat. Session: {session_id}")
 
-        user1_data = ready_users[0]
-        user2_data = ready_users[1]
-
-        waiting_users['video'] = [u for u in waiting_users['video'] 
-                                if u['user_id'] not in [user1_data['user_id'], user2_data['user_id']]]
-
-        create_video_chat_session(user1_data, user2_data)
-
-def create_video_chat_session(user1_data, user2_data):
-    """Create a video chat session between two users"""
+def notify_video_chat_match(user1_data, user2_data, session_id):
+    """Send match details to both users of a new video chat session"""
     user1_id = user1_data['user_id']
     user2_id = user2_data['user_id']
 
-    # Create video chat session
-    chat_session = ChatSession(
-        user1_id=user1_id,
-        user2_id=user2_id,
-        session_type='video',
-        started_at=datetime.utcnow()
-    )
-    db.session.add(chat_session)
-    db.session.commit()
-
-    # Store in active chats
-    active_chats[user1_id] = {
-        'session_id': chat_session.id,
-        'partner': user2_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': 'video',
-        'media_ready': user1_data.get('media_ready', False)
-    }
-    active_chats[user2_id] = {
-        'session_id': chat_session.id,
-        'partner': user1_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': 'video',
-        'media_ready': user2_data.get('media_ready', False)
-    }
-
-    # Get user info for notification
-    user1 = User.query.get(user1_id)
-    user2 = User.query.get(user2_id)
-
     # Calculate common interests
     interests1 = set(user1_data.get('interests', []))
     interests2 = set(user2_data.get('interests', []))
@@ -354,165 +284,263 @@ def create_video_chat_session(user1_data, user2_data):
 
     # Notify both users
     match_data = {
-        'session_id': chat_session.id,
+        'session_id': session_id,
         'partner_id': user2_id,
-        'partner_name': user2.display_name if user2 else 'Anonymous',
-        'partner_gender': user2.gender if user2 else 'Not specified',
+        'partner_name': user2_data.get('display_name') or 'Anonymous',
+        'partner_gender': user2_data.get('gender') or 'Not specified',
         'partner_interests': user2_data.get('interests', []),
         'common_interests': common_interests,
         'chat_type': 'video',
         'timestamp': datetime.utcnow().isoformat()
     }
 
-    emit('video_chat_match_found', match_data, room=user1_id)
+    socketio.emit('video_chat_match_found', match_data, room=user1_id)
 
     match_data['partner_id'] = user1_id
-    match_data['partner_name'] = user1.display_name if user1 else 'Anonymous'
-    match_data['partner_gender'] = user1.gender if user1 else 'Not specified'
+    match_data['partner_name'] = user1_data.get('display_name') or 'Anonymous'
+    match_data['partner_gender'] = user1_data.get('gender') or 'Not specified'
     match_data['partner_interests'] = user1_data.get('interests', [])
 
-    emit('video_chat_match_found', match_data, room=user2_id)
+    socketio.emit('video_chat_match_found', match_data, room=user2_id)
 
-    print(f"Matched users {user1_id} ({user1.gender if user1 else 'Unknown'}) and {user2_id} ({user2.gender if user2 else 'Unknown'}) for video chat. Session: {chat_session.id}")
+    print(f"Matched users {user1_id} ({user1_data.get('gender') or 'Unknown'}) and {user2_id} ({user2_data.get('gender') or 'Unknown'}) for video chat. Session: {session_id}")
 
 def cleanup_inactive_sessions():
-    """Periodically clean up inactive sessions"""
-    global active_chats, waiting_users, online_users
-    
+    """Expire waiting users, idle chats and silent clients whose deadline has passed"""
     try:
         with app.app_context():
             # Clean up abandoned waiting users (older than 10 minutes)
             cutoff_time = datetime.utcnow() - timedelta(minutes=10)
 
-            for chat_type in ['text', 'video']:
-                original_count = len(waiting_users[chat_type])
-                waiting_users[chat_type] = [
-                    u for u in waiting_users[chat_type]
-                    if datetime.fromisoformat(u.get('joined_at', datetime.utcnow().isoformat())) > cutoff_time
-                ]
-                if len(waiting_users[chat_type]) != original_count:
-                    print(f"Cleaned up {original_count - len(waiting_users[chat_type])} inactive waiting users from {chat_type} queue")
+            for chat_type, removed_count in chat_state.expire_waiting(cutoff_time).items():
+                if removed_count:
+                    print(f"Cleaned up {removed_count} inactive waiting users from {chat_type} queue")
 
             # Clean up stale active chats (no activity for 5 minutes)
             stale_cutoff = datetime.utcnow() - timedelta(minutes=5)
-            users_to_remove = []
-
-            for user_id, chat_data in active_chats.items():
-                if chat_data.get('start_time', datetime.utcnow()) < stale_cutoff:
-                    users_to_remove.append(user_id)
+            users_to_remove = chat_state.expire_chats(stale_cutoff)
 
             for user_id in users_to_remove:
                 cleanup_user_sessions(user_id)
                 print(f"Cleaned up stale chat session for user {user_id}")
 
-            # Special cleanup for video sessions without media
-            cleanup_video_sessions()
-
-            # Clean up users who haven't sent heartbeat in 2 minutes
-            heartbeat_cutoff = datetime.utcnow() - timedelta(minutes=2)
-            stale_users = User.query.filter(
-                User.is_online == True,
-                User.last_heartbeat < heartbeat_cutoff
-            ).all()
+            # Clean up users who haven't sent a heartbeat recently
+            heartbeat_cutoff = datetime.utcnow() - timedelta(seconds=app.config.get('PRESENCE_TIMEOUT'))
+            stale_users = chat_state.expire_presence(heartbeat_cutoff)
 
-            for user in stale_users:
-                user.is_online = False
-                if user.id in online_users:
-                    online_users.remove(user.id)
-                print(f"Marked user {user.id} as offline due to inactivity")
+            for user_id in stale_users:
+                chat_state.remove_online_user(user_id)
+                print(f"Marked user {user_id} as offline due to inactivity")
 
             if stale_users:
+                # Tell related users, like a disconnect would
+                display_names = dict(
+                    User.query.with_entities(User.id, User.display_name).filter(User.id.in_(stale_users)).all()
+                )
+                for user_id in stale_users:
+                    presence_broadcaster.user_offline(user_id, display_names.get(user_id))
+
+                User.query.filter(User.id.in_(stale_users)).update({'is_online': False}, synchronize_session=False)
                 db.session.commit()
 
     except Exception as e:
         print(f"Error in cleanup_inactive_sessions: {str(e)}")
 
+def cleanup_media_uploads():
+    """Discard chunked uploads that were never completed"""
+    try:
+        expired_uploads = media_uploads.expire(app.config.get('MEDIA_UPLOAD_EXPIRY'))
+        if expired_uploads:
+            print(f"Discarded {expired_uploads} unfinished media uploads")
+    except Exception as e:
+        print(f"Error in cleanup_media_uploads: {str(e)}")
+
+def cleanup_rollups():
+    """Drop hourly dashboard counters past their retention; daily ones are kept"""
+    try:
+        with app.app_context():
+            retention = timedelta(days=app.config.get('ROLLUP_HOURLY_RETENTION_DAYS'))
+            pruned = prune_hourly(hour_start(datetime.utcnow()) - retention)
+            if pruned:
+                print(f"Pruned {pruned} hourly stats rollups")
+    except Exception as e:
+        print(f"Error in cleanup_rollups: {str(e)}")
+
+def flush_presence():
+    """Write heartbeats recorded since the last flush to the users table in one batch"""
+    seen = chat_state.take_unflushed_seen()
+    if not seen:
+        return
+
+    users = User.__table__
+    try:
+        with app.app_context():
+            db.session.execute(
+                update(users)
+                .where(users.c.id == db.bindparam('user_id'))
+                .values(last_heartbeat=db.bindparam('seen_at'), last_seen=db.bindparam('seen_at')),
+                [{'user_id': user_id, 'seen_at': seen_at} for user_id, seen_at in seen.items()]
+            )
+            db.session.commit()
+    except Exception as e:
+        print(f"Error flushing presence for {len(seen)} users: {str(e)}")
+
+# Write out heartbeats still pending when the process exits
+atexit.register(flush_presence)
+
 def cleanup_video_sessions():
-    """Clean up abandoned video sessions"""
-    cutoff_time = datetime.utcnow() - timedelta(minutes=2)
-    
-    for user_id, chat_data in list(active_chats.items()):
-        if chat_data['chat_type'] == 'video' and chat_data.get('start_time', datetime.utcnow()) < cutoff_time:
-            print(f"Cleaning up stale video session for user {user_id}")
-            cleanup_user_sessions(user_id)
+    """End video chats where a participant's media never became ready"""
+    try:
+        with app.app_context():
+            cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('VIDEO_MEDIA_TIMEOUT'))
+
+            for user_id in chat_state.expire_media_wait(cutoff_time):
+                chat_data = chat_state.end_chat(user_id)
+                if not chat_data:
+                    continue
+
+                session_id = chat_data['session_id']
+                session_cache.mark_ended(session_id)
+
+                chat_session = ChatSession.query.get(session_id)
+                if chat_session and not chat_session.ended_at:
+                    end_chat_session(chat_session, 'media_timeout')
+                    db.session.commit()
+
+                recipients = [user_id, chat_data['partner']] if chat_data['partner_active'] else [user_id]
+                for recipient in recipients:
+                    socketio.emit('video_chat_ended', {
+                        'session_id': session_id,
+                        'reason': 'media_timeout',
+                        'partner_left': recipient != user_id,
+                        'timestamp': datetime.utcnow().isoformat()
+                    }, room=recipient)
+
+                print(f"Ended video session {session_id}: media for user {user_id} was not ready in time")
+
+    except Exception as e:
+        print(f"Error in cleanup_video_sessions: {str(e)}")
 
 def calculate_estimated_wait(chat_type):
     """Calculate estimated wait time based on queue length"""
     base_wait = 10  # seconds
     wait_per_user = 5  # seconds
-    return base_wait + (len(waiting_users[chat_type]) * wait_per_user)
+    return base_wait + (chat_state.queue_length(chat_type) * wait_per_user)
 
 def cleanup_user_sessions(user_id):
     """Clean up user sessions on disconnect"""
     # Remove from waiting lists
-    for chat_type in ['text', 'video']:
-        waiting_users[chat_type] = [u for u in waiting_users[chat_type] if u.get('user_id') != user_id]
+    chat_state.dequeue(user_id)
 
     # Handle active chat cleanup
-    if user_id in active_chats:
-        chat_data = active_chats[user_id]
+    chat_data = chat_state.end_chat(user_id)
+    if chat_data:
         partner_id = chat_data['partner']
         session_id = chat_data['session_id']
+        session_cache.mark_ended(session_id)
 
         # Notify partner
-        if partner_id in active_chats:
-            emit('partner_disconnected', {
+        if chat_data['partner_active']:
+            socketio.emit('partner_disconnected', {
                 'session_id': session_id,
                 'timestamp': datetime.utcnow().isoformat()
             }, room=partner_id)
-            del active_chats[partner_id]
 
         # Update chat session
         chat_session = ChatSession.query.get(session_id)
         if chat_session and not chat_session.ended_at:
-            chat_session.ended_at = datetime.utcnow()
-            chat_session.end_reason = 'user_disconnected'
-            if chat_session.started_at:
-                duration = (chat_session.ended_at - chat_session.started_at).total_seconds()
-                chat_session.duration = int(duration)
+            end_chat_session(chat_session, 'user_disconnected')
             db.session.commit()
 
-        del active_chats[user_id]
-
 def start_background_tasks():
-    """Start background maintenance tasks"""
+    """Start background maintenance tasks once per process"""
+    global background_tasks_started
+
+    with background_tasks_lock:
+        if background_tasks_started:
+            return
+        background_tasks_started = True
+
+    print("Starting background tasks...")
+
     def periodic_cleanup():
         while True:
             socketio.sleep(60)  # Run every minute
+            cleanup_media_uploads()
+            cleanup_rollups()
+
+    def presence_broadcast_loop():
+        while True:
+            socketio.sleep(presence_broadcaster.interval)
+            try:
+                presence_broadcaster.flush()
+            except Exception as e:
+                print(f"Error broadcasting presence: {str(e)}")
+
+    def expiry_loop():
+        # Expiry only touches what is due, so it can run every second
+        while True:
+            socketio.sleep(app.config.get('EXPIRY_TICK_INTERVAL', 1))
             cleanup_inactive_sessions()
+            cleanup_video_sessions()
+            typing_tracker.expire()
+
+    def presence_flush_loop():
+        while True:
+            socketio.sleep(app.config.get('PRESENCE_FLUSH_INTERVAL', 15))
+            flush_presence()
+
+    def matchmaking_loop():
+        while True:
+            socketio.sleep(app.config.get('MATCHMAKING_TICK_INTERVAL', 0.2))
+            try:
+                with app.app_context():
+                    run_matchmaking_tick()
+            except Exception as e:
+                print(f"Error in matchmaking tick: {str(e)}")
 
     socketio.start_background_task(periodic_cleanup)
+    socketio.start_background_task(expiry_loop)
+    socketio.start_background_task(presence_broadcast_loop)
+    socketio.start_background_task(presence_flush_loop)
+    socketio.start_background_task(matchmaking_loop)
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(user_id)
 
-# Create database tables - with proper error handling
-with app.app_context():
-    try:
-        db.create_all()
-        print("Database tables created successfully!")
-
-        # Create default admin user if not exists
-        admin_user = User.query.filter_by(email='admin@shadowtalk.com').first()
-        if not admin_user:
-            admin_user = User(
-                email='admin@shadowtalk.com',
-                password=generate_password_hash('admin123'),
-                username='admin',
-                display_name='Administrator',
-                is_verified=True,
-                is_profile_complete=True
-            )
-            db.session.add(admin_user)
-            db.session.commit()
-            print("Default admin user created!")
-
-    except Exception as e:
-        print(f"Error creating database: {e}")
-        # If there's an error, try to identify the problem
-        import traceback
-        traceback.print_exc()
+# Tables, indexes and the default admin accounts are created by migrations,
+# run once per deploy with `flask --app app migrate` before workers start
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending database schema migrations"""
+    applied = run_migrations()
+    if not applied:
+        print("Database schema is up to date")
+
+@app.cli.command('backfill-chat-stats')
+def backfill_chat_stats_command():
+    """Recompute every user's chat totals from the chat sessions"""
+    with db.engine.begin() as conn:
+        users = backfill_user_stats(conn)
+    print(f"Recomputed chat statistics for {users} users")
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the dashboard counters in stats_rollups from the source tables"""
+    with db.engine.begin() as conn:
+        rows = backfill_rollups(conn)
+    print(f"Rebuilt {rows} stats rollups")
+
+@app.cli.command('migration-status')
+def migration_status_command():
+    """List migrations that have not been applied yet"""
+    pending = pending_migrations()
+    for version, name in pending:
+        print(f"Pending migration {version:04d} {name}")
+    if not pending:
+        print("Database schema is up to date")
 
 from flask_admin import Admin as FlaskAdmin
 
@@ -534,15 +562,16 @@ class MyAdminIndexView(AdminIndexView):
             return redirect(url_for('login'))
 
         # Admin dashboard statistics
+        counts = totals('users', 'reports_pending', 'messages', 'chat_sessions')
         stats = {
-            'total_users': User.query.count(),
-            'online_users': len(online_users),
-            'active_chats': len(active_chats) // 2,
-            'pending_reports': Report.query.filter_by(status='pending').count(),
-            'waiting_text': len(waiting_users['text']),
-            'waiting_video': len(waiting_users['video']),
-            'total_messages': Message.query.count(),
-            'total_sessions': ChatSession.query.count()
+            'total_users': counts['users'],
+            'online_users': chat_state.online_count(),
+            'active_chats': chat_state.active_chat_count(),
+            'pending_reports': counts['reports_pending'],
+            'waiting_text': chat_state.queue_length('text'),
+            'waiting_video': chat_state.queue_length('video'),
+            'total_messages': counts['messages'],
+            'total_sessions': counts['chat_sessions']
         }
 
         # Recent activity
@@ -655,28 +684,32 @@ class PasswordResetRequestAdminView(SecureModelView):
 class AnalyticsView(BaseView):
     @expose('/')
     def index(self):
+        counts = totals(
+            'users', 'chat_sessions', 'chat_sessions_text', 'chat_sessions_video',
+            'messages', 'reports', 'reports_pending', 'reports_resolved'
+        )
+
         # User growth statistics
-        total_users = User.query.count()
-        today = datetime.utcnow().date()
+        total_users = counts['users']
 
-        # Daily stats
-        users_today = User.query.filter(db.func.date(User.created_at) == today).count()
-        users_week = User.query.filter(User.created_at >= today - timedelta(days=7)).count()
-        users_month = User.query.filter(User.created_at >= today - timedelta(days=30)).count()
+        # Daily stats, summed from the daily signup rollups
+        users_today = daily_sum('signups', 0)
+        users_week = daily_sum('signups', 7)
+        users_month = daily_sum('signups', 30)
 
         # Chat statistics
-        total_sessions = ChatSession.query.count()
-        text_sessions = ChatSession.query.filter_by(session_type='text').count()
-        video_sessions = ChatSession.query.filter_by(session_type='video').count()
+        total_sessions = counts['chat_sessions']
+        text_sessions = counts['chat_sessions_text']
+        video_sessions = counts['chat_sessions_video']
 
         # Message statistics
-        total_messages = Message.query.count()
-        messages_today = Message.query.filter(db.func.date(Message.timestamp) == today).count()
+        total_messages = counts['messages']
+        messages_today = daily_sum('messages', 0)
 
         # Report statistics
-        total_reports = Report.query.count()
-        pending_reports = Report.query.filter_by(status='pending').count()
-        resolved_reports = Report.query.filter_by(status='resolved').count()
+        total_reports = counts['reports']
+        pending_reports = counts['reports_pending']
+        resolved_reports = counts['reports_resolved']
 
         return self.render('admin/analytics.html',
                          total_users=total_users,
@@ -696,14 +729,15 @@ class SystemMonitorView(BaseView):
     @expose('/')
     def index(self):
         # Real-time system statistics
+        counts = totals('connections', 'chat_sessions_active', 'notifications_unread')
         stats = {
-            'online_users': len(online_users),
-            'active_chats': len(active_chats) // 2,
-            'waiting_text': len(waiting_users['text']),
-            'waiting_video': len(waiting_users['video']),
-            'total_connections': Connection.query.count(),
-            'active_sessions': ChatSession.query.filter(ChatSession.ended_at.is_(None)).count(),
-            'unread_notifications': Notification.query.filter_by(is_read=False).count(),
+            'online_users': chat_state.online_count(),
+            'active_chats': chat_state.active_chat_count(),
+            'waiting_text': chat_state.queue_length('text'),
+            'waiting_video': chat_state.queue_length('video'),
+            'total_connections': counts['connections'],
+            'active_sessions': counts['chat_sessions_active'],
+            'unread_notifications': counts['notifications_unread'],
             'server_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         }
 
@@ -1284,23 +1318,15 @@ def update_profile():
         if avatar_data and avatar_data.startswith('data:image') and not remove_avatar:
             print("Processing avatar data URL")
             try:
-                import base64
-                # Extract the base64 data
-                header, encoded = avatar_data.split(',', 1)
-                file_extension = header.split('/')[1].split(';')[0]
-                
-                # Generate unique filename
-                unique_filename = f"{current_user.id}_{int(time.time())}_ai_avatar.{file_extension}"
-                file_path = os.path.join(avatars_dir, unique_filename)
-                
-                # Decode and save the image
-                image_data = base64.b64decode(encoded)
-                with open(file_path, 'wb') as f:
-                    f.write(image_data)
+                # Decode and store the image; renditions are generated in the background
+                mime_type, image_data = parse_data_url(avatar_data)
+                if image_data is None:
+                    raise ValueError('Invalid avatar data URL')
+                digest = media_store.put(image_data, mime_type)
                 
                 # Update user's avatar URL
-                current_user.avatar_url = f"/static/avatars/{unique_filename}"
-                print("Saved AI avatar:", unique_filename)
+                current_user.avatar_url = store_image(digest)
+                print("Saved AI avatar:", digest)
                 
             except Exception as e:
                 print(f"Error processing avatar data URL: {e}")
@@ -1313,10 +1339,6 @@ def update_profile():
             file = request.files['avatar']
             if file and file.filename != '':
                 print("Processing uploaded avatar file")
-                # Secure the filename and create unique name
-                filename = secure_filename(file.filename)
-                unique_filename = f"{current_user.id}_{int(time.time())}_{filename}"
-                file_path = os.path.join(avatars_dir, unique_filename)
                 
                 # Remove old avatar if exists
                 if current_user.avatar_url and current_user.avatar_url.startswith('/static/avatars/'):
@@ -1326,12 +1348,15 @@ def update_profile():
                         os.remove(old_path)
                         print("Removed old avatar file:", old_filename)
                 
-                # Save the new file
-                file.save(file_path)
+                # Save the new file into the media store; renditions are generated in the background
+                fd, tmp_path = tempfile.mkstemp(dir=media_store.tmp_dir)
+                os.close(fd)
+                file.save(tmp_path)
+                digest = media_store.put_file(tmp_path, file.mimetype)
                 
                 # Update user's avatar URL
-                current_user.avatar_url = f"/static/avatars/{unique_filename}"
-                print("Saved uploaded avatar:", unique_filename)
+                current_user.avatar_url = store_image(digest)
+                print("Saved uploaded avatar:", digest)
         
         # Update other profile fields
         current_user.display_name = request.form.get('display_name', current_user.display_name)
@@ -1440,24 +1465,29 @@ def admin_dashboard():
     if current_user.email != 'admin@shadowtalk.com':
         return redirect(url_for('index'))
 
-    # Get statistics
+    # Get statistics; counters come from the rollups, active users need
+    # distinct logins and stay an indexed range count on last_login
+    counts = totals(
+        'users', 'reports_pending', 'users_banned', 'chat_sessions_text', 'chat_sessions_video',
+        'chat_seconds', 'chat_sessions_timed'
+    )
     stats = {
-        'total_users': User.query.count(),
-        'active_chats': len(active_chats) // 2,
-        'pending_reports': Report.query.filter_by(status='pending').count(),
-        'banned_users': User.query.filter_by(is_banned=True).count(),
+        'total_users': counts['users'],
+        'active_chats': chat_state.active_chat_count(),
+        'pending_reports': counts['reports_pending'],
+        'banned_users': counts['users_banned'],
         'moderation_queue': 0,
-        'text_chats': ChatSession.query.filter_by(session_type='text').count(),
-        'video_chats': ChatSession.query.filter_by(session_type='video').count(),
+        'text_chats': counts['chat_sessions_text'],
+        'video_chats': counts['chat_sessions_video'],
         'daily_active_users': User.query.filter(
             User.last_login >= datetime.utcnow() - timedelta(days=1)
         ).count(),
         'weekly_active_users': User.query.filter(
             User.last_login >= datetime.utcnow() - timedelta(days=7)
         ).count(),
-        'avg_chat_duration': db.session.query(
-            db.func.avg(ChatSession.duration)
-        ).scalar() or 0,
+        'avg_chat_duration': (
+            counts['chat_seconds'] / counts['chat_sessions_timed'] if counts['chat_sessions_timed'] else 0
+        ),
         'ai_flagged_today': 0,
         'manual_actions_today': 0
     }
@@ -1475,19 +1505,10 @@ def admin_dashboard():
         ChatSession.started_at.desc()
     ).limit(50).all()
 
-    # Get user reports count
-    user_reports_count = {}
-    for report in Report.query.all():
-        if report.reported_user_id:
-            user_reports_count[report.reported_user_id] = \
-                user_reports_count.get(report.reported_user_id, 0) + 1
-
-    # Get user warnings count - UPDATED
-    user_warnings_count = {}
-    for warning in UserWarningLog.query.all():  # Changed from UserWarning
-        if warning.user_id:
-            user_warnings_count[warning.user_id] = \
-                user_warnings_count.get(warning.user_id, 0) + 1
+    # Report and warning counts for the users shown on the page
+    page_user_ids = [user.id for user in users]
+    user_reports_count = report_counts(page_user_ids)
+    user_warnings_count = warning_counts(page_user_ids)
 
     # Get moderation queue
     moderation_queue = []
@@ -1593,30 +1614,22 @@ def ban_user():
         ).all()
 
         for session in active_sessions:
-            session.ended_at = datetime.utcnow()
-            session.end_reason = 'user_banned'
-            if session.started_at:
-                duration = (session.ended_at - session.started_at).total_seconds()
-                session.duration = int(duration)
+            end_chat_session(session, 'user_banned')
 
         # Remove from waiting lists and active chats
-        global waiting_users, active_chats
+        chat_state.dequeue(user_id)
         
-        for chat_type in ['text', 'video']:
-            waiting_users[chat_type] = [u for u in waiting_users[chat_type] if u.get('user_id') != user_id]
-        
-        if user_id in active_chats:
-            partner_id = active_chats[user_id]['partner']
-            if partner_id in active_chats:
+        chat_data = chat_state.end_chat(user_id)
+        if chat_data:
+            session_cache.mark_ended(chat_data['session_id'])
+            if chat_data['partner_active']:
                 # Notify partner
                 emit('chat_ended', {
-                    'session_id': active_chats[user_id]['session_id'],
+                    'session_id': chat_data['session_id'],
                     'reason': 'partner_banned',
                     'partner_left': True,
                     'timestamp': datetime.utcnow().isoformat()
-                }, room=partner_id)
-                del active_chats[partner_id]
-            del active_chats[user_id]
+                }, room=chat_data['partner'])
 
         db.session.commit()
 
@@ -1686,11 +1699,11 @@ def get_user_details(user_id):
     user = User.query.get_or_404(user_id)
 
     # Get user statistics
-    chat_count = ChatSession.query.filter(
-        (ChatSession.user1_id == user_id) | (ChatSession.user2_id == user_id)
-    ).count()
+    chat_stats = db.session.get(UserChatStats, user_id)
+    chat_count = chat_stats.total_chats if chat_stats else 0
 
-    report_count = Report.query.filter_by(reported_user_id=user_id).count()
+    report_count = report_counts([user_id]).get(user_id, 0)
+    warning_count = warning_counts([user_id]).get(user_id, 0)
 
     return jsonify({
         'success': True,
@@ -1702,7 +1715,8 @@ def get_user_details(user_id):
             'created_at': user.created_at.isoformat(),
             'last_login': user.last_login.isoformat() if user.last_login else None,
             'chat_count': chat_count,
-            'report_count': report_count
+            'report_count': report_count,
+            'warning_count': warning_count
         }
     })
 
@@ -1927,20 +1941,14 @@ def send_reset_email(email, token):
 @login_required
 def chat_stats():
     """Get chat statistics for dashboard"""
-    total_chats = ChatSession.query.filter(
-        (ChatSession.user1_id == current_user.id) |
-        (ChatSession.user2_id == current_user.id)
-    ).count()
-
-    total_messages = Message.query.join(ChatSession).filter(
-        (ChatSession.user1_id == current_user.id) |
-        (ChatSession.user2_id == current_user.id)
-    ).count()
+    # Totals are kept per user as chats start, end and get messages
+    stats = db.session.get(UserChatStats, current_user.id)
 
     return jsonify({
-        'total_chats': total_chats,
-        'total_messages': total_messages,
-        'online_users': len(online_users)
+        'total_chats': stats.total_chats if stats else 0,
+        'total_messages': stats.total_messages if stats else 0,
+        'total_minutes': stats.total_seconds // 60 if stats else 0,
+        'online_users': chat_state.online_count()
     })
 
 @app.route('/api/chat/history')
@@ -1950,7 +1958,13 @@ def chat_history():
     page = request.args.get('page', 1, type=int)
     per_page = 10
 
-    chat_sessions = ChatSession.query.filter(
+    # Partners and last messages are joined into the page query; the message
+    # count is a column kept up to date by the message writer
+    chat_sessions = ChatSession.query.options(
+        joinedload(ChatSession.user1),
+        joinedload(ChatSession.user2),
+        joinedload(ChatSession.last_message)
+    ).filter(
         (ChatSession.user1_id == current_user.id) |
         (ChatSession.user2_id == current_user.id)
     ).order_by(desc(ChatSession.started_at)).paginate(
@@ -1960,9 +1974,7 @@ def chat_history():
     sessions_data = []
     for session in chat_sessions.items:
         partner = session.user2 if session.user1_id == current_user.id else session.user1
-        last_message = Message.query.filter_by(
-            chat_session_id=session.id
-        ).order_by(desc(Message.timestamp)).first()
+        last_message = session.last_message
 
         sessions_data.append({
             'session_id': session.id,
@@ -1971,7 +1983,7 @@ def chat_history():
             'started_at': session.started_at.isoformat() if session.started_at else None,
             'duration': session.duration,
             'last_message': last_message.content if last_message else None,
-            'message_count': Message.query.filter_by(chat_session_id=session.id).count()
+            'message_count': session.message_count
         })
 
     return jsonify({
@@ -1980,32 +1992,112 @@ def chat_history():
         'current_page': page
     })
 
-@app.route('/api/chat/session/<int:session_id>')
+# Columns sent for each message of a session's history
+HISTORY_COLUMNS = (Message.id, Message.content, Message.sender_id, Message.message_type, Message.timestamp)
+
+def message_history_query(session_id, before=None, after=None, from_start=False):
+    """Keyset query for a session's messages past a cursor message id.
+
+    Messages are ordered by (timestamp, id), since ids from different
+    workers do not follow send order. With ``before`` the query walks
+    backwards from the cursor, newest first, and with ``after`` forwards.
+    Without a cursor it starts at the newest message, or walks forwards
+    from the first one if ``from_start`` is set.
+    A cursor that is not a message of this session matches nothing.
+    """
+    query = select(*HISTORY_COLUMNS).where(Message.chat_session_id == session_id)
+    cursor_id = before if before is not None else after
+    if cursor_id is not None:
+        cursor_at = select(Message.timestamp).where(
+            Message.id == cursor_id,
+            Message.chat_session_id == session_id
+        ).scalar_subquery()
+        if before is not None:
+            query = query.where(or_(
+                Message.timestamp < cursor_at,
+                and_(Message.timestamp == cursor_at, Message.id < cursor_id)
+            ))
+        else:
+            query = query.where(or_(
+                Message.timestamp > cursor_at,
+                and_(Message.timestamp == cursor_at, Message.id > cursor_id)
+            ))
+
+    if after is not None or (from_start and before is None):
+        return query.order_by(Message.timestamp.asc(), Message.id.asc())
+    return query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+def history_message_json(row, viewer_id):
+    return {
+        'id': row.id,
+        'content': row.content,
+        'sender_id': row.sender_id,
+        'type': row.message_type,
+        'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+        'is_own': row.sender_id == viewer_id
+    }
+
+def stream_message_history(session_id, viewer_id, after=None):
+    """Yield a session's messages from ``after`` onwards as NDJSON lines.
+
+    Rows are read in keyset batches and the database session is released
+    before each batch is sent, so memory and connections stay flat however
+    long the conversation and however slow the client.
+    """
+    batch_size = app.config.get('MESSAGE_STREAM_BATCH_SIZE')
+    while True:
+        rows = db.session.execute(
+            message_history_query(session_id, after=after, from_start=True).limit(batch_size)
+        ).all()
+        db.session.close()
+
+        for row in rows:
+            yield json.dumps(history_message_json(row, viewer_id)) + '\n'
+        if len(rows) < batch_size:
+            return
+        after = rows[-1].id
+
+@app.route('/api/chat/session/<session_id>')
 @login_required
 def chat_session_details(session_id):
-    """Get details and messages for a specific chat session"""
+    """Get details and a page of messages for a specific chat session.
+
+    Messages come in send order, ``limit`` at a time: the newest page by
+    default, older pages with ``before=<message id>`` and newer ones with
+    ``after=<message id>``. ``format=ndjson`` streams every message from
+    ``after`` (or the first message) as one JSON object per line.
+    """
     chat_session = ChatSession.query.get_or_404(session_id)
 
     # Check if user is part of this chat session
     if current_user.id not in [chat_session.user1_id, chat_session.user2_id]:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    partner = chat_session.user2 if chat_session.user1_id == current_user.id else chat_session.user1
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    if before is not None and after is not None:
+        return jsonify({'error': 'Use either before or after, not both'}), 400
+
+    if request.args.get('format') == 'ndjson':
+        if before is not None:
+            return jsonify({'error': 'Streaming only supports after'}), 400
+        return Response(
+            stream_with_context(stream_message_history(session_id, current_user.id, after=after)),
+            mimetype='application/x-ndjson'
+        )
 
-    # Get messages for this session
-    messages = Message.query.filter_by(
-        chat_session_id=session_id
-    ).order_by(Message.timestamp.asc()).all()
-
-    messages_data = []
-    for message in messages:
-        messages_data.append({
-            'id': message.id,
-            'content': message.content,
-            'sender_id': message.sender_id,
-            'timestamp': message.timestamp.isoformat(),
-            'is_own': message.sender_id == current_user.id
-        })
+    limit = request.args.get('limit', app.config.get('MESSAGE_PAGE_SIZE'), type=int)
+    limit = max(1, min(limit, app.config.get('MESSAGE_PAGE_MAX')))
+
+    # One extra row tells whether there is another page in this direction
+    rows = db.session.execute(message_history_query(session_id, before=before, after=after).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is None:
+        rows.reverse()
+    messages_data = [history_message_json(row, current_user.id) for row in rows]
+
+    partner = chat_session.user2 if chat_session.user1_id == current_user.id else chat_session.user1
 
     return jsonify({
         'session': {
@@ -2019,9 +2111,219 @@ def chat_session_details(session_id):
             'display_name': partner.display_name if partner else 'Anonymous',
             'interests': partner.interests_list if partner else []
         },
-        'messages': messages_data
+        'messages': messages_data,
+        'has_more': has_more,
+        'before': messages_data[0]['id'] if messages_data else before,
+        'after': messages_data[-1]['id'] if messages_data else after
+    })
+
+# Shared Media
+@app.route('/media/<digest>')
+@login_required
+def download_media(digest):
+    """Serve a stored media blob, with range support for audio and video seeking"""
+    if not media_store.exists(digest):
+        return jsonify({'error': 'Media not found'}), 404
+
+    mime_type = media_store.mime_type(digest)
+    if is_resizable_image(mime_type):
+        # Originals can carry EXIF data such as GPS position; only stripped renditions are served
+        return redirect(url_for('media_rendition', digest=digest, rendition='full'))
+
+    inline = mime_type.startswith(('image/', 'video/', 'audio/')) and mime_type != 'image/svg+xml'
+
+    response = send_file(
+        media_store.path(digest),
+        mimetype=mime_type,
+        as_attachment=not inline,
+        download_name=secure_filename(request.args.get('name', '')) or digest,
+        conditional=True,
+        etag=digest,
+        max_age=app.config.get('MEDIA_CACHE_MAX_AGE')
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/media/<digest>/<rendition>')
+@login_required
+def media_rendition(digest, rendition):
+    """Serve a resized, metadata-free rendition of an image.
+
+    A missing rendition is generated while the request waits, up to
+    RENDITION_WAIT_TIMEOUT seconds. The original is never served instead,
+    since it may carry EXIF data: a rendition still being generated gives
+    202 with Retry-After, and one that cannot be generated 404.
+    """
+    if not media_store.exists(digest) or rendition not in RENDITIONS:
+        return jsonify({'error': 'Media not found'}), 404
+
+    path = image_pipeline.rendition_path(digest, rendition)
+    if not path and image_pipeline.wait(digest, app.config.get('RENDITION_WAIT_TIMEOUT')):
+        path = image_pipeline.rendition_path(digest, rendition)
+    if not path:
+        if image_pipeline.rendering(digest):
+            response = jsonify({'status': 'processing'})
+            response.status_code = 202
+            response.headers['Retry-After'] = '1'
+            return response
+        return jsonify({'error': 'Image is not available'}), 404
+
+    response = send_file(
+        path,
+        mimetype='image/webp',
+        conditional=True,
+        etag=f"{digest}-{rendition}",
+        max_age=app.config.get('RENDITION_CACHE_MAX_AGE')
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def media_url(digest, file_name=None):
+    """Download URL for a stored media blob"""
+    return url_for('download_media', digest=digest, name=file_name or None)
+
+def is_resizable_image(mime_type):
+    return bool(mime_type) and mime_type.startswith('image/') and mime_type != 'image/svg+xml'
+
+def store_image(digest):
+    """Queue renditions for a stored image and return the URL of its preview rendition"""
+    image_pipeline.submit(digest)
+    return url_for('media_rendition', digest=digest, rendition='preview')
+
+def create_media_message(session_id, partner_id, digest, file_name, file_type, file_size):
+    """Record a stored media blob as a chat message and send it to the partner"""
+    # Create media message, with an id from the same sequence as queued messages
+    message = Message(
+        id=message_ids.next_id(),
+        chat_session_id=session_id,
+        sender_id=current_user.id,
+        content=f"[Media: {file_name}]",
+        message_type='media',
+        media_data=blob_ref(digest),
+        media_type=file_type,
+        media_name=file_name,
+        timestamp=datetime.utcnow()
+    )
+    db.session.add(message)
+    db.session.execute(session_messages_update(), {
+        'session_id': session_id,
+        'added': 1,
+        'latest_id': message.id,
+        'activity_at': message.timestamp
+    })
+    record_messages({session_id: 1})
+    db.session.commit()
+
+    # Images are shown and downloaded as metadata-free renditions, never as uploaded
+    if is_resizable_image(file_type):
+        preview_url = store_image(digest)
+        download_url = url_for('media_rendition', digest=digest, rendition='full')
+    else:
+        download_url = media_url(digest, file_name)
+        preview_url = download_url
+
+    # Send to partner
+    socketio.emit('media_message', {
+        'message_id': message.id,
+        'session_id': session_id,
+        'sender_id': current_user.id,
+        'sender_name': current_user.display_name,
+        'file_name': file_name,
+        'file_type': file_type,
+        'file_size': file_size,
+        'timestamp': message.timestamp.isoformat(),
+        'preview_url': preview_url,
+        'download_url': download_url
+    }, room=partner_id)
+
+    return message, preview_url
+
+@app.errorhandler(UploadError)
+def handle_upload_error(error):
+    """Report chunked upload errors with the bytes received so far"""
+    return jsonify({'error': str(error), 'received': error.received}), error.status
+
+@app.route('/api/media/uploads', methods=['POST'])
+@login_required
+def create_media_upload():
+    """Start a chunked media upload for the current chat session"""
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id')
+
+    try:
+        file_size = int(data.get('file_size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Missing file size'}), 400
+
+    if file_size <= 0 or file_size > app.config.get('MEDIA_MAX_SIZE'):
+        return jsonify({'error': 'File too large. Maximum size is 5MB.'}), 413
+
+    if not get_active_partner(session_id, current_user.id):
+        return jsonify({'error': 'Invalid chat session'}), 403
+
+    upload = media_uploads.create(
+        current_user.id,
+        file_size,
+        session_id=session_id,
+        file_name=secure_filename(data.get('file_name') or '') or 'file',
+        file_type=data.get('file_type') or 'application/octet-stream',
+        temp_id=data.get('temp_id')
+    )
+    return jsonify(upload_status(upload)), 201
+
+@app.route('/api/media/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_media_upload(upload_id):
+    """Bytes received so far, so a client can resume after reconnecting"""
+    return jsonify(upload_status(media_uploads.get(upload_id, current_user.id)))
+
+@app.route('/api/media/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_media_chunk(upload_id):
+    """Append one chunk at ?offset=N, streamed straight to disk"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Missing offset'}), 400
+
+    received = media_uploads.append(upload_id, current_user.id, offset, request.stream)
+    return jsonify({'upload_id': upload_id, 'received': received})
+
+@app.route('/api/media/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_media_upload(upload_id):
+    """Store a fully received upload and send it to the chat partner"""
+    upload = media_uploads.get(upload_id, current_user.id)
+    partner_id = get_active_partner(upload['session_id'], current_user.id)
+    if not partner_id:
+        return jsonify({'error': 'Invalid chat session'}), 403
+
+    upload, digest = media_uploads.finish(upload_id, current_user.id)
+    message, preview_url = create_media_message(
+        upload['session_id'], partner_id, digest,
+        upload['file_name'], upload['file_type'], upload['file_size']
+    )
+
+    return jsonify({
+        'message_id': message.id,
+        'temp_id': upload.get('temp_id'),
+        'file_name': upload['file_name'],
+        'preview_url': preview_url,
+        'timestamp': message.timestamp.isoformat()
     })
 
+def upload_status(upload):
+    """Client-facing view of a chunked upload"""
+    return {
+        'upload_id': upload['upload_id'],
+        'received': upload['received'],
+        'file_size': upload['file_size'],
+        'chunk_size': upload['chunk_size']
+    }
+
 # Service Pages Routes
 @app.route('/privacy-policy')
 def privacy_policy():
@@ -2046,13 +2348,12 @@ def help_center():
 @socketio.on('connect')
 def handle_connect():
     """Handle user connection"""
-    global online_users, active_chats, waiting_users
-    
     try:
         if current_user.is_authenticated:
             user_id = current_user.id
             join_room(user_id)
-            online_users.add(user_id)
+            online_count = chat_state.add_online_user(user_id)
+            chat_state.touch(user_id, datetime.utcnow())
 
             # Update user online status in database
             current_user.is_online = True
@@ -2060,31 +2361,23 @@ def handle_connect():
             current_user.last_heartbeat = datetime.utcnow()
             db.session.commit()
 
-            # Broadcast user online status to all users
-            emit('user_online_status', {
-                'user_id': user_id,
-                'display_name': current_user.display_name,
-                'status': 'online',
-                'timestamp': datetime.utcnow().isoformat()
-            }, broadcast=True)
-
-            # Send online count to all users
-            emit('online_count_update', {
-                'count': len(online_users),
-                'timestamp': datetime.utcnow().isoformat()
-            }, broadcast=True)
+            # Status and online count go out with the next presence broadcast
+            presence_broadcaster.user_online(user_id, current_user.display_name)
 
             # Send connection success to the connected user
             emit('connection_established', {
                 'user_id': user_id,
-                'online_users': len(online_users),
-                'waiting_text': len(waiting_users['text']),
-                'waiting_video': len(waiting_users['video']),
-                'active_chats': len(active_chats),
+                'online_users': online_count,
+                'waiting_text': chat_state.queue_length('text'),
+                'waiting_video': chat_state.queue_length('video'),
+                'active_chats': chat_state.active_chat_count(),
                 'server_time': datetime.utcnow().isoformat()
             }, room=user_id)
 
-            print(f"User {current_user.display_name} ({user_id}) connected. Online users: {len(online_users)}")
+            print(f"User {current_user.display_name} ({user_id}) connected. Online users: {online_count}")
+
+            # Background tasks start with the first client connection
+            start_background_tasks()
 
         else:
             # Handle unauthenticated connections
@@ -2105,16 +2398,13 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle user disconnection"""
-    global online_users, active_chats, waiting_users
-    
     try:
         if current_user.is_authenticated:
             user_id = current_user.id
             leave_room(user_id)
 
             # Remove from online users
-            if user_id in online_users:
-                online_users.remove(user_id)
+            online_count = chat_state.remove_online_user(user_id)
 
             # Update user offline status in database
             current_user.is_online = False
@@ -2124,21 +2414,10 @@ def handle_disconnect():
             # Clean up any active chat sessions for this user
             cleanup_user_sessions(user_id)
 
-            # Broadcast user offline status to all users
-            emit('user_online_status', {
-                'user_id': user_id,
-                'display_name': current_user.display_name,
-                'status': 'offline',
-                'timestamp': datetime.utcnow().isoformat()
-            }, broadcast=True)
-
-            # Update online count for all users
-            emit('online_count_update', {
-                'count': len(online_users),
-                'timestamp': datetime.utcnow().isoformat()
-            }, broadcast=True)
+            # Status and online count go out with the next presence broadcast
+            presence_broadcaster.user_offline(user_id, current_user.display_name)
 
-            print(f"User {current_user.display_name} ({user_id}) disconnected. Online users: {len(online_users)}")
+            print(f"User {current_user.display_name} ({user_id}) disconnected. Online users: {online_count}")
 
     except Exception as e:
         print(f"Error in handle_disconnect: {str(e)}")
@@ -2146,15 +2425,12 @@ def handle_disconnect():
 @socketio.on('heartbeat')
 def handle_heartbeat(data):
     """Handle client heartbeat to track active connection"""
-    global online_users
-    
     try:
         if current_user.is_authenticated:
             user_id = current_user.id
             
-            # Update last heartbeat timestamp
-            current_user.last_heartbeat = datetime.utcnow()
-            db.session.commit()
+            # Record the heartbeat; presence_flush_loop writes it to the database in batches
+            chat_state.touch(user_id, datetime.utcnow())
 
             # Send acknowledgment back to client
             emit('heartbeat_ack', {
@@ -2182,39 +2458,30 @@ def handle_start_chat_search(data):
 
     print(f"User {current_user.id} ({user_gender}) from {user_location} starting {chat_type} chat search")
 
-    # Remove user from any existing queues
-    for ctype in ['text', 'video']:
-        waiting_users[ctype] = [u for u in waiting_users[ctype] if u.get('user_id') != current_user.id]
-
-    # Add user to waiting list with enhanced metadata
-    user_data = {
-        'user_id': current_user.id,
-        'interests': user_interests,
-        'filters': filters,
-        'location': user_location,
-        'gender': user_gender,
-        'joined_at': datetime.utcnow().isoformat(),
-        'chat_type': chat_type,
-        'language': data.get('language', 'en')
-    }
+    # Add user to waiting list with enhanced metadata, replacing any existing queue entry
+    user_data = make_queue_entry(
+        current_user, chat_type, user_interests,
+        filters=filters,
+        location=user_location,
+        language=data.get('language', 'en')
+    )
 
-    waiting_users[chat_type].append(user_data)
+    position = chat_state.enqueue(chat_type, user_data)
 
     # Send searching status with enhanced info
     emit('chat_search_started', {
         'chat_type': chat_type,
-        'position': len(waiting_users[chat_type]),
-        'total_waiting': len(waiting_users[chat_type]),
+        'position': position,
+        'total_waiting': chat_state.queue_length(chat_type),
         'estimated_wait': calculate_estimated_wait(chat_type),
         'searching_globally': True,
         'gender_preference': 'opposite',
         'timestamp': datetime.utcnow().isoformat()
     }, room=current_user.id)
 
-    # Try to match immediately with gender-based approach
-    attempt_gender_based_matchmaking(chat_type)
+    # The next matchmaking tick pairs the user with a partner
 
-    print(f"User {current_user.id} ({user_gender}) from {user_location} started {chat_type} chat search. Position: {len(waiting_users[chat_type])}")
+    print(f"User {current_user.id} ({user_gender}) from {user_location} started {chat_type} chat search. Position: {position}")
 
 def get_user_location(request):
     """Get user location from IP address or client data"""
@@ -2250,7 +2517,7 @@ def handle_cancel_chat_search(data):
     chat_type = data.get('type', 'text')
 
     # Remove from waiting list
-    waiting_users[chat_type] = [u for u in waiting_users[chat_type] if u.get('user_id') != current_user.id]
+    chat_state.dequeue(current_user.id, chat_type)
 
     emit('chat_search_cancelled', {
         'chat_type': chat_type,
@@ -2266,20 +2533,16 @@ def handle_get_chat_status(data):
         return
 
     chat_type = data.get('type', 'text')
-    position = None
 
     # Find user position in queue
-    for i, user_data in enumerate(waiting_users[chat_type]):
-        if user_data.get('user_id') == current_user.id:
-            position = i + 1
-            break
+    position = chat_state.queue_position(chat_type, current_user.id)
 
-    in_chat = current_user.id in active_chats
+    in_chat = chat_state.in_chat(current_user.id)
 
     emit('chat_status_update', {
         'in_queue': position is not None,
         'position': position,
-        'total_waiting': len(waiting_users[chat_type]),
+        'total_waiting': chat_state.queue_length(chat_type),
         'in_chat': in_chat,
         'chat_type': chat_type,
         'estimated_wait': calculate_estimated_wait(chat_type),
@@ -2307,133 +2570,154 @@ def handle_send_message(data):
         return
 
     # Verify user is in this chat session
-    chat_session = ChatSession.query.get(session_id)
-    if not chat_session or current_user.id not in [chat_session.user1_id, chat_session.user2_id]:
+    session = session_cache.load(session_id, ChatSession.query.get)
+    if not session or current_user.id not in session['partners']:
         emit('message_error', {
             'temp_id': temporary_id,
             'error': 'Invalid chat session'
         })
         return
 
-    # Check if chat is still active
-    if chat_session.ended_at:
+    # Get partner ID
+    partner_id = session['partners'][current_user.id]
+
+    # Check if chat is still active, here or on any other worker
+    if session['ended'] or not chat_is_active(session_id, current_user.id, partner_id):
         emit('message_error', {
             'temp_id': temporary_id,
             'error': 'Chat session has ended'
         })
         return
 
-    # Create message record
-    message = Message(
-        chat_session_id=session_id,
-        sender_id=current_user.id,
-        content=message_content,
-        message_type=message_type,
-        timestamp=datetime.utcnow()
-    )
-    db.session.add(message)
-    db.session.commit()
-
-    # Get partner ID
-    partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
+    # Create message record; the id is pre-allocated so nothing waits on the database
+    message_id = message_ids.next_id()
+    timestamp = datetime.utcnow()
 
     # Prepare message data for delivery
     message_data = {
-        'id': message.id,
+        'id': message_id,
         'session_id': session_id,
         'sender_id': current_user.id,
         'sender_name': current_user.display_name,
         'content': message_content,
         'type': message_type,
-        'timestamp': message.timestamp.isoformat(),
+        'timestamp': timestamp.isoformat(),
         'temp_id': temporary_id
     }
 
     # Send to partner
     emit('new_message', message_data, room=partner_id)
 
+    # Persist in the background with the session's last activity
+    message_writer.submit({
+        'id': message_id,
+        'chat_session_id': session_id,
+        'sender_id': current_user.id,
+        'content': message_content,
+        'message_type': message_type,
+        'timestamp': timestamp
+    })
+
+    # Postpone the idle-chat expiry for both participants
+    chat_state.touch_chat(current_user.id, timestamp)
+
     # Confirm delivery to sender
     emit('message_sent', {
         'temp_id': temporary_id,
-        'message_id': message.id,
-        'timestamp': message.timestamp.isoformat()
+        'message_id': message_id,
+        'timestamp': timestamp.isoformat()
     }, room=current_user.id)
 
-    # Update chat session last activity
-    chat_session.last_activity = datetime.utcnow()
-    db.session.commit()
-
     print(f"Message sent in session {session_id} from {current_user.id} to {partner_id}")
 
+def parse_receipt_timestamp(value):
+    """Naive UTC datetime from a message's ISO timestamp, or None if missing or invalid"""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def acknowledge_messages(session_id, up_to_id, up_to_timestamp, status):
+    """Mark the partner's messages up to a high-water message as delivered or read and notify them once.
+
+    The mark is the message's (timestamp, id), the order messages were
+    sent in; without a valid timestamp it is looked up from the id.
+    """
+    try:
+        up_to_id = int(up_to_id)
+    except (TypeError, ValueError):
+        return
+
+    partner_id = get_session_partner(session_id, current_user.id)
+    if not partner_id:
+        return
+
+    # One UPDATE covers every message up to the high-water mark, applied after queued inserts
+    timestamp = datetime.utcnow()
+    message_writer.submit_receipt(
+        session_id, current_user.id, up_to_id, parse_receipt_timestamp(up_to_timestamp), status, timestamp
+    )
+
+    # Notify sender with a single summary
+    emit('message_delivery_status', {
+        'session_id': session_id,
+        'message_id': up_to_id,
+        'up_to_id': up_to_id,
+        'status': status,
+        'timestamp': timestamp.isoformat()
+    }, room=partner_id)
+
+@socketio.on('messages_delivered')
+def handle_messages_delivered(data):
+    """Confirm delivery of all partner messages up to a message"""
+    if not current_user.is_authenticated:
+        return
+
+    acknowledge_messages(data.get('session_id'), data.get('up_to_id'), data.get('up_to_timestamp'), 'delivered')
+
+@socketio.on('messages_read')
+def handle_messages_read(data):
+    """Confirm reading of all partner messages up to a message"""
+    if not current_user.is_authenticated:
+        return
+
+    acknowledge_messages(data.get('session_id'), data.get('up_to_id'), data.get('up_to_timestamp'), 'read')
+
 @socketio.on('message_delivered')
 def handle_message_delivered(data):
     """Confirm message delivery to recipient"""
-    message_id = data.get('message_id')
-    session_id = data.get('session_id')
-
-    message = Message.query.get(message_id)
-    if message and message.sender_id != current_user.id:
-        # Mark as delivered
-        message.delivered_at = datetime.utcnow()
-        db.session.commit()
+    if not current_user.is_authenticated:
+        return
 
-        # Notify sender
-        emit('message_delivery_status', {
-            'message_id': message_id,
-            'status': 'delivered',
-            'timestamp': datetime.utcnow().isoformat()
-        }, room=message.sender_id)
+    acknowledge_messages(data.get('session_id'), data.get('message_id'), data.get('timestamp'), 'delivered')
 
 @socketio.on('message_read')
 def handle_message_read(data):
     """Confirm message read by recipient"""
-    message_id = data.get('message_id')
-    session_id = data.get('session_id')
-
-    message = Message.query.get(message_id)
-    if message and message.sender_id != current_user.id:
-        # Mark as read
-        message.read_at = datetime.utcnow()
-        db.session.commit()
+    if not current_user.is_authenticated:
+        return
 
-        # Notify sender
-        emit('message_delivery_status', {
-            'message_id': message_id,
-            'status': 'read',
-            'timestamp': datetime.utcnow().isoformat()
-        }, room=message.sender_id)
+    acknowledge_messages(data.get('session_id'), data.get('message_id'), data.get('timestamp'), 'read')
 
 # Typing Indicators
 @socketio.on('start_typing')
 def handle_start_typing(data):
-    """Notify partner that user is typing"""
+    """Notify partner that user is typing, at most once per typing window"""
     session_id = data.get('session_id')
 
-    chat_session = ChatSession.query.get(session_id)
-    if chat_session and current_user.id in [chat_session.user1_id, chat_session.user2_id]:
-        partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
-
-        emit('partner_typing', {
-            'session_id': session_id,
-            'user_id': current_user.id,
-            'user_name': current_user.display_name,
-            'timestamp': datetime.utcnow().isoformat()
-        }, room=partner_id)
+    partner_id = get_active_partner(session_id, current_user.id)
+    if partner_id:
+        typing_tracker.start(session_id, current_user.id, partner_id, current_user.display_name)
 
 @socketio.on('stop_typing')
 def handle_stop_typing(data):
     """Notify partner that user stopped typing"""
-    session_id = data.get('session_id')
-
-    chat_session = ChatSession.query.get(session_id)
-    if chat_session and current_user.id in [chat_session.user1_id, chat_session.user2_id]:
-        partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
-
-        emit('partner_stopped_typing', {
-            'session_id': session_id,
-            'user_id': current_user.id,
-            'timestamp': datetime.utcnow().isoformat()
-        }, room=partner_id)
+    typing_tracker.stop(data.get('session_id'), current_user.id)
 
 # Chat Session Control
 @socketio.on('end_chat')
@@ -2445,33 +2729,27 @@ def handle_end_chat(data):
     session_id = data.get('session_id')
     reason = data.get('reason', 'user_left')
 
-    if current_user.id in active_chats:
-        chat_data = active_chats[current_user.id]
+    # Remove from active chats
+    chat_data = chat_state.end_chat(current_user.id)
+    if chat_data:
         partner_id = chat_data['partner']
         session_id = chat_data['session_id']
-
-        # Remove from active chats
-        del active_chats[current_user.id]
+        session_cache.mark_ended(session_id)
 
         # Update chat session
         chat_session = ChatSession.query.get(session_id)
         if chat_session and not chat_session.ended_at:
-            chat_session.ended_at = datetime.utcnow()
-            chat_session.end_reason = reason
-            if chat_session.started_at:
-                duration = (chat_session.ended_at - chat_session.started_at).total_seconds()
-                chat_session.duration = int(duration)
+            end_chat_session(chat_session, reason)
             db.session.commit()
 
         # Notify partner
-        if partner_id in active_chats:
+        if chat_data['partner_active']:
             emit('chat_ended', {
                 'session_id': session_id,
                 'reason': reason,
                 'partner_left': True,
                 'timestamp': datetime.utcnow().isoformat()
             }, room=partner_id)
-            del active_chats[partner_id]
 
         # Notify user
         emit('chat_ended', {
@@ -2515,34 +2793,26 @@ def handle_join_video_chat(data):
     user_interests = data.get('interests', [])
     filters = data.get('filters', {})
 
-    # Remove user from any existing queues
-    for ctype in ['text', 'video']:
-        waiting_users[ctype] = [u for u in waiting_users[ctype] if u.get('user_id') != current_user.id]
-
-    # Add user to video waiting list
-    user_data = {
-        'user_id': current_user.id,
-        'interests': user_interests,
-        'filters': filters,
-        'joined_at': datetime.utcnow().isoformat(),
-        'chat_type': chat_type,
-        'media_ready': False
-    }
+    # Add user to video waiting list, replacing any existing queue entry
+    user_data = make_queue_entry(
+        current_user, chat_type, user_interests,
+        filters=filters,
+        media_ready=False
+    )
 
-    waiting_users[chat_type].append(user_data)
+    position = chat_state.enqueue(chat_type, user_data)
 
     # Send searching status
     emit('video_chat_search_started', {
-        'position': len(waiting_users[chat_type]),
-        'total_waiting': len(waiting_users[chat_type]),
+        'position': position,
+        'total_waiting': chat_state.queue_length(chat_type),
         'estimated_wait': calculate_estimated_wait(chat_type),
         'timestamp': datetime.utcnow().isoformat()
     }, room=current_user.id)
 
-    # Try to match immediately
-    attempt_video_matchmaking()
+    # The next matchmaking tick pairs the user with a partner
 
-    print(f"User {current_user.id} joined video chat queue. Position: {len(waiting_users[chat_type])}")
+    print(f"User {current_user.id} joined video chat queue. Position: {position}")
 
 @socketio.on('leave_video_chat')
 def handle_leave_video_chat(data):
@@ -2551,7 +2821,7 @@ def handle_leave_video_chat(data):
         return
 
     # Remove from waiting list
-    waiting_users['video'] = [u for u in waiting_users['video'] if u.get('user_id') != current_user.id]
+    chat_state.dequeue(current_user.id, 'video')
 
     emit('video_chat_search_cancelled', {
         'timestamp': datetime.utcnow().isoformat()
@@ -2561,36 +2831,24 @@ def handle_leave_video_chat(data):
 
 @socketio.on('webrtc_signal')
 def handle_webrtc_signal(data):
-    """Handle WebRTC signaling for video chat"""
+    """Relay WebRTC signaling (offer, answer, ice_candidate) for voice and video chat"""
     if not current_user.is_authenticated:
         return
 
     session_id = data.get('session_id')
-    signal_data = data.get('signal')
-    signal_type = data.get('type')  # offer, answer, ice_candidate
-
-    # Verify user is in this video chat session
-    if current_user.id not in active_chats:
-        emit('error', {'message': 'Not in active video chat'})
-        return
 
-    chat_data = active_chats[current_user.id]
-    if chat_data['session_id'] != session_id:
+    # Verify user is in this chat session; membership is cached in memory
+    session = session_cache.load(session_id, ChatSession.query.get)
+    if not session or current_user.id not in session['partners']:
         emit('error', {'message': 'Invalid session'})
         return
 
-    partner_id = chat_data['partner']
-
-    # Forward signal to partner
-    emit('webrtc_signal', {
-        'session_id': session_id,
-        'from_user_id': current_user.id,
-        'signal': signal_data,
-        'type': signal_type,
-        'timestamp': datetime.utcnow().isoformat()
-    }, room=partner_id)
+    partner_id = session['partners'][current_user.id]
+    if session['ended'] or not chat_is_active(session_id, current_user.id, partner_id):
+        emit('error', {'message': 'Chat session has ended'})
+        return
 
-    print(f"WebRTC {signal_type} signal forwarded from {current_user.id} to {partner_id}")
+    signal_relay.relay(session_id, current_user.id, partner_id, data)
 
 @socketio.on('media_ready')
 def handle_media_ready(data):
@@ -2602,15 +2860,11 @@ def handle_media_ready(data):
     media_type = data.get('media_type')  # video, audio, both
 
     # Update user's media status in waiting list
-    for user_data in waiting_users['video']:
-        if user_data['user_id'] == current_user.id:
-            user_data['media_ready'] = True
-            user_data['media_type'] = media_type
-            break
+    chat_state.set_media_ready(current_user.id, media_type)
 
     # If in active chat, notify partner
-    if current_user.id in active_chats:
-        chat_data = active_chats[current_user.id]
+    chat_data = chat_state.get_chat(current_user.id)
+    if chat_data:
         partner_id = chat_data['partner']
 
         emit('partner_media_ready', {
@@ -2630,32 +2884,26 @@ def handle_video_chat_ended(data):
     session_id = data.get('session_id')
     reason = data.get('reason', 'user_left')
 
-    if current_user.id in active_chats:
-        chat_data = active_chats[current_user.id]
+    # Remove from active chats
+    chat_data = chat_state.end_chat(current_user.id)
+    if chat_data:
         partner_id = chat_data['partner']
-
-        # Remove from active chats
-        del active_chats[current_user.id]
+        session_cache.mark_ended(chat_data['session_id'])
 
         # Update chat session
         chat_session = ChatSession.query.get(session_id)
         if chat_session and not chat_session.ended_at:
-            chat_session.ended_at = datetime.utcnow()
-            chat_session.end_reason = reason
-            if chat_session.started_at:
-                duration = (chat_session.ended_at - chat_session.started_at).total_seconds()
-                chat_session.duration = int(duration)
+            end_chat_session(chat_session, reason)
             db.session.commit()
 
         # Notify partner
-        if partner_id in active_chats:
+        if chat_data['partner_active']:
             emit('video_chat_ended', {
                 'session_id': session_id,
                 'reason': reason,
                 'partner_left': True,
                 'timestamp': datetime.utcnow().isoformat()
             }, room=partner_id)
-            del active_chats[partner_id]
 
         # Notify user
         emit('video_chat_ended', {
@@ -2667,99 +2915,6 @@ def handle_video_chat_ended(data):
 
         print(f"Video chat session {session_id} ended by user {current_user.id}. Reason: {reason}")
 
-# Video Chat Matching Function
-def attempt_video_matchmaking():
-    """Attempt to match users in video chat queue with media readiness"""
-    if len(waiting_users['video']) < 2:
-        return
-
-    # Find users who have media ready or at least one media type
-    ready_users = [u for u in waiting_users['video'] if u.get('media_ready', False)]
-    
-    if len(ready_users) < 2:
-        # Try to match any users if queue is long enough
-        if len(waiting_users['video']) >= 2:
-            ready_users = waiting_users['video'][:2]
-        else:
-            return
-
-    # Simple FIFO matching for now - enhance with interest matching later
-    user1_data = ready_users[0]
-    user2_data = ready_users[1]
-
-    # Remove from waiting list
-    waiting_users['video'] = [u for u in waiting_users['video'] 
-                             if u['user_id'] not in [user1_data['user_id'], user2_data['user_id']]]
-
-    user1_id = user1_data['user_id']
-    user2_id = user2_data['user_id']
-
-    # Create video chat session
-    chat_session = ChatSession(
-        user1_id=user1_id,
-        user2_id=user2_id,
-        session_type='video',
-        started_at=datetime.utcnow()
-    )
-    db.session.add(chat_session)
-    db.session.commit()
-
-    # Store in active chats
-    active_chats[user1_id] = {
-        'session_id': chat_session.id,
-        'partner': user2_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': 'video',
-        'media_ready': user1_data.get('media_ready', False)
-    }
-    active_chats[user2_id] = {
-        'session_id': chat_session.id,
-        'partner': user1_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': 'video',
-        'media_ready': user2_data.get('media_ready', False)
-    }
-
-    # Get user info for notification
-    user1 = User.query.get(user1_id)
-    user2 = User.query.get(user2_id)
-
-    # Calculate common interests
-    interests1 = set(user1_data.get('interests', []))
-    interests2 = set(user2_data.get('interests', []))
-    common_interests = list(interests1.intersection(interests2))
-
-    # Notify both users
-    match_data = {
-        'session_id': chat_session.id,
-        'partner_id': user2_id,
-        'partner_name': user2.display_name if user2 else 'Anonymous',
-        'partner_interests': user2_data.get('interests', []),
-        'common_interests': common_interests,
-        'chat_type': 'video',
-        'timestamp': datetime.utcnow().isoformat()
-    }
-
-    emit('video_chat_match_found', match_data, room=user1_id)
-
-    match_data['partner_id'] = user1_id
-    match_data['partner_name'] = user1.display_name if user1 else 'Anonymous'
-    match_data['partner_interests'] = user1_data.get('interests', [])
-
-    emit('video_chat_match_found', match_data, room=user2_id)
-
-    print(f"Matched users {user1_id} and {user2_id} for video chat. Session: {chat_session.id}")
-
-# Enhanced cleanup function for video chats
-def cleanup_video_sessions():
-    """Clean up abandoned video sessions"""
-    cutoff_time = datetime.utcnow() - timedelta(minutes=2)
-    
-    for user_id, chat_data in list(active_chats.items()):
-        if chat_data['chat_type'] == 'video' and chat_data.get('start_time', datetime.utcnow()) < cutoff_time:
-            print(f"Cleaning up stale video session for user {user_id}")
-            cleanup_user_sessions(user_id)
-
 # User Status and Presence
 @socketio.on('update_user_status')
 def handle_update_user_status(data):
@@ -2784,17 +2939,6 @@ def handle_update_user_status(data):
         'timestamp': datetime.utcnow().isoformat()
     }, broadcast=True)
 
-@socketio.on('heartbeat')
-def handle_heartbeat(data):
-    """Handle client heartbeat to track active connection"""
-    if current_user.is_authenticated:
-        current_user.last_heartbeat = datetime.utcnow()
-        db.session.commit()
-
-        emit('heartbeat_ack', {
-            'server_time': datetime.utcnow().isoformat()
-        }, room=current_user.id)
-
 # Media and File Sharing
 @socketio.on('send_media')
 def handle_send_media(data):
@@ -2809,48 +2953,35 @@ def handle_send_media(data):
     file_size = data.get('file_size')
 
     # Validate file size (5MB limit)
-    if file_size and file_size > 5 * 1024 * 1024:
+    if file_size and file_size > app.config.get('MEDIA_MAX_SIZE'):
         emit('media_error', {'error': 'File too large. Maximum size is 5MB.'})
         return
 
-    chat_session = ChatSession.query.get(session_id)
-    if not chat_session or current_user.id not in [chat_session.user1_id, chat_session.user2_id]:
+    partner_id = get_active_partner(session_id, current_user.id)
+    if not partner_id:
         emit('media_error', {'error': 'Invalid chat session'})
         return
 
-    partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
+    mime_type, media_bytes = parse_data_url(file_data)
+    if media_bytes is None:
+        emit('media_error', {'error': 'Invalid file data'})
+        return
+    if len(media_bytes) > app.config.get('MEDIA_MAX_SIZE'):
+        emit('media_error', {'error': 'File too large. Maximum size is 5MB.'})
+        return
 
-    # Create media message
-    message = Message(
-        chat_session_id=session_id,
-        sender_id=current_user.id,
-        content=f"[Media: {file_name}]",
-        message_type='media',
-        media_data=file_data,
-        media_type=file_type,
-        media_name=file_name,
-        timestamp=datetime.utcnow()
+    # Store the file once by content hash; the message only keeps a reference
+    digest = media_store.put(media_bytes, file_type or mime_type)
+    message, preview_url = create_media_message(
+        session_id, partner_id, digest, file_name, file_type, len(media_bytes)
     )
-    db.session.add(message)
-    db.session.commit()
-
-    # Send to partner
-    emit('media_message', {
-        'message_id': message.id,
-        'session_id': session_id,
-        'sender_id': current_user.id,
-        'sender_name': current_user.display_name,
-        'file_name': file_name,
-        'file_type': file_type,
-        'file_size': file_size,
-        'timestamp': message.timestamp.isoformat(),
-        'preview_url': file_data  # In production, this would be a proper CDN URL
-    }, room=partner_id)
 
     # Confirm to sender
     emit('media_sent', {
         'message_id': message.id,
+        'temp_id': data.get('temp_id'),
         'file_name': file_name,
+        'preview_url': preview_url,
         'timestamp': message.timestamp.isoformat()
     }, room=current_user.id)
 
@@ -2860,9 +2991,8 @@ def handle_voice_chat_request(data):
     """Request voice chat with partner"""
     session_id = data.get('session_id')
 
-    chat_session = ChatSession.query.get(session_id)
-    if chat_session and current_user.id in [chat_session.user1_id, chat_session.user2_id]:
-        partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
+    partner_id = get_active_partner(session_id, current_user.id)
+    if partner_id:
 
         emit('voice_chat_invitation', {
             'session_id': session_id,
@@ -2877,9 +3007,8 @@ def handle_voice_chat_response(data):
     session_id = data.get('session_id')
     accepted = data.get('accepted', False)
 
-    chat_session = ChatSession.query.get(session_id)
-    if chat_session and current_user.id in [chat_session.user1_id, chat_session.user2_id]:
-        partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
+    partner_id = get_active_partner(session_id, current_user.id)
+    if partner_id:
 
         emit('voice_chat_response', {
             'session_id': session_id,
@@ -2900,25 +3029,6 @@ def handle_voice_chat_response(data):
                 'timestamp': datetime.utcnow().isoformat()
             }, room=partner_id)
 
-@socketio.on('webrtc_signal')
-def handle_webrtc_signal(data):
-    """Handle WebRTC signaling for voice/video chat"""
-    session_id = data.get('session_id')
-    signal_data = data.get('signal')
-    signal_type = data.get('type')  # offer, answer, candidate
-
-    chat_session = ChatSession.query.get(session_id)
-    if chat_session and current_user.id in [chat_session.user1_id, chat_session.user2_id]:
-        partner_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
-
-        emit('webrtc_signal', {
-            'session_id': session_id,
-            'from_user_id': current_user.id,
-            'signal': signal_data,
-            'type': signal_type,
-            'timestamp': datetime.utcnow().isoformat()
-        }, room=partner_id)
-
 # Moderation and Safety
 @socketio.on('report_user')
 def handle_report_user(data):
@@ -2931,12 +3041,10 @@ def handle_report_user(data):
     report_type = data.get('type', 'inappropriate_behavior')
     additional_info = data.get('additional_info')
 
-    chat_session = ChatSession.query.get(session_id)
-    if not chat_session or current_user.id not in [chat_session.user1_id, chat_session.user2_id]:
+    reported_user_id = get_session_partner(session_id, current_user.id)
+    if not reported_user_id:
         return
 
-    reported_user_id = chat_session.user2_id if chat_session.user1_id == current_user.id else chat_session.user1_id
-
     # Create report
     report = Report(
         reporter_id=current_user.id,
@@ -2972,7 +3080,7 @@ def handle_block_user(data):
     user_id_to_block = data.get('user_id')
     session_id = data.get('session_id')
 
-    if session_id and current_user.id in active_chats:
+    if session_id and chat_state.in_chat(current_user.id):
         handle_end_chat({
             'session_id': session_id,
             'reason': 'user_blocked'
@@ -2992,195 +3100,31 @@ def handle_admin_get_stats(data):
         emit('error', {'message': 'Unauthorized'})
         return
 
+    counts = totals('users', 'chat_sessions_active')
+    since = hour_start(datetime.utcnow()) - timedelta(hours=23)
     stats = {
-        'online_users': len(online_users),
-        'active_chats': len(active_chats) // 2,
-        'waiting_text': len(waiting_users['text']),
-        'waiting_video': len(waiting_users['video']),
-        'total_users': User.query.count(),
-        'active_sessions': ChatSession.query.filter(ChatSession.ended_at.is_(None)).count(),
+        'online_users': chat_state.online_count(),
+        'active_chats': chat_state.active_chat_count(),
+        'waiting_text': chat_state.queue_length('text'),
+        'waiting_video': chat_state.queue_length('video'),
+        'total_users': counts['users'],
+        'active_sessions': counts['chat_sessions_active'],
+        'messages_per_hour': {
+            bucket.isoformat(): value for bucket, value in series('messages', 'hour', since).items()
+        },
         'server_time': datetime.utcnow().isoformat(),
-        'system_uptime': get_system_uptime()  # You'd implement this
+        'system_uptime': get_system_uptime(),  # You'd implement this
+        'presence_fanout': presence_broadcaster.metrics(),
+        'typing': typing_tracker.metrics(),
+        'signaling': signal_relay.metrics()
     }
 
     emit('admin_stats', stats, room=current_user.id)
 
-def attempt_matchmaking(chat_type):
-    """Attempt to match users in the waiting queue"""
-    if len(waiting_users[chat_type]) < 2:
-        return
-
-    # Simple FIFO matching - you can enhance this with interest-based matching
-    user1_data = waiting_users[chat_type].pop(0)
-    user2_data = waiting_users[chat_type].pop(0)
-
-    user1_id = user1_data['user_id']
-    user2_id = user2_data['user_id']
-
-    # Create chat session
-    chat_session = ChatSession(
-        user1_id=user1_id,
-        user2_id=user2_id,
-        session_type=chat_type,
-        started_at=datetime.utcnow()
-    )
-    db.session.add(chat_session)
-    db.session.commit()
-
-    # Store in active chats
-    active_chats[user1_id] = {
-        'session_id': chat_session.id,
-        'partner': user2_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': chat_type
-    }
-    active_chats[user2_id] = {
-        'session_id': chat_session.id,
-        'partner': user1_id,
-        'start_time': datetime.utcnow(),
-        'chat_type': chat_type
-    }
-
-    # Get user info for notification
-    user1 = User.query.get(user1_id)
-    user2 = User.query.get(user2_id)
-
-    # Calculate common interests
-    interests1 = set(user1_data.get('interests', []))
-    interests2 = set(user2_data.get('interests', []))
-    common_interests = list(interests1.intersection(interests2))
-
-    # Notify both users
-    match_data = {
-        'session_id': chat_session.id,
-        'partner_id': user2_id,
-        'partner_name': user2.display_name if user2 else 'Anonymous',
-        'partner_interests': user2_data.get('interests', []),
-        'common_interests': common_interests,
-        'chat_type': chat_type,
-        'timestamp': datetime.utcnow().isoformat()
-    }
-
-    emit('chat_match_found', match_data, room=user1_id)
-
-    match_data['partner_id'] = user1_id
-    match_data['partner_name'] = user1.display_name if user1 else 'Anonymous'
-    match_data['partner_interests'] = user1_data.get('interests', [])
-
-    emit('chat_match_found', match_data, room=user2_id)
-
-    print(f"Matched users {user1_id} and {user2_id} for {chat_type} chat. Session: {chat_session.id}")
-
-def calculate_estimated_wait(chat_type):
-    """Calculate estimated wait time based on queue length"""
-    base_wait = 10  # seconds
-    wait_per_user = 5  # seconds
-    return base_wait + (len(waiting_users[chat_type]) * wait_per_user)
-
-def cleanup_user_sessions(user_id):
-    """Clean up user sessions on disconnect"""
-    # Remove from waiting lists
-    for chat_type in ['text', 'video']:
-        waiting_users[chat_type] = [u for u in waiting_users[chat_type] if u.get('user_id') != user_id]
-
-    # Handle active chat cleanup
-    if user_id in active_chats:
-        chat_data = active_chats[user_id]
-        partner_id = chat_data['partner']
-        session_id = chat_data['session_id']
-
-        # Notify partner
-        if partner_id in active_chats:
-            emit('partner_disconnected', {
-                'session_id': session_id,
-                'timestamp': datetime.utcnow().isoformat()
-            }, room=partner_id)
-            del active_chats[partner_id]
-
-        # Update chat session
-        chat_session = ChatSession.query.get(session_id)
-        if chat_session and not chat_session.ended_at:
-            chat_session.ended_at = datetime.utcnow()
-            chat_session.end_reason = 'user_disconnected'
-            if chat_session.started_at:
-                duration = (chat_session.ended_at - chat_session.started_at).total_seconds()
-                chat_session.duration = int(duration)
-            db.session.commit()
-
-        del active_chats[user_id]
-
 def get_system_uptime():
     """Get system uptime (simplified)"""
     return "0 days, 0 hours, 0 minutes"  # Implement actual uptime tracking
 
-def cleanup_inactive_sessions():
-    """Periodically clean up inactive sessions"""
-    global active_chats, waiting_users, online_users
-    
-    try:
-        with app.app_context():
-            # Clean up abandoned waiting users (older than 10 minutes)
-            cutoff_time = datetime.utcnow() - timedelta(minutes=10)
-
-            for chat_type in ['text', 'video']:
-                original_count = len(waiting_users[chat_type])
-                waiting_users[chat_type] = [
-                    u for u in waiting_users[chat_type]
-                    if datetime.fromisoformat(u.get('joined_at', datetime.utcnow().isoformat())) > cutoff_time
-                ]
-                if len(waiting_users[chat_type]) != original_count:
-                    print(f"Cleaned up {original_count - len(waiting_users[chat_type])} inactive waiting users from {chat_type} queue")
-
-            # Clean up stale active chats (no activity for 5 minutes)
-            stale_cutoff = datetime.utcnow() - timedelta(minutes=5)
-            users_to_remove = []
-
-            for user_id, chat_data in active_chats.items():
-                if chat_data.get('start_time', datetime.utcnow()) < stale_cutoff:
-                    users_to_remove.append(user_id)
-
-            for user_id in users_to_remove:
-                cleanup_user_sessions(user_id)
-                print(f"Cleaned up stale chat session for user {user_id}")
-
-            # Clean up users who haven't sent heartbeat in 2 minutes
-            heartbeat_cutoff = datetime.utcnow() - timedelta(minutes=2)
-            stale_users = User.query.filter(
-                User.is_online == True,
-                User.last_heartbeat < heartbeat_cutoff
-            ).all()
-
-            for user in stale_users:
-                user.is_online = False
-                if user.id in online_users:
-                    online_users.remove(user.id)
-                print(f"Marked user {user.id} as offline due to inactivity")
-
-            if stale_users:
-                db.session.commit()
-
-    except Exception as e:
-        print(f"Error in cleanup_inactive_sessions: {str(e)}")
-
-def start_background_tasks():
-    """Start background maintenance tasks"""
-    def periodic_cleanup():
-        while True:
-            socketio.sleep(60)  # Run every minute
-            cleanup_inactive_sessions()
-
-    socketio.start_background_task(periodic_cleanup)
-
-# Initialize background tasks when first client connects
-@socketio.on('connect')
-def initialize_background_tasks():
-    """Initialize background tasks when first client connects"""
-    global online_users
-    
-    if len(online_users) == 1:  # First connection
-        print("Starting background tasks...")
-        start_background_tasks()
-
 @app.route('/admin/unban-user', methods=['POST'])
 @login_required
 def unban_user():
@@ -3425,8 +3369,7 @@ def extend_ban():
 def update_database_schema():
     """Update database schema for the renamed UserWarningLog model"""
     try:
-    
-        db.create_all()
+        run_migrations()
         print("Database schema updated successfully!")
     except Exception as e:
         print(f"Error updating database schema: {e}")
@@ -3661,12 +3604,16 @@ def export_users():
         return jsonify({'success': False, 'error': 'Unauthorized'}), 403
 
     users = User.query.order_by(User.created_at.desc()).all()
+
+    # Every user is exported, so count over the whole tables in one GROUP BY each
+    user_reports_count = report_counts()
+    user_warnings_count = warning_counts()
     
     output = io.StringIO()
     writer = csv.writer(output)
     
     # Write header
-    writer.writerow(['ID', 'Email', 'Display Name', 'Username', 'Status', 'Verified', 'Banned', 'Created At', 'Last Login'])
+    writer.writerow(['ID', 'Email', 'Display Name', 'Username', 'Status', 'Verified', 'Banned', 'Created At', 'Last Login', 'Reports', 'Warnings'])
     
     # Write data
     for user in users:
@@ -3681,7 +3628,9 @@ def export_users():
             'Yes' if user.is_verified else 'No',
             'Yes' if user.is_banned else 'No',
             user.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            user.last_login.strftime('%Y-%m-%d %H:%M:%S') if user.last_login else 'Never'
+            user.last_login.strftime('%Y-%m-%d %H:%M:%S') if user.last_login else 'Never',
+            user_reports_count.get(user.id, 0),
+            user_warnings_count.get(user.id, 0)
         ])
     
     output.seek(0)
@@ -3701,12 +3650,16 @@ def export_banned_users():
         return jsonify({'success': False, 'error': 'Unauthorized'}), 403
 
     banned_users = User.query.filter_by(is_banned=True).order_by(User.banned_at.desc()).all()
+
+    banned_user_ids = [user.id for user in banned_users]
+    user_reports_count = report_counts(banned_user_ids)
+    user_warnings_count = warning_counts(banned_user_ids)
     
     output = io.StringIO()
     writer = csv.writer(output)
     
     # Write header
-    writer.writerow(['ID', 'Email', 'Display Name', 'Ban Reason', 'Banned At', 'Ban Expires', 'Banned By'])
+    writer.writerow(['ID', 'Email', 'Display Name', 'Ban Reason', 'Banned At', 'Ban Expires', 'Banned By', 'Reports', 'Warnings'])
     
     # Write data
     for user in banned_users:
@@ -3720,7 +3673,9 @@ def export_banned_users():
             user.ban_reason or 'No reason provided',
             user.banned_at.strftime('%Y-%m-%d %H:%M:%S') if user.banned_at else 'N/A',
             user.ban_expires_at.strftime('%Y-%m-%d %H:%M:%S') if user.ban_expires_at else 'Permanent',
-            banned_by_name
+            banned_by_name,
+            user_reports_count.get(user.id, 0),
+            user_warnings_count.get(user.id, 0)
         ])
     
     output.seek(0)
@@ -3739,7 +3694,10 @@ def export_chats():
     if current_user.email != 'admin@shadowtalk.com':
         return jsonify({'success': False, 'error': 'Unauthorized'}), 403
 
-    chat_sessions = ChatSession.query.order_by(ChatSession.started_at.desc()).all()
+    chat_sessions = ChatSession.query.options(
+        joinedload(ChatSession.user1),
+        joinedload(ChatSession.user2)
+    ).order_by(ChatSession.started_at.desc()).all()
     
     output = io.StringIO()
     writer = csv.writer(output)
@@ -3752,7 +3710,7 @@ def export_chats():
         user1_name = session.user1.display_name if session.user1 else 'Unknown'
         user2_name = session.user2.display_name if session.user2 else 'Unknown'
         status = 'Ended' if session.ended_at else 'Active'
-        message_count = len(session.messages)
+        message_count = session.message_count
         
         writer.writerow([
             session.id[:8] + '...',
@@ -4018,28 +3976,11 @@ def export_chats_pdf(chat_sessions):
         return export_chats_pdf(chat_sessions)
     
 if __name__ == '__main__':
+    # The development server is a single process, so it can migrate on start
     with app.app_context():
         try:
-            # Try to create tables if they don't exist
-            db.create_all()
-            print("Database tables checked/created successfully!")
-
-            # Create default admin user if not exists
-            from werkzeug.security import generate_password_hash
-            admin_user = Admin.query.filter_by(username='admin@shadowtalk.com').first()
-            if not admin_user:
-                print("Creating default admin user...")
-                admin_user = Admin(
-                    username='admin@shadowtalk.com',
-                    password=generate_password_hash('admin123'),
-                    is_super_admin=True
-                )
-                db.session.add(admin_user)
-                db.session.commit()
-                print("✓ Default admin user created: admin@shadowtalk.com / admin123")
-            else:
-                print("✓ Admin user already exists")
-
+            run_migrations()
+            print("Database schema is up to date")
         except Exception as e:
             print(f"Error during setup: {e}")
 
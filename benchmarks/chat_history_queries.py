@@ -0,0 +1,126 @@
+"""Count the SQL statements issued by one /api/chat/history page.
+
+Creates a scratch SQLite database through the migrations, writes chat
+sessions and messages through the app's MessageWriter, then calls the
+chat_history view as one of the users and counts every statement sent to
+the database. Exits with status 1 if the page takes more than
+MAX_QUERIES statements or if the denormalized message_count and
+last_message_id columns disagree with the messages table.
+
+    python benchmarks/chat_history_queries.py [--sessions 25] [--messages 8]
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The app reads its database and Redis settings at import time
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'history.db')}"
+os.environ.pop('REDIS_URL', None)
+
+from flask_login import login_user
+from sqlalchemy import event
+
+from app import app, chat_history, message_ids, message_writer
+from migrations import run_migrations
+from models import db, ChatSession, Message, User
+
+# One statement for the page with partners and last messages, one for the total
+MAX_QUERIES = 2
+
+
+def seed(sessions, messages):
+    """Create a user with ``sessions`` chats of ``messages`` messages each; returns the user"""
+    user = User(email='history@example.com', password='x', display_name='History')
+    partners = [
+        User(email=f"partner{i}@example.com", password='x', display_name=f"Partner {i}")
+        for i in range(sessions)
+    ]
+    db.session.add_all([user] + partners)
+    db.session.flush()
+
+    started_at = datetime.utcnow() - timedelta(days=1)
+    chat_sessions = []
+    for i, partner in enumerate(partners):
+        # Alternate sides so both halves of the user1/user2 filter are exercised
+        user1, user2 = (user, partner) if i % 2 else (partner, user)
+        chat_sessions.append(ChatSession(
+            user1_id=user1.id,
+            user2_id=user2.id,
+            session_type='text',
+            started_at=started_at + timedelta(minutes=i)
+        ))
+    db.session.add_all(chat_sessions)
+    db.session.commit()
+
+    for i, chat_session in enumerate(chat_sessions):
+        for n in range(messages + i % 3):
+            message_writer.submit({
+                'id': message_ids.next_id(),
+                'chat_session_id': chat_session.id,
+                'sender_id': chat_session.user1_id if n % 2 else chat_session.user2_id,
+                'content': f"message {n} in {chat_session.id}",
+                'message_type': 'text',
+                'timestamp': chat_session.started_at + timedelta(seconds=n)
+            })
+    message_writer.flush()
+    return user
+
+
+def counter_mismatches():
+    """Sessions whose message_count or last_message_id disagree with the messages table"""
+    mismatches = []
+    for chat_session in ChatSession.query.all():
+        messages = Message.query.filter_by(chat_session_id=chat_session.id).order_by(
+            Message.timestamp.desc(), Message.id.desc()
+        ).all()
+        last_message_id = messages[0].id if messages else None
+        if chat_session.message_count != len(messages) or chat_session.last_message_id != last_message_id:
+            mismatches.append(chat_session.id)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=25)
+    parser.add_argument('--messages', type=int, default=8, help='messages per session (varies by up to 2)')
+    args = parser.parse_args()
+
+    failures = 0
+    with app.app_context():
+        run_migrations()
+        user = seed(args.sessions, args.messages)
+        user_id = user.id
+
+        mismatches = counter_mismatches()
+        failures += bool(mismatches)
+        print(f"{'ok' if not mismatches else 'MISMATCH':>9}  message counters ({len(mismatches)} sessions wrong)")
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *event_args: statements.append(event_args[2]))
+
+        pages = -(-args.sessions // 10)
+        for page in range(1, pages + 1):
+            db.session.expunge_all()
+            with app.test_request_context(f"/api/chat/history?page={page}"):
+                login_user(db.session.get(User, user_id))
+                del statements[:]
+                data = chat_history().get_json()
+
+            too_many = len(statements) > MAX_QUERIES
+            failures += too_many
+            print(f"{'TOO MANY' if too_many else 'ok':>9}  page {page}: "
+                  f"{len(data['sessions'])} sessions in {len(statements)} queries")
+            if too_many:
+                for statement in statements:
+                    print(f"{'':>11}{' '.join(statement.split())[:120]}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
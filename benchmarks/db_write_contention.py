@@ -0,0 +1,126 @@
+"""Write throughput of a SQLite database under thread contention.
+
+Runs the same workload against a fresh database file twice: once with
+SQLAlchemy's default engine (rollback journal) and once with the options
+and pragmas from database.py (WAL, synchronous=NORMAL, busy_timeout,
+pooled connections). Writer threads commit small transactions, one
+message insert plus a session update each, like the chat hot path,
+while reader threads keep querying recent messages.
+
+    python benchmarks/db_write_contention.py --writers 16 --readers 4 --seconds 5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from database import engine_options, install_sqlite_pragmas
+
+SCHEMA = [
+    "CREATE TABLE chat_sessions (id INTEGER PRIMARY KEY, last_activity REAL)",
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_session_id INTEGER, content TEXT, timestamp REAL)",
+    "CREATE INDEX ix_messages_session ON messages (chat_session_id, id)"
+]
+SESSIONS = 200
+
+
+def make_engine(url, tuned):
+    if not tuned:
+        return create_engine(url)
+    engine = create_engine(url, **engine_options(url))
+    install_sqlite_pragmas(engine)
+    return engine
+
+
+def run(tuned, writers, readers, seconds):
+    tmp_dir = tempfile.mkdtemp()
+    url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    engine = make_engine(url, tuned)
+    with engine.begin() as conn:
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO chat_sessions (id, last_activity) VALUES (:id, 0)"),
+            [{'id': i} for i in range(SESSIONS)]
+        )
+
+    counts = {'writes': 0, 'reads': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def writer(index):
+        n = 0
+        while not stop.is_set():
+            session_id = (index * 7919 + n) % SESSIONS
+            n += 1
+            try:
+                with engine.begin() as conn:
+                    now = time.time()
+                    conn.execute(
+                        text("INSERT INTO messages (chat_session_id, content, timestamp) VALUES (:s, :c, :t)"),
+                        {'s': session_id, 'c': 'hello there', 't': now}
+                    )
+                    conn.execute(
+                        text("UPDATE chat_sessions SET last_activity = :t WHERE id = :s"),
+                        {'s': session_id, 't': now}
+                    )
+                key = 'writes'
+            except OperationalError:
+                key = 'errors'
+            with lock:
+                counts[key] += 1
+
+    def reader(index):
+        n = 0
+        while not stop.is_set():
+            n += 1
+            try:
+                with engine.connect() as conn:
+                    conn.execute(
+                        text("SELECT id, content FROM messages WHERE chat_session_id = :s ORDER BY id DESC LIMIT 50"),
+                        {'s': (index + n) % SESSIONS}
+                    ).fetchall()
+                key = 'reads'
+            except OperationalError:
+                key = 'errors'
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    engine.dispose()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {key: value / seconds for key, value in counts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    for tuned in (False, True):
+        result = run(tuned, args.writers, args.readers, args.seconds)
+        label = 'database.py options' if tuned else 'default engine'
+        print(f"{label:>20}: {result['writes']:9,.0f} commits/s  {result['reads']:9,.0f} reads/s  "
+              f"{result['errors']:7,.1f} lock errors/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Stress matchmaking with concurrent searches, cancels, ends and disconnects.
+
+Connects every user through a Socket.IO test client and, from several
+threads at once, has random users send start_chat_search,
+cancel_chat_search and end_chat or disconnect and reconnect, while
+other threads keep running run_matchmaking_tick. Afterwards it checks
+that no user ended up matched twice:
+
+  - every chat in chat_state is mirrored by the partner's, for the same session
+  - no user is in more than one open ChatSession
+  - every open ChatSession is the chat both its users have in chat_state
+
+Exits with status 1 on any violation.
+
+    python benchmarks/matchmaking_stress.py --users 200 --threads 16 --seconds 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The app reads its database and Redis settings at import time
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stress.db')}"
+os.environ.pop('REDIS_URL', None)
+
+from sqlalchemy import func
+
+from app import app, chat_state, run_matchmaking_tick, socketio
+from migrations import run_migrations
+from models import db, ChatSession, User
+
+INTERESTS = ['music', 'movies', 'games', 'travel', 'books']
+GENDERS = ['male', 'female', None]
+
+
+class StressUser:
+    """One user with a logged-in Socket.IO test client; only one thread drives it"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.http = app.test_client()
+        with self.http.session_transaction() as session:
+            session['_user_id'] = user_id
+            session['_fresh'] = True
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        self.socket = socketio.test_client(app, flask_test_client=self.http)
+
+    def disconnect(self):
+        if self.socket.is_connected():
+            self.socket.disconnect()
+
+    def act(self, rng):
+        """Send one random event; returns its name"""
+        if not self.socket.is_connected():
+            self.connect()
+            return 'connect'
+
+        roll = rng.random()
+        chat_type = rng.choice(['text', 'video'])
+        if roll < 0.5:
+            event = 'start_chat_search'
+            self.socket.emit(event, {'type': chat_type, 'interests': rng.sample(INTERESTS, 2)})
+        elif roll < 0.65:
+            event = 'cancel_chat_search'
+            self.socket.emit(event, {'type': chat_type})
+        elif roll < 0.9:
+            event = 'end_chat'
+            self.socket.emit(event, {'reason': 'user_left'})
+        else:
+            self.socket.disconnect()
+            return 'disconnect'
+        # Events sent back to this client are not needed
+        self.socket.get_received()
+        return event
+
+
+def seed(users):
+    rows = [
+        User(email=f"stress{i}@example.com", password='x', display_name=f"Stress {i}", gender=GENDERS[i % len(GENDERS)])
+        for i in range(users)
+    ]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+def violations():
+    """Descriptions of every broken invariant"""
+    problems = []
+    chats = {}
+    for user_id, in User.query.with_entities(User.id):
+        chat_data = chat_state.get_chat(user_id)
+        if chat_data:
+            chats[user_id] = chat_data
+
+    for user_id, chat_data in chats.items():
+        partner_chat = chats.get(chat_data['partner'])
+        if not partner_chat or partner_chat['partner'] != user_id or partner_chat['session_id'] != chat_data['session_id']:
+            problems.append(f"chat of {user_id} in {chat_data['session_id']} is not mirrored by its partner")
+
+    open_sessions = ChatSession.query.filter(ChatSession.ended_at.is_(None)).all()
+    sessions_per_user = {}
+    for chat_session in open_sessions:
+        for user_id in (chat_session.user1_id, chat_session.user2_id):
+            sessions_per_user.setdefault(user_id, []).append(chat_session.id)
+        for user_id, partner_id in ((chat_session.user1_id, chat_session.user2_id),
+                                    (chat_session.user2_id, chat_session.user1_id)):
+            chat_data = chats.get(user_id)
+            if not chat_data or chat_data['session_id'] != chat_session.id or chat_data['partner'] != partner_id:
+                problems.append(f"open session {chat_session.id} is not the chat of {user_id}")
+
+    for user_id, session_ids in sessions_per_user.items():
+        if len(session_ids) > 1:
+            problems.append(f"user {user_id} is in {len(session_ids)} open sessions")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--tickers', type=int, default=2, help='threads running matchmaking ticks')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        run_migrations()
+        user_ids = seed(args.users)
+    users = [StressUser(user_id) for user_id in user_ids]
+
+    stop = threading.Event()
+    events = [0] * args.threads
+    errors = []
+
+    def driver(index):
+        rng = random.Random(index)
+        # Each user belongs to one thread, so its test client is never shared
+        own = users[index::args.threads]
+        while not stop.is_set():
+            try:
+                rng.choice(own).act(rng)
+                events[index] += 1
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    ticks = [0]
+
+    def ticker():
+        while not stop.is_set():
+            try:
+                with app.app_context():
+                    run_matchmaking_tick()
+                ticks[0] += 1
+            except Exception as e:
+                errors.append(f"tick {type(e).__name__}: {e}")
+
+    threads = [threading.Thread(target=driver, args=(i,)) for i in range(args.threads)]
+    threads += [threading.Thread(target=ticker) for _ in range(args.tickers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        problems = violations()
+        sessions = db.session.query(func.count(ChatSession.id)).scalar()
+        active = chat_state.active_chat_count()
+
+    print(f"{sum(events):,} events and {ticks[0]:,} matchmaking ticks in {args.seconds:g} s; "
+          f"{sessions:,} chat sessions created, {active} chats active at the end")
+    for error in errors[:10]:
+        print(f"   error  {error}")
+    for problem in problems[:20]:
+        print(f"  VIOLATION  {problem}")
+    print(f"{'ok' if not problems and not errors else 'FAILED':>9}  {len(problems)} violations, {len(errors)} errors")
+
+    for user in users:
+        user.disconnect()
+    if problems or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Per-user report and warning counts: Python loop over all rows vs GROUP BY.
+
+Fills a scratch SQLite database with users, reports and warnings, then
+builds the admin dashboard's user_reports_count and user_warnings_count
+maps three ways:
+
+  all rows   load every Report and UserWarningLog and count in Python
+             (what admin_dashboard used to do)
+  page       report_counts/warning_counts for the 50 users on the page
+  export     report_counts()/warning_counts() for every user at once
+
+and prints the time and peak Python memory of each.
+
+    python benchmarks/moderation_counts.py --reports 1000000 --warnings 100000 --users 50000
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from database import configure_database
+from models import db, Report, User, UserWarningLog
+from moderation import report_counts, warning_counts
+
+INSERT_BATCH = 50000
+PAGE_SIZE = 50
+
+
+def fill(users, reports, warnings):
+    user_ids = [f"{i:036d}" for i in range(users)]
+    db.session.execute(User.__table__.insert(), [
+        {'id': user_id, 'email': f"user{i}@example.com", 'password': 'x'}
+        for i, user_id in enumerate(user_ids)
+    ])
+
+    rng = random.Random(42)
+    for table, total, column in ((Report.__table__, reports, 'reported_user_id'),
+                                 (UserWarningLog.__table__, warnings, 'user_id')):
+        for start in range(0, total, INSERT_BATCH):
+            # A few users collect most reports, like on a real platform
+            db.session.execute(table.insert(), [
+                {column: user_ids[int(rng.paretovariate(1.2)) % users], 'reason': 'spam'}
+                for _ in range(min(INSERT_BATCH, total - start))
+            ])
+    db.session.commit()
+    return user_ids
+
+
+def all_rows(page_user_ids):
+    user_reports_count = {}
+    for report in Report.query.all():
+        if report.reported_user_id:
+            user_reports_count[report.reported_user_id] = user_reports_count.get(report.reported_user_id, 0) + 1
+    user_warnings_count = {}
+    for warning in UserWarningLog.query.all():
+        if warning.user_id:
+            user_warnings_count[warning.user_id] = user_warnings_count.get(warning.user_id, 0) + 1
+    return user_reports_count, user_warnings_count
+
+
+def page(page_user_ids):
+    return report_counts(page_user_ids), warning_counts(page_user_ids)
+
+
+def export(page_user_ids):
+    return report_counts(), warning_counts()
+
+
+def measure(func, page_user_ids):
+    db.session.remove()
+    started = time.perf_counter()
+    result = func(page_user_ids)
+    elapsed = time.perf_counter() - started
+
+    db.session.remove()
+    tracemalloc.start()
+    func(page_user_ids)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reports', type=int, default=1000000)
+    parser.add_argument('--warnings', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=50000)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(tmp_dir, 'moderation.db')}"
+    configure_database(app)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            print(f"Inserting {args.users:,} users, {args.reports:,} reports and {args.warnings:,} warnings...")
+            user_ids = fill(args.users, args.reports, args.warnings)
+            # The most reported users and some never reported ones, as on a dashboard page
+            page_user_ids = user_ids[:PAGE_SIZE // 2] + user_ids[-(PAGE_SIZE // 2):]
+
+            expected = None
+            for label, func in (('all rows', all_rows), ('page', page), ('export', export)):
+                (reports, warnings), elapsed, peak = measure(func, page_user_ids)
+                on_page = (
+                    {user_id: reports[user_id] for user_id in page_user_ids if user_id in reports},
+                    {user_id: warnings[user_id] for user_id in page_user_ids if user_id in warnings}
+                )
+                if expected is None:
+                    expected = on_page
+                status = 'ok' if on_page == expected else 'MISMATCH'
+                print(f"{label:>9}: {elapsed * 1000:10,.1f} ms  {peak / 2**20:8,.1f} MiB peak  {status}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
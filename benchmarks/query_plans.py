@@ -0,0 +1,139 @@
+"""Check that the hot queries are served by indexes.
+
+Builds the queries issued by chat_history, chat_session_details,
+get_notifications, forgot_password, verify_otp, cleanup_inactive_sessions
+and admin_dashboard against a scratch SQLite database created from
+models.py, runs EXPLAIN QUERY PLAN on each and reports any full table
+scan. Exits with status 1 if one is found.
+
+    python benchmarks/query_plans.py [-v]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import and_, desc, func, or_, select
+
+from database import configure_database
+from models import db, AuditLog, ChatSession, Message, Notification, OTP, PasswordResetRequest, Report, User, UserWarningLog
+
+
+def hot_queries():
+    """(name, statement) pairs mirroring the queries in app.py"""
+    user_id = 'u' * 36
+    session_id = 's' * 36
+    now = datetime.utcnow()
+
+    def count(query):
+        return select(func.count()).select_from(query.subquery())
+
+    def history_page(older):
+        # Same shape as message_history_query in app.py
+        cursor_at = select(Message.timestamp).where(
+            Message.id == 1000, Message.chat_session_id == session_id
+        ).scalar_subquery()
+        if older:
+            keyset = or_(Message.timestamp < cursor_at, and_(Message.timestamp == cursor_at, Message.id < 1000))
+            order = (Message.timestamp.desc(), Message.id.desc())
+        else:
+            keyset = or_(Message.timestamp > cursor_at, and_(Message.timestamp == cursor_at, Message.id > 1000))
+            order = (Message.timestamp.asc(), Message.id.asc())
+        return select(Message.id, Message.content).where(
+            Message.chat_session_id == session_id, keyset
+        ).order_by(*order).limit(51)
+
+    return [
+        ('chat_history: sessions', ChatSession.query.filter(
+            (ChatSession.user1_id == user_id) | (ChatSession.user2_id == user_id)
+        ).order_by(desc(ChatSession.started_at)).limit(10).statement),
+        ('chat_history: last message', Message.query.filter_by(
+            chat_session_id=session_id
+        ).order_by(desc(Message.timestamp)).limit(1).statement),
+        ('chat_history: message count', count(Message.query.filter_by(chat_session_id=session_id))),
+        ('chat_session_details: newest page', select(Message.id, Message.content).where(
+            Message.chat_session_id == session_id
+        ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(51)),
+        ('chat_session_details: older page', history_page(older=True)),
+        ('chat_session_details: newer page', history_page(older=False)),
+        ('get_notifications', Notification.query.filter_by(
+            user_id=user_id, is_read=False
+        ).order_by(Notification.created_at.desc()).statement),
+        ('forgot_password: rate limit', count(PasswordResetRequest.query.filter(
+            PasswordResetRequest.ip_address == '127.0.0.1',
+            PasswordResetRequest.requested_at >= now - timedelta(hours=1)
+        ))),
+        ('forgot_password: user', User.query.filter_by(email='a@example.com').limit(1).statement),
+        ('verify_otp', OTP.query.filter_by(email='a@example.com', otp='123456').limit(1).statement),
+        ('cleanup_inactive_sessions: stale users', User.query.filter(User.id.in_([user_id])).statement),
+        ('admin_dashboard: pending reports count', count(Report.query.filter_by(status='pending'))),
+        ('admin_dashboard: banned users', count(User.query.filter_by(is_banned=True))),
+        ('admin_dashboard: sessions by type', count(ChatSession.query.filter_by(session_type='text'))),
+        ('admin_dashboard: daily active users', count(User.query.filter(
+            User.last_login >= now - timedelta(days=1)
+        ))),
+        ('admin_dashboard: pending reports', Report.query.filter_by(status='pending').order_by(
+            Report.created_at.desc()
+        ).statement),
+        ('admin_dashboard: reports against user', Report.query.filter_by(reported_user_id=user_id).statement),
+        ('admin_dashboard: report counts', select(Report.reported_user_id, func.count()).where(
+            Report.reported_user_id.in_([user_id])
+        ).group_by(Report.reported_user_id)),
+        ('admin_dashboard: warning counts', select(UserWarningLog.user_id, func.count()).where(
+            UserWarningLog.user_id.in_([user_id])
+        ).group_by(UserWarningLog.user_id)),
+        ('admin_dashboard: recent users', User.query.order_by(User.created_at.desc()).limit(50).statement),
+        ('admin_dashboard: recent sessions', ChatSession.query.order_by(
+            ChatSession.started_at.desc()
+        ).limit(50).statement),
+        ('admin_dashboard: live sessions', ChatSession.query.filter(
+            ChatSession.ended_at.is_(None)
+        ).order_by(ChatSession.started_at.desc()).statement),
+        ('admin_dashboard: audit log', AuditLog.query.order_by(AuditLog.created_at.desc()).limit(50).statement),
+    ]
+
+
+def explain(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup or ())
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    """Plan steps that read a whole table rather than an index"""
+    return [step for step in plan if step.startswith('SCAN ') and 'INDEX' not in step]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every plan')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    configure_database(app)
+
+    failures = 0
+    with app.app_context():
+        db.create_all()
+        with db.engine.connect() as conn:
+            for name, statement in hot_queries():
+                plan = explain(conn, statement)
+                scans = full_scans(plan)
+                failures += bool(scans)
+                print(f"{'FULL SCAN' if scans else 'ok':>9}  {name}")
+                if scans or args.verbose:
+                    for step in plan:
+                        print(f"{'':>11}{step}")
+
+    if failures:
+        print(f"{failures} queries read a whole table")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
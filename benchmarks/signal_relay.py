@@ -0,0 +1,182 @@
+"""Signals per second through one worker's webrtc_signal handler.
+
+Simulates call setups from several handler threads at once. Each call is
+an offer, an answer, a burst of trickle ICE candidates from both sides
+and a renegotiation offer from the caller. Every signal goes through
+handle_webrtc_signal as the sending user, with its session checks, into
+the app's SignalRelay. Emits go to a recording stand-in for Socket.IO,
+so the figure is the handler and relay cost per worker, not network
+throughput. The same calls are then sent straight into SignalRelay.relay,
+which shows how much of that cost is the relay itself. Exits with status 1 if a partner receives a sender's signals
+out of order, e.g. candidates after the offer that followed them.
+
+    python benchmarks/signal_relay.py --calls 2000 --candidates 20 --threads 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The app reads its database and Redis settings at import time
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'signals.db')}"
+os.environ.pop('REDIS_URL', None)
+
+from flask_login import login_user
+
+import app as shadowtalk
+from app import app, chat_state, create_chat_sessions, handle_webrtc_signal
+from matchmaking import make_queue_entry
+from migrations import run_migrations
+from models import db, User
+from realtime import SignalRelay
+
+INSERT_BATCH = 500
+
+
+class RecordingSocketIO:
+    """Keeps the signals each room received, in emit order"""
+
+    def __init__(self):
+        self.emits = 0
+        self.received = {}
+        self._lock = threading.Lock()
+
+    def emit(self, event, data, room=None):
+        with self._lock:
+            self.emits += 1
+            self.received.setdefault(room, []).append(data)
+
+
+def seed(calls):
+    """Put ``calls`` pairs of users in active video chats; returns (session_id, caller, callee) tuples"""
+    users = [
+        User(email=f"signal{i}@example.com", password='x', display_name=f"Signal {i}")
+        for i in range(2 * calls)
+    ]
+    for start in range(0, len(users), INSERT_BATCH):
+        db.session.add_all(users[start:start + INSERT_BATCH])
+        db.session.commit()
+    for user in users:
+        # Load the attributes now, so handler threads never refresh them
+        db.session.refresh(user)
+        db.session.expunge(user)
+
+    by_id = {user.id: user for user in users}
+    for user in users:
+        chat_state.enqueue('video', make_queue_entry(user, 'video', []))
+
+    # Matches are announced through the app's Socket.IO; nobody is listening here
+    shadowtalk.notify_video_chat_match = lambda *args: None
+    matches = chat_state.claim_matches('video')
+    create_chat_sessions(matches, 'video')
+    return [(session_id, by_id[user1['user_id']], by_id[user2['user_id']]) for user1, user2, session_id in matches]
+
+
+def signal(user, data):
+    with app.test_request_context('/'):
+        login_user(user)
+        handle_webrtc_signal(data)
+
+
+def relay(session_id, user, partner, data):
+    shadowtalk.signal_relay.relay(session_id, user.id, partner.id, data)
+
+
+def call_setup(session_id, caller, callee, candidates, through_handler=True):
+    """Send one call's signals; returns ``{(sender, partner): [signal tags in send order]}``"""
+    sent = {(caller.id, callee.id): [], (callee.id, caller.id): []}
+
+    def send(user, partner, data, tag):
+        data = dict(data, session_id=session_id)
+        if through_handler:
+            signal(user, data)
+        else:
+            relay(session_id, user, partner, data)
+        sent[(user.id, partner.id)].append(tag)
+
+    send(caller, callee, {'type': 'offer', 'offer': {'type': 'offer', 'sdp': 'v=0'}}, 'offer')
+    send(callee, caller, {'type': 'answer', 'answer': {'type': 'answer', 'sdp': 'v=0'}}, 'answer')
+    for i in range(candidates):
+        candidate = {'candidate': f"candidate:{i} 1 udp 2122260223 10.0.0.{i % 250} 5{i:04d} typ host", 'sdpMid': '0'}
+        send(caller, callee, {'type': 'ice_candidate', 'candidate': candidate}, candidate['candidate'])
+        send(callee, caller, {'type': 'ice_candidate', 'candidate': candidate}, candidate['candidate'])
+    send(caller, callee, {'type': 'offer', 'offer': {'type': 'offer', 'sdp': 'v=1'}}, 'offer')
+    return sent
+
+
+def received_tags(received, sender_id, partner_id):
+    """Signal tags a partner got from one sender, with candidate batches unpacked"""
+    tags = []
+    for data in received.get(partner_id, []):
+        if data['from_user_id'] != sender_id:
+            continue
+        if data['type'] == 'ice_candidates':
+            tags.extend(candidate['candidate'] for candidate in data['candidates'])
+        elif data['type'] == 'ice_candidate':
+            tags.append(data['candidate']['candidate'])
+        else:
+            tags.append(data['type'])
+    return tags
+
+
+def run(calls, candidates, threads, batch_window, through_handler):
+    socketio = RecordingSocketIO()
+    shadowtalk.signal_relay = SignalRelay(socketio, batch_window=batch_window)
+    sent = {}
+    signals = [0] * threads
+
+    def worker(index):
+        for session_id, caller, callee in calls[index::threads]:
+            for stream, tags in call_setup(session_id, caller, callee, candidates, through_handler).items():
+                sent[stream] = tags
+                signals[index] += len(tags)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # Let the last candidate batches go out before checking what arrived
+    time.sleep(batch_window * 4 + 0.05)
+    out_of_order = sum(
+        1 for (sender_id, partner_id), tags in sent.items()
+        if received_tags(socketio.received, sender_id, partner_id) != tags
+    )
+    return sum(signals), socketio.emits, elapsed, out_of_order
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--candidates', type=int, default=20, help='ICE candidates per side per call')
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    failures = 0
+    with app.app_context():
+        run_migrations()
+        calls = seed(args.calls)
+
+    for through_handler in (True, False):
+        print('handler and relay' if through_handler else 'relay only')
+        for batch_window in (0, 0.005):
+            signals, emits, elapsed, out_of_order = run(calls, args.candidates, args.threads, batch_window, through_handler)
+            failures += bool(out_of_order)
+            label = 'unbatched' if batch_window == 0 else f"batched ({batch_window * 1000:g} ms)"
+            status = 'ok' if not out_of_order else f"{out_of_order} streams OUT OF ORDER"
+            print(f"{label:>18}: {signals / elapsed:12,.0f} signals/s  "
+                  f"{emits:8d} emits for {signals} signals ({emits / signals:.2f} per signal)  {status}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,19 @@ from datetime import timedelta
 
 class Config:
     SECRET_KEY = 'your-secret-key-here-change-in-production'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///shadowtalk.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///shadowtalk.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool per worker process (see database.engine_options)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     SESSION_TYPE = 'filesystem'
     SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
     SESSION_COOKIE_HTTPONLY = True
-    SESSION_COOKIE_SAMESITE = 'Lax
+    SESSION_COOKIE_SAMESITE = 'Lax'
 
     # Email configuration - Updated with better settings
     MAIL_SERVER = 'smtp.gmail.com'
@@ -31,3 +36,50 @@ class Config:
     # File upload
     UPLOAD_FOLDER = 'static/uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+
+    # Shared chat media, stored by content hash
+    MEDIA_STORE_FOLDER = os.environ.get('MEDIA_STORE_FOLDER', 'media_store')
+    MEDIA_MAX_SIZE = 5 * 1024 * 1024  # 5MB max shared file size
+    MEDIA_CACHE_MAX_AGE = 7 * 24 * 3600  # blobs never change, so clients may cache them
+    MEDIA_UPLOAD_CHUNK_SIZE = 256 * 1024  # bytes per chunked upload request
+    MEDIA_UPLOAD_EXPIRY = 3600  # seconds before an unfinished upload is discarded
+    IMAGE_PIPELINE_WORKERS = int(os.environ.get('IMAGE_PIPELINE_WORKERS', 2))  # processes resizing images
+    RENDITION_CACHE_MAX_AGE = 365 * 24 * 3600  # renditions of a blob never change
+    RENDITION_WAIT_TIMEOUT = 5  # seconds a request waits for missing renditions before answering 202
+
+    # Matchmaking
+    MATCHMAKING_TICK_INTERVAL = float(os.environ.get('MATCHMAKING_TICK_INTERVAL', 0.2))  # seconds between ticks
+    MATCHMAKING_BATCH_SIZE = int(os.environ.get('MATCHMAKING_BATCH_SIZE', 500))  # max pairs per queue per tick
+
+    # Presence
+    PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 15))  # seconds between heartbeat writes
+    PRESENCE_TIMEOUT = 120  # seconds without a heartbeat before a user is marked offline
+    PRESENCE_BROADCAST_INTERVAL = float(os.environ.get('PRESENCE_BROADCAST_INTERVAL', 1))  # seconds between status broadcasts
+
+    # Typing indicators
+    TYPING_WINDOW = float(os.environ.get('TYPING_WINDOW', 3))  # seconds between partner_typing events per sender
+    TYPING_IDLE_TIMEOUT = float(os.environ.get('TYPING_IDLE_TIMEOUT', 5))  # seconds without input before typing stops
+
+    # WebRTC signaling
+    ICE_BATCH_WINDOW = float(os.environ.get('ICE_BATCH_WINDOW', 0.005))  # seconds ICE candidates are held for batching
+
+    # Expiry of waiting users, idle chats and video chats without media
+    EXPIRY_TICK_INTERVAL = float(os.environ.get('EXPIRY_TICK_INTERVAL', 1))  # seconds between expiry passes
+    VIDEO_MEDIA_TIMEOUT = int(os.environ.get('VIDEO_MEDIA_TIMEOUT', 30))  # seconds for both sides to report media
+
+    # Shared state and Socket.IO message queue for running more than one worker
+    REDIS_URL = os.environ.get('REDIS_URL')
+
+    # Write-behind message persistence
+    MESSAGE_WRITE_QUEUE_SIZE = int(os.environ.get('MESSAGE_WRITE_QUEUE_SIZE', 10000))  # max messages waiting to be written
+    MESSAGE_WRITE_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITE_BATCH_SIZE', 500))  # max messages per insert
+    MESSAGE_WRITE_INTERVAL = float(os.environ.get('MESSAGE_WRITE_INTERVAL', 0.05))  # seconds to gather a batch
+    MESSAGE_ID_BLOCK_SIZE = int(os.environ.get('MESSAGE_ID_BLOCK_SIZE', 100))  # ids reserved per round trip
+
+    # Chat session message history
+    MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 50))  # messages per page by default
+    MESSAGE_PAGE_MAX = int(os.environ.get('MESSAGE_PAGE_MAX', 200))  # largest page a client may ask for
+    MESSAGE_STREAM_BATCH_SIZE = int(os.environ.get('MESSAGE_STREAM_BATCH_SIZE', 500))  # rows per query when streaming
+
+    # Dashboard counters
+    ROLLUP_HOURLY_RETENTION_DAYS = int(os.environ.get('ROLLUP_HOURLY_RETENTION_DAYS', 14))  # days of hourly buckets kept
@@ -1,21 +1,111 @@
+import sqlite3
+
 from models import db
 from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Applied to every new SQLite connection: WAL lets readers run alongside the
+# single writer, NORMAL sync is safe with WAL, and busy_timeout makes writers
+# wait for the lock instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY'
+}
+
+def normalize_database_url(url):
+    """Accept the postgres:// scheme many hosts hand out, which SQLAlchemy no longer does"""
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url, pool_size=10, max_overflow=20, pool_timeout=10, pool_recycle=1800):
+    """SQLAlchemy engine options for a database URL.
+
+    Socket handlers run on many threads at once, so file databases and
+    servers get a real connection pool. SQLite connections are shared
+    between threads by the pool, which needs check_same_thread off.
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': pool_timeout,
+            'connect_args': {
+                'check_same_thread': False,
+                'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000
+            }
+        }
+
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': True
+    }
+
+def upsert_insert(table, dialect_name):
+    """``insert(table)`` with the ``on_conflict_do_*`` methods, or None where unsupported.
+
+    PostgreSQL and SQLite, the databases this app runs on, both support
+    INSERT ... ON CONFLICT; callers keep a plain fallback for anything else.
+    """
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(table)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def install_sqlite_pragmas(engine):
+    """Apply SQLITE_PRAGMAS to every connection the engine opens"""
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _set_sqlite_pragmas):
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+def configure_database(app):
+    """Initialize ``db`` for the app with pooled, tuned engines"""
+    url = normalize_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    options = engine_options(
+        url,
+        pool_size=app.config.get('DB_POOL_SIZE', 10),
+        max_overflow=app.config.get('DB_MAX_OVERFLOW', 20),
+        pool_timeout=app.config.get('DB_POOL_TIMEOUT', 10)
+    )
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    # Engines are created here but connect lazily, so the pragmas cover every connection
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            install_sqlite_pragmas(engine)
 
 def init_db(app):
-    if not hasattr(db, 'get_app') or db.get_app() is None:
-        db.init_app(app)
+    """Configure the database for an app and bring its schema up to date"""
+    from migrations import run_migrations
+
+    # db.init_app registers the extension on the app it configured
+    if 'sqlalchemy' not in app.extensions:
+        configure_database(app)
     
     with app.app_context():
-        db.create_all()
-        
-        from werkzeug.security import generate_password_hash
-        from models import Admin
-        
-        admin = Admin.query.filter_by(username='admin').first()
-        if not admin:
-            admin = Admin(
-                username='admin',
-                password=generate_password_hash('admin123')
-            )
-            db.session.add(admin)
-            db.session.commit()
\ No newline at end of file
+        run_migrations()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import heapq
+import itertools
+
+
+class DeadlineHeap:
+    """Keys ordered by deadline, for expiring state without scanning it.
+
+    ``set`` registers or moves a key's deadline and ``pop_due`` removes and
+    returns every key whose deadline has passed, so expiry costs
+    O(expired * log n) however much state is tracked. Moving a deadline
+    leaves the old heap entry behind and skips it when it surfaces; the heap
+    is rebuilt once such dead entries outnumber the live ones. Not
+    thread-safe; callers hold their own lock.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, seq, key)
+        self._deadlines = {}  # key -> current deadline
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def get(self, key):
+        return self._deadlines.get(key)
+
+    def set(self, key, deadline):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def discard(self, key):
+        self._deadlines.pop(key, None)
+
+    def peek(self):
+        """Earliest live deadline, or None"""
+        self._drop_dead()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the keys whose deadline is at or before ``now``, earliest first"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    def _drop_dead(self):
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        self._heap = [(deadline, next(self._seq), key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
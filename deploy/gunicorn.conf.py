@@ -1,5 +1,15 @@
-bind = "0.0.0.0:5000"
-workers = 1
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+# GUNICORN_WORKERS sets the number of workers (default 1). Every worker
+# beyond the first needs REDIS_URL: chat state then lives in Redis and
+# Socket.IO emits go through it as the message queue, so they reach clients
+# connected to any worker. nginx ip_hash keeps a client on one upstream
+# server, but gunicorn hands connections to its workers without stickiness,
+# so long-polling clients need each worker reachable as its own upstream
+# server (one instance per server line in deploy/nginx.conf) rather than
+# several workers behind one port.
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
 worker_class = "eventlet"
 timeout = 120
 loglevel = "info"
@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Pillow is optional; without it no renditions are made and images are not served
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Rendition name -> bounding box; images are scaled down to fit, never up
+RENDITIONS = {
+    'thumb': (160, 160),
+    'preview': (640, 640),
+    'full': (1920, 1920)
+}
+
+RENDITION_FORMAT = 'WEBP'
+RENDITION_EXTENSION = 'webp'
+RENDITION_QUALITY = 80
+
+# Refuse to decode images larger than this many pixels
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+def render_image(source_path, out_dir):
+    """Write every rendition of an image into ``out_dir``.
+
+    Runs in a worker process. The image is rotated according to its EXIF
+    orientation and saved without any metadata, so EXIF (including GPS
+    position) never reaches other users. Returns the rendition names written.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    os.makedirs(out_dir, exist_ok=True)
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        for name, size in RENDITIONS.items():
+            rendition = image.copy()
+            rendition.thumbnail(size, Image.LANCZOS)
+
+            # Write next to the target and rename, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                rendition.save(f, RENDITION_FORMAT, quality=RENDITION_QUALITY, method=4)
+            os.replace(tmp_path, os.path.join(out_dir, f"{name}.{RENDITION_EXTENSION}"))
+
+    return list(RENDITIONS)
+
+
+class ImagePipeline:
+    """Background image renditions for blob store images.
+
+    Resizing runs on a process pool so it never holds the GIL of the web
+    process. Renditions are cached on disk per blob digest; a digest whose
+    renditions already exist or are being generated is not submitted again.
+    """
+
+    def __init__(self, store, max_workers=2):
+        self.store = store
+        self.root = os.path.join(store.root, 'renditions')
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._running = {}  # digest -> Future of renditions being generated
+
+    @property
+    def available(self):
+        return PIL_AVAILABLE
+
+    def _pool(self):
+        if self._executor is None:
+            # Spawned workers do not inherit the server's threads or sockets
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    def _dir(self, digest):
+        # Validates the digest through the store
+        self.store.path(digest)
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def rendition_path(self, digest, name):
+        """Path of a rendition if it has been generated, otherwise None"""
+        if name not in RENDITIONS:
+            return None
+        path = os.path.join(self._dir(digest), f"{name}.{RENDITION_EXTENSION}")
+        return path if os.path.exists(path) else None
+
+    def has_renditions(self, digest):
+        return all(self.rendition_path(digest, name) for name in RENDITIONS)
+
+    def submit(self, digest):
+        """Queue rendition generation for an image blob; returns a Future or None"""
+        if not PIL_AVAILABLE or self.has_renditions(digest):
+            return None
+
+        with self._lock:
+            future = self._running.get(digest)
+            if future is None:
+                future = self._pool().submit(render_image, self.store.path(digest), self._dir(digest))
+                self._running[digest] = future
+                future.add_done_callback(lambda f: self._done(digest, f))
+        return future
+
+    def wait(self, digest, timeout):
+        """Generate an image's renditions if needed, waiting up to ``timeout`` seconds.
+
+        Returns True once they exist; False if Pillow is missing, the image
+        could not be rendered or it is still being rendered.
+        """
+        future = self.submit(digest)
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except FutureTimeoutError:
+                return False
+            except Exception:
+                # Reported by _done
+                return False
+        return PIL_AVAILABLE and self.has_renditions(digest)
+
+    def rendering(self, digest):
+        """True while this process is generating an image's renditions"""
+        with self._lock:
+            return digest in self._running
+
+    def _done(self, digest, future):
+        with self._lock:
+            self._running.pop(digest, None)
+        _report_failure(digest, future)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def _report_failure(digest, future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        print(f"Error generating renditions for {digest}: {error}")
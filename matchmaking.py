@@ -0,0 +1,494 @@
+from collections import Counter, OrderedDict
+from datetime import datetime
+import time
+
+# NumPy is optional; it only speeds up interest scoring for very large queues
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Free-form gender values accepted from profiles, grouped for matchmaking
+MALE_GENDERS = {'male', 'm', 'man', 'boy', 'gentleman'}
+FEMALE_GENDERS = {'female', 'f', 'woman', 'girl', 'lady'}
+
+# Score added to a candidate pair for a male-female match
+GENDER_MATCH_BONUS = 3
+
+# Combined seconds of waiting worth one point of match score
+WAIT_BONUS_SECONDS = 10
+
+# Score added to a video pair for each partner whose media is already ready
+MEDIA_READY_BONUS = 2
+
+# Posting-list volume above which interest scoring switches to NumPy
+VECTORIZE_THRESHOLD = 4096
+
+_GENDER_CODES = {'other': 0, 'male': 1, 'female': 2}
+_OPPOSITE_GENDER = {'male': 'female', 'female': 'male'}
+
+
+def gender_class(gender):
+    """Normalize a free-form gender value to 'male', 'female' or 'other'"""
+    if not gender:
+        return 'other'
+
+    gender_lower = str(gender).lower().strip()
+    if gender_lower in MALE_GENDERS:
+        return 'male'
+    if gender_lower in FEMALE_GENDERS:
+        return 'female'
+    return 'other'
+
+
+def normalize_interests(interests):
+    """Lower-cased, de-duplicated interest tags for set comparisons"""
+    return frozenset(
+        str(tag).strip().lower() for tag in (interests or []) if str(tag).strip()
+    )
+
+
+def make_queue_entry(user, chat_type, interests, **fields):
+    """Build a waiting-queue entry with the profile data matchmaking needs.
+
+    Gender, its normalized class, display name and the interest set are
+    captured once at enqueue time so matching passes never touch the database.
+    """
+    entry = {
+        'user_id': user.id,
+        'display_name': user.display_name,
+        'gender': user.gender,
+        'gender_class': gender_class(user.gender),
+        'interests': interests or [],
+        'interest_set': normalize_interests(interests),
+        'joined_at': datetime.utcnow().isoformat(),
+        'queued_at': time.time(),
+        'chat_type': chat_type
+    }
+    entry.update(fields)
+    return entry
+
+
+def is_opposite_gender(entry1, entry2):
+    """True for a male-female pair of queue entries"""
+    return {entry1.get('gender_class'), entry2.get('gender_class')} == {'male', 'female'}
+
+
+class _RankIndex:
+    """Fenwick tree over queue sequence numbers, used for position lookups"""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+
+    def add(self, index, delta):
+        index += 1
+        while index <= self.capacity:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index):
+        """Number of live entries with a sequence number <= index"""
+        index += 1
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class InterestIndex:
+    """Inverted index from interest tag to the queued users that listed it.
+
+    Every indexed entry gets an integer slot so that candidate scoring can run
+    either as a Counter over posting lists or, for large queues, as a NumPy
+    ``bincount`` over the same postings.
+    """
+
+    def __init__(self):
+        self._postings = {}    # tag -> set of slots
+        self._slots = {}       # user_id -> slot
+        self._entries = []     # slot -> entry (None when free)
+        self._order = []       # slot -> enqueue order, for tie-breaking
+        self._free_slots = []
+        self._next_order = 0
+        self._gender_codes = None
+        self._orders = None
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add(self, entry):
+        user_id = entry['user_id']
+        if user_id in self._slots:
+            self.remove(user_id)
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._entries[slot] = entry
+            self._order[slot] = self._next_order
+        else:
+            slot = len(self._entries)
+            self._entries.append(entry)
+            self._order.append(self._next_order)
+        self._next_order += 1
+        self._slots[user_id] = slot
+
+        for tag in entry.get('interest_set', ()):
+            self._postings.setdefault(tag, set()).add(slot)
+
+        if self._gender_codes is not None:
+            self._ensure_array_capacity(slot + 1)
+            self._gender_codes[slot] = _GENDER_CODES[entry.get('gender_class', 'other')]
+            self._orders[slot] = self._order[slot]
+
+    def remove(self, user_id):
+        slot = self._slots.pop(user_id, None)
+        if slot is None:
+            return
+
+        entry = self._entries[slot]
+        for tag in entry.get('interest_set', ()):
+            postings = self._postings.get(tag)
+            if postings is not None:
+                postings.discard(slot)
+                if not postings:
+                    del self._postings[tag]
+
+        self._entries[slot] = None
+        self._free_slots.append(slot)
+        if self._gender_codes is not None:
+            self._gender_codes[slot] = -1
+
+    def best_candidate(self, entry, vectorize=None):
+        """Best-scoring queued user sharing at least one interest with ``entry``.
+
+        Returns ``(candidate_entry, score)`` or ``(None, 0)``. Ties go to the
+        user who joined first.
+        """
+        tags = [tag for tag in entry.get('interest_set', ()) if tag in self._postings]
+        if not tags:
+            return None, 0
+
+        if vectorize is None:
+            volume = sum(len(self._postings[tag]) for tag in tags)
+            vectorize = NUMPY_AVAILABLE and volume >= VECTORIZE_THRESHOLD
+
+        if vectorize and NUMPY_AVAILABLE:
+            return self._best_candidate_numpy(entry, tags)
+        return self._best_candidate_counter(entry, tags)
+
+    def _best_candidate_counter(self, entry, tags):
+        counts = Counter()
+        for tag in tags:
+            counts.update(self._postings[tag])
+        counts.pop(self._slots.get(entry['user_id']), None)
+
+        if not counts:
+            return None, 0
+
+        # Only candidates within the gender bonus of the top overlap can win
+        opposite = _OPPOSITE_GENDER.get(entry.get('gender_class'))
+        floor = max(counts.values()) - (GENDER_MATCH_BONUS if opposite else 0)
+
+        best_slot = None
+        best_key = None
+        for slot, overlap in counts.items():
+            if overlap < floor:
+                continue
+            candidate = self._entries[slot]
+            score = overlap
+            if opposite and candidate.get('gender_class') == opposite:
+                score += GENDER_MATCH_BONUS
+            key = (score, -self._order[slot])
+            if best_key is None or key > best_key:
+                best_slot, best_key = slot, key
+
+        if best_slot is None:
+            return None, 0
+        return self._entries[best_slot], best_key[0]
+
+    def _best_candidate_numpy(self, entry, tags):
+        size = len(self._entries)
+        self._ensure_array_capacity(size)
+
+        postings = np.fromiter(
+            (slot for tag in tags for slot in self._postings[tag]),
+            dtype=np.int64
+        )
+        scores = np.bincount(postings, minlength=size).astype(np.int64)
+
+        own_slot = self._slots.get(entry['user_id'])
+        if own_slot is not None:
+            scores[own_slot] = 0
+
+        opposite = _OPPOSITE_GENDER.get(entry.get('gender_class'))
+        if opposite:
+            bonus = (self._gender_codes[:size] == _GENDER_CODES[opposite]) & (scores > 0)
+            scores += bonus * GENDER_MATCH_BONUS
+
+        best_score = scores.max()
+        if best_score <= 0:
+            return None, 0
+
+        # Earliest joiner among the top scorers
+        tied = np.flatnonzero(scores == best_score)
+        best_slot = int(tied[np.argmin(self._orders[tied])])
+        return self._entries[best_slot], int(best_score)
+
+    def _ensure_array_capacity(self, size):
+        """Lazily build or grow the per-slot arrays used by the NumPy path"""
+        if self._gender_codes is not None and len(self._gender_codes) >= size:
+            return
+
+        capacity = max(1024, 2 * size)
+        self._gender_codes = np.full(capacity, -1, dtype=np.int8)
+        self._orders = np.zeros(capacity, dtype=np.int64)
+        for slot, slot_entry in enumerate(self._entries):
+            if slot_entry is not None:
+                self._gender_codes[slot] = _GENDER_CODES[slot_entry.get('gender_class', 'other')]
+                self._orders[slot] = self._order[slot]
+
+
+class MatchQueue:
+    """Waiting queue for one chat type.
+
+    Entries are the plain ``user_data`` dicts built by the socket handlers.
+    Enqueue, removal by user_id and FIFO pop are O(1); queue position is an
+    O(log n) Fenwick lookup. Entries are additionally kept in sub-buckets
+    keyed by (gender class, media readiness) so matchmaking can take the
+    oldest user of a given kind without re-partitioning the whole queue, and
+    indexed by interest tag for best-partner lookups.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()  # user_id -> entry, oldest first
+        self._seq = {}                 # user_id -> sequence number
+        self._buckets = {}             # (gender, ready) -> OrderedDict
+        self._next_seq = 0
+        self._rank = _RankIndex()
+        self._interests = InterestIndex()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    @staticmethod
+    def _bucket_key(entry):
+        return entry.get('gender_class', 'other'), bool(entry.get('media_ready', False))
+
+    def get(self, user_id):
+        return self._entries.get(user_id)
+
+    def push(self, entry):
+        """Append an entry, replacing any existing entry for the same user"""
+        user_id = entry['user_id']
+        self.remove(user_id)
+
+        if self._next_seq >= self._rank.capacity:
+            self._compact()
+
+        seq = self._next_seq
+        self._next_seq += 1
+
+        self._entries[user_id] = entry
+        self._seq[user_id] = seq
+        self._buckets.setdefault(self._bucket_key(entry), OrderedDict())[user_id] = entry
+        self._rank.add(seq, 1)
+        self._interests.add(entry)
+        return entry
+
+    def remove(self, user_id):
+        """Remove a user from the queue, returning their entry if present"""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return None
+
+        seq = self._seq.pop(user_id)
+        self._rank.add(seq, -1)
+        self._interests.remove(user_id)
+
+        key = self._bucket_key(entry)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.pop(user_id, None)
+            if not bucket:
+                del self._buckets[key]
+        return entry
+
+    def position(self, user_id):
+        """1-based position of a user in the queue, or None if not queued"""
+        seq = self._seq.get(user_id)
+        if seq is None:
+            return None
+        return self._rank.prefix_sum(seq)
+
+    def _matching_buckets(self, gender=None, ready=None):
+        return [
+            bucket for (bucket_gender, bucket_ready), bucket in self._buckets.items()
+            if (gender is None or bucket_gender == gender) and
+               (ready is None or bucket_ready == ready)
+        ]
+
+    def count(self, gender=None, ready=None):
+        """Number of waiting users in the matching sub-buckets"""
+        if gender is None and ready is None:
+            return len(self._entries)
+        return sum(len(bucket) for bucket in self._matching_buckets(gender, ready))
+
+    def oldest(self, gender=None, ready=None):
+        """Longest-waiting entry in the matching sub-buckets, without removing it"""
+        if gender is None and ready is None:
+            return next(iter(self._entries.values()), None)
+
+        oldest_entry = None
+        oldest_seq = None
+        for bucket in self._matching_buckets(gender, ready):
+            user_id, entry = next(iter(bucket.items()))
+            seq = self._seq[user_id]
+            if oldest_seq is None or seq < oldest_seq:
+                oldest_entry, oldest_seq = entry, seq
+        return oldest_entry
+
+    def pop(self, gender=None, ready=None):
+        """Remove and return the longest-waiting matching entry"""
+        entry = self.oldest(gender, ready)
+        if entry is None:
+            return None
+        return self.remove(entry['user_id'])
+
+    def best_partner(self, entry, vectorize=None):
+        """Best queued partner for ``entry`` by interest overlap plus gender bonus.
+
+        Only users sharing at least one interest are scored. Any opposite-gender
+        user scores at least the gender bonus, so the oldest one is considered
+        as well. Returns ``(partner_entry, score)`` or ``(None, 0)``.
+        """
+        partner, score = self._interests.best_candidate(entry, vectorize=vectorize)
+
+        opposite = _OPPOSITE_GENDER.get(entry.get('gender_class'))
+        if opposite and score < GENDER_MATCH_BONUS:
+            fallback = self.oldest(opposite)
+            if fallback is not None and fallback['user_id'] != entry['user_id']:
+                return fallback, GENDER_MATCH_BONUS
+
+        return partner, score
+
+    def set_media_ready(self, user_id, media_type=None):
+        """Mark a queued user's media as ready, moving them to the ready bucket.
+
+        Within the ready bucket users are ordered by the time they became ready.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+
+        old_key = self._bucket_key(entry)
+        entry['media_ready'] = True
+        entry['media_type'] = media_type
+        new_key = self._bucket_key(entry)
+
+        if new_key != old_key:
+            bucket = self._buckets[old_key]
+            bucket.pop(user_id, None)
+            if not bucket:
+                del self._buckets[old_key]
+            self._buckets.setdefault(new_key, OrderedDict())[user_id] = entry
+        return entry
+
+    def snapshot(self):
+        """List of waiting entries, oldest first"""
+        return list(self._entries.values())
+
+    def head(self, limit, gender=None, ready=None):
+        """The ``limit`` longest-waiting entries in the matching sub-buckets"""
+        if gender is None and ready is None:
+            sources = [self._entries]
+        else:
+            sources = self._matching_buckets(gender, ready)
+
+        head = []
+        for source in sources:
+            for count, (user_id, entry) in enumerate(source.items()):
+                if count >= limit:
+                    break
+                head.append((self._seq[user_id], entry))
+        head.sort(key=lambda item: item[0])
+        return [entry for _, entry in head[:limit]]
+
+    def _compact(self):
+        """Renumber live entries so sequence numbers fit the rank index again"""
+        capacity = max(1024, 2 * len(self._entries))
+        self._rank = _RankIndex(capacity)
+        for seq, user_id in enumerate(self._entries):
+            self._seq[user_id] = seq
+            self._rank.add(seq, 1)
+        self._next_seq = len(self._entries)
+
+
+def pair_score(entry1, entry2, now=None, video=False):
+    """Match score: interest overlap, gender bonus, wait time and media readiness"""
+    now = now or time.time()
+    score = len(entry1.get('interest_set', ()) & entry2.get('interest_set', ()))
+    if is_opposite_gender(entry1, entry2):
+        score += GENDER_MATCH_BONUS
+
+    waited = (now - entry1.get('queued_at', now)) + (now - entry2.get('queued_at', now))
+    score += max(waited, 0) / WAIT_BONUS_SECONDS
+
+    if video:
+        score += MEDIA_READY_BONUS * (bool(entry1.get('media_ready')) + bool(entry2.get('media_ready')))
+    return score
+
+
+def plan_matches(queue, max_pairs=None, now=None, video=False):
+    """Greedily pair the users waiting in ``queue`` for one matchmaking tick.
+
+    Users are visited longest-waiting first. Each one is offered its best
+    interest-index partner plus the oldest opposite-gender users, the oldest
+    users overall and, for video, the oldest users with media ready; the
+    highest ``pair_score`` wins. Matched entries are removed from the queue and
+    returned as ``(entry1, entry2)`` tuples, at most ``max_pairs`` per call.
+    """
+    now = now or time.time()
+    pairs = []
+
+    for entry in queue.snapshot():
+        if max_pairs is not None and len(pairs) >= max_pairs:
+            break
+        if entry['user_id'] not in queue or len(queue) < 2:
+            continue
+
+        candidates = [queue.best_partner(entry)[0]]
+        opposite = _OPPOSITE_GENDER.get(entry.get('gender_class'))
+        if opposite:
+            candidates.extend(queue.head(2, opposite))
+        candidates.extend(queue.head(2))
+        if video:
+            candidates.extend(queue.head(2, ready=True))
+
+        # Candidates come best interest match first, then oldest first, so
+        # ties (including pairs that score 0) go to the earlier candidate
+        best_partner = None
+        best_score = None
+        for candidate in candidates:
+            if candidate is None or candidate['user_id'] == entry['user_id']:
+                continue
+            score = pair_score(entry, candidate, now=now, video=video)
+            if best_score is None or score > best_score:
+                best_partner, best_score = candidate, score
+
+        if best_partner is None:
+            continue
+
+        queue.remove(entry['user_id'])
+        queue.remove(best_partner['user_id'])
+        pairs.append((entry, best_partner))
+
+    return pairs
@@ -0,0 +1,286 @@
+import base64
+import binascii
+import contextlib
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+# File locks are POSIX only; elsewhere uploads are only locked per process
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Prefix marking a Message.media_data value as a blob store reference
+BLOB_REF_PREFIX = 'blob:'
+
+# Bytes read at a time while hashing files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Bytes read at a time from an upload request body
+STREAM_READ_SIZE = 64 * 1024
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_DATA_URL_RE = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(;[^,]*)?,', re.IGNORECASE)
+
+
+def parse_data_url(data_url):
+    """Split a base64 data URL into its MIME type and decoded bytes.
+
+    Returns ``(mime_type, data)``, or ``(None, None)`` if the value is not a
+    base64 data URL.
+    """
+    match = _DATA_URL_RE.match(data_url or '')
+    if not match or 'base64' not in (match.group(2) or ''):
+        return None, None
+
+    try:
+        data = base64.b64decode(data_url[match.end():], validate=False)
+    except (binascii.Error, ValueError):
+        return None, None
+    return match.group(1) or 'application/octet-stream', data
+
+
+def blob_ref(digest):
+    return BLOB_REF_PREFIX + digest
+
+
+def digest_from_ref(value):
+    """Digest referenced by a media_data value, or None for inline data"""
+    if value and value.startswith(BLOB_REF_PREFIX):
+        digest = value[len(BLOB_REF_PREFIX):]
+        if _DIGEST_RE.match(digest):
+            return digest
+    return None
+
+
+class BlobStore:
+    """Content-addressed file store for shared media.
+
+    Blobs are named by the SHA-256 of their content and fanned out into
+    two levels of sub-directories, so identical uploads are stored once.
+    Writes go to a temporary file that is renamed into place, so readers
+    never see a partial blob. The MIME type is kept next to the blob.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        if not _DIGEST_RE.match(digest or ''):
+            raise ValueError(f"Invalid blob digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def mime_type(self, digest):
+        try:
+            with open(self.path(digest) + '.type') as f:
+                return f.read().strip() or 'application/octet-stream'
+        except OSError:
+            return 'application/octet-stream'
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def put(self, data, mime_type=None):
+        """Store bytes and return their digest"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self.put_file(tmp_path, mime_type)
+
+    def put_file(self, tmp_path, mime_type=None):
+        """Move a finished file into the store and return its digest.
+
+        The file must live on the same filesystem as the store, e.g. in
+        ``tmp_dir``. It is removed if an identical blob already exists.
+        """
+        sha = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+        type_path = path + '.type'
+        if mime_type and not os.path.exists(type_path):
+            with open(type_path, 'w') as f:
+                f.write(mime_type)
+        return digest
+
+
+class UploadError(Exception):
+    """A chunked upload request that cannot be applied; ``status`` is the HTTP status to return"""
+
+    def __init__(self, message, status=400, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+class ChunkedUploads:
+    """Resumable uploads assembled chunk by chunk on disk.
+
+    Each upload is a ``.part`` file plus a small JSON description in the
+    blob store's tmp directory. The bytes received so far are simply the
+    size of the part file, so a client can ask for it after a reconnect and
+    carry on from there. Chunks are streamed to disk in small reads, so
+    memory per request is bounded by the read size whatever the file size.
+    Writes to an upload are serialized with an exclusive lock on its JSON
+    file, which holds across worker processes sharing the directory.
+    """
+
+    def __init__(self, store, chunk_size=256 * 1024):
+        self.store = store
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._upload_locks = {}  # upload_id -> lock serializing writes to that upload
+
+    def _paths(self, upload_id):
+        if not _UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadError('Unknown upload', status=404)
+        base = os.path.join(self.store.tmp_dir, upload_id)
+        return base + '.json', base + '.part'
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    @contextlib.contextmanager
+    def _locked(self, upload_id):
+        """Hold an upload's lock, within this process and across processes"""
+        meta_path, _ = self._paths(upload_id)
+        with self._upload_lock(upload_id):
+            try:
+                lock_file = open(meta_path)
+            except OSError:
+                raise UploadError('Unknown upload', status=404)
+            with lock_file:
+                if FCNTL_AVAILABLE:
+                    # Released when the file is closed
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def create(self, owner_id, file_size, **meta):
+        """Start an upload and return its description"""
+        upload = dict(meta)
+        upload.update({
+            'upload_id': uuid.uuid4().hex,
+            'owner_id': owner_id,
+            'file_size': file_size,
+            'chunk_size': self.chunk_size,
+            'created_at': time.time()
+        })
+        meta_path, part_path = self._paths(upload['upload_id'])
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump(upload, f)
+        upload['received'] = 0
+        return upload
+
+    def get(self, upload_id, owner_id):
+        """Description of an upload with the number of bytes received so far"""
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                upload = json.load(f)
+            upload['received'] = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            raise UploadError('Unknown upload', status=404)
+        if upload['owner_id'] != owner_id:
+            raise UploadError('Unknown upload', status=404)
+        return upload
+
+    def append(self, upload_id, owner_id, offset, stream):
+        """Write one chunk read from ``stream`` at ``offset``; returns bytes received.
+
+        The offset must equal the bytes already received, which makes a
+        retried chunk that already landed fail with 409 and the current
+        offset instead of being written twice.
+        """
+        with self._locked(upload_id):
+            upload = self.get(upload_id, owner_id)
+            if offset != upload['received']:
+                raise UploadError('Offset does not match received bytes', status=409, received=upload['received'])
+
+            limit = min(self.chunk_size, upload['file_size'] - offset)
+            _, part_path = self._paths(upload_id)
+            written = 0
+            with open(part_path, 'ab') as f:
+                while True:
+                    data = stream.read(STREAM_READ_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > limit:
+                        f.truncate(offset)
+                        raise UploadError('Chunk too large', status=413, received=offset)
+                    f.write(data)
+            return offset + written
+
+    def finish(self, upload_id, owner_id):
+        """Move a fully received upload into the blob store; returns ``(upload, digest)``"""
+        with self._locked(upload_id):
+            # Another process may have finished it while we waited; get() then fails
+            upload = self.get(upload_id, owner_id)
+            if upload['received'] != upload['file_size']:
+                raise UploadError('Upload is incomplete', status=409, received=upload['received'])
+
+            meta_path, part_path = self._paths(upload_id)
+            digest = self.store.put_file(part_path, upload.get('file_type'))
+            os.remove(meta_path)
+
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+        return upload, digest
+
+    def expire(self, max_age):
+        """Delete uploads started more than ``max_age`` seconds ago; returns how many"""
+        cutoff = time.time() - max_age
+        expired = 0
+        for name in os.listdir(self.store.tmp_dir):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.store.tmp_dir, name)
+            try:
+                with open(meta_path) as f:
+                    created_at = json.load(f).get('created_at', 0)
+            except (OSError, ValueError):
+                continue
+            if created_at < cutoff:
+                upload_id = name[:-len('.json')]
+                try:
+                    # Wait for a chunk being written, possibly by another process
+                    with self._locked(upload_id):
+                        for path in (meta_path, meta_path[:-len('.json')] + '.part'):
+                            try:
+                                os.remove(path)
+                            except OSError:
+                                pass
+                except UploadError:
+                    # Finished or expired elsewhere in the meantime
+                    continue
+                with self._lock:
+                    self._upload_locks.pop(upload_id, None)
+                expired += 1
+        return expired
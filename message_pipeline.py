@@ -0,0 +1,306 @@
+import queue
+import threading
+import time
+
+from sqlalchemy import and_, case, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ChatSession, IdSequence, Message
+from rollups import record_events
+from user_stats import record_messages
+
+# Message ids reserved from the id_sequences table per round trip
+ID_BLOCK_SIZE = 100
+
+
+class IdBlockAllocator:
+    """Hands out ids from blocks reserved in the ``id_sequences`` table.
+
+    Reserving a block is one short transaction, so ids are known before the
+    row that uses them is written and several workers never hand out the
+    same id. Ids are unique and increase within a process; unused ids of a
+    block are skipped after a restart.
+    """
+
+    def __init__(self, name, model, block_size=ID_BLOCK_SIZE):
+        self._name = name
+        self._model = model
+        self._block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
+
+    def next_id(self):
+        with self._lock:
+            if self._next >= self._limit:
+                self._next = self._reserve_block()
+                self._limit = self._next + self._block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve_block(self):
+        """Advance the stored sequence by one block and return the block start"""
+        for _ in range(2):
+            with db.engine.begin() as conn:
+                result = conn.execute(
+                    update(IdSequence)
+                    .where(IdSequence.name == self._name)
+                    .values(next_value=IdSequence.next_value + self._block_size)
+                )
+                if result.rowcount:
+                    next_value = conn.execute(
+                        select(IdSequence.next_value).where(IdSequence.name == self._name)
+                    ).scalar_one()
+                    return next_value - self._block_size
+
+            # First use: continue after the highest id already in the table
+            try:
+                with db.engine.begin() as conn:
+                    max_id = conn.execute(select(func.max(self._model.id))).scalar() or 0
+                    conn.execute(
+                        IdSequence.__table__.insert(),
+                        {'name': self._name, 'next_value': max_id + 1 + self._block_size}
+                    )
+                return max_id + 1
+            except IntegrityError:
+                # Another worker created the sequence first; reserve from it
+                continue
+        raise RuntimeError(f"Could not reserve ids for sequence {self._name}")
+
+
+class MessageWriter:
+    """Write-behind persistence for chat messages and their receipts.
+
+    Socket handlers hand rows to ``submit`` and return immediately; a
+    background thread drains the bounded queue, inserts each batch with one
+    executemany and coalesces ``last_activity``, ``message_count`` and
+    ``last_message_id`` to one UPDATE per session, plus one per session for
+    the participants' message totals. The dashboard message counters are
+    updated in the same transaction.
+    Delivery and read receipts go through the same queue, so they are
+    applied after the messages they acknowledge, and are coalesced to one
+    UPDATE per session, reader and receipt type.
+    ``submit`` blocks when the queue is full, which throttles senders if the
+    database falls behind. ``close`` drains everything still queued.
+    """
+
+    def __init__(self, app, max_queue=10000, batch_size=500, interval=0.05):
+        self._app = app
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._interval = interval
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, row):
+        """Queue a messages row (a dict of column values including ``id``)"""
+        self._put(('message', row))
+
+    def submit_receipt(self, session_id, reader_id, up_to_id, up_to_timestamp, status, timestamp):
+        """Queue marking the partner's messages up to (``up_to_timestamp``, ``up_to_id``) as delivered or read.
+
+        ``up_to_timestamp`` may be None, in which case it is looked up from
+        the message ``up_to_id`` when the receipt is written.
+        """
+        self._put(('receipt', {
+            'session_id': session_id,
+            'reader_id': reader_id,
+            'up_to_id': up_to_id,
+            'up_to_timestamp': up_to_timestamp,
+            'status': status,
+            'timestamp': timestamp
+        }))
+
+    def _put(self, item):
+        if self._stopping:
+            self._write_batch([item])
+            return
+        self.start()
+        self._queue.put(item)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Block until everything submitted so far has been written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Stop accepting background work and write out whatever is queued"""
+        self._stopping = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._drain()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self._interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Shutdown sentinel; write what we have and stop
+                    self._write_batch(batch)
+                    for _ in range(len(batch) + 1):
+                        self._queue.task_done()
+                    return
+                batch.append(item)
+
+            self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+            self._queue.task_done()
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, items):
+        """Write a batch of queued messages and receipts in one transaction"""
+        rows = []
+        sessions = {}
+        receipts = {}
+        for kind, payload in items:
+            if kind == 'message':
+                rows.append(payload)
+                session_id = payload['chat_session_id']
+                counters = sessions.get(session_id)
+                if counters is None:
+                    sessions[session_id] = {
+                        'session_id': session_id,
+                        'activity_at': payload['timestamp'],
+                        'added': 1,
+                        'latest_id': payload['id']
+                    }
+                else:
+                    counters['added'] += 1
+                    if (payload['timestamp'], payload['id']) > (counters['activity_at'], counters['latest_id']):
+                        counters['activity_at'] = payload['timestamp']
+                        counters['latest_id'] = payload['id']
+            else:
+                # Marks are ordered like messages, by (timestamp, id); those
+                # without a timestamp are only coalesced with each other
+                has_timestamp = payload['up_to_timestamp'] is not None
+                key = (payload['session_id'], payload['reader_id'], payload['status'], has_timestamp)
+                mark = (payload['up_to_timestamp'], payload['up_to_id']) if has_timestamp else payload['up_to_id']
+                current = receipts.get(key)
+                if current is None or mark > current[0]:
+                    receipts[key] = (mark, payload)
+
+        with self._app.app_context():
+            try:
+                # Receipts only refer to earlier messages, so inserting first keeps them valid
+                if rows:
+                    db.session.execute(Message.__table__.insert(), rows)
+                    record_events(db.session.connection(), 'messages', [row['timestamp'] for row in rows])
+                if sessions:
+                    db.session.execute(session_messages_update(), list(sessions.values()))
+                    record_messages({session_id: counters['added'] for session_id, counters in sessions.items()})
+                for _, receipt in receipts.values():
+                    db.session.execute(receipt_update(receipt))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error writing {len(items)} queued messages and receipts: {str(e)}")
+                if len(items) > 1:
+                    # Retry one by one so a single bad row does not drop the batch
+                    for item in items:
+                        self._write_batch([item])
+
+
+def session_messages_update():
+    """UPDATE recording new messages on a session, for executemany.
+
+    Parameters are ``session_id``, ``added`` (messages written),
+    ``latest_id`` and ``activity_at`` (id and timestamp of the newest one).
+    ``last_activity`` and ``last_message_id`` only move forward in
+    (timestamp, id) order, so a batch from another worker holding older
+    messages does not roll them back; ``message_count`` always grows.
+    """
+    sessions = ChatSession.__table__
+    activity_at = db.bindparam('activity_at')
+    latest_id = db.bindparam('latest_id')
+    newer = or_(
+        sessions.c.last_message_id.is_(None),
+        sessions.c.last_activity.is_(None),
+        activity_at > sessions.c.last_activity,
+        and_(activity_at == sessions.c.last_activity, latest_id > sessions.c.last_message_id)
+    )
+    return (
+        update(sessions)
+        .where(sessions.c.id == db.bindparam('session_id'))
+        .values(
+            last_activity=case((newer, activity_at), else_=sessions.c.last_activity),
+            message_count=sessions.c.message_count + db.bindparam('added'),
+            last_message_id=case((newer, latest_id), else_=sessions.c.last_message_id)
+        )
+    )
+
+
+def receipt_update(receipt):
+    """UPDATE marking a session's messages from the partner as delivered or read.
+
+    Every message from the other participant sent up to the receipt's
+    high-water mark, in (timestamp, id) order, that is not yet marked is
+    covered; reading a message also marks it delivered.
+    """
+    messages = Message.__table__
+    up_to_id = receipt['up_to_id']
+    up_to_at = receipt['up_to_timestamp']
+    if up_to_at is None:
+        up_to_at = select(messages.c.timestamp).where(
+            messages.c.id == up_to_id,
+            messages.c.chat_session_id == receipt['session_id']
+        ).scalar_subquery()
+    timestamp = receipt['timestamp']
+    if receipt['status'] == 'read':
+        values = {
+            'read_at': timestamp,
+            'is_read': True,
+            'delivered_at': func.coalesce(messages.c.delivered_at, timestamp)
+        }
+        pending = messages.c.read_at.is_(None)
+    else:
+        values = {'delivered_at': timestamp}
+        pending = messages.c.delivered_at.is_(None)
+
+    return (
+        update(messages)
+        .where(messages.c.chat_session_id == receipt['session_id'])
+        .where(messages.c.sender_id != receipt['reader_id'])
+        .where(or_(
+            messages.c.timestamp < up_to_at,
+            and_(messages.c.timestamp == up_to_at, messages.c.id <= up_to_id)
+        ))
+        .where(pending)
+        .values(**values)
+    )
@@ -0,0 +1,216 @@
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, inspect, select, text, update
+from werkzeug.security import generate_password_hash
+
+from media_store import BLOB_REF_PREFIX, BlobStore, blob_ref, parse_data_url
+from models import db, Admin, ChatSession, Message, StatsRollup, User, UserChatStats
+from rollups import backfill_rollups
+from user_stats import backfill_user_stats
+
+# (version, name, function) in the order they are applied
+MIGRATIONS = []
+
+VERSION_TABLE = 'schema_migrations'
+
+# Messages loaded at a time while moving inline media into the blob store
+MEDIA_MIGRATION_BATCH_SIZE = 100
+
+
+def migration(version, name):
+    """Register a migration function taking a Connection.
+
+    Migrations run in version order, once per database. A fresh database
+    gets the full current schema from the first migration, so later ones
+    must tolerate finding their change already there; the helpers below
+    check before creating.
+    """
+    def register(func):
+        assert all(version > existing for existing, _, _ in MIGRATIONS), 'migration versions must increase'
+        MIGRATIONS.append((version, name, func))
+        return func
+    return register
+
+
+def create_indexes(conn, *names):
+    """Create the named indexes declared in models.py, skipping any that exist"""
+    inspector = inspect(conn)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in names and index.name not in existing:
+                index.create(conn)
+
+
+def add_column(conn, table_name, column):
+    """ALTER TABLE ADD COLUMN unless the column exists; ``column`` is a Column from the model"""
+    if column.name in {col['name'] for col in inspect(conn).get_columns(table_name)}:
+        return
+    column_type = column.type.compile(dialect=conn.dialect)
+    default = ''
+    if column.server_default is not None:
+        default = f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            default += " NOT NULL"
+    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}{default}"))
+
+
+# Migrations
+
+@migration(1, 'initial_schema')
+def initial_schema(conn):
+    db.metadata.create_all(conn)
+
+
+@migration(2, 'hot_query_indexes')
+def hot_query_indexes(conn):
+    create_indexes(
+        conn,
+        'ix_users_created_at', 'ix_users_last_login', 'ix_users_is_banned',
+        'ix_otps_email_otp',
+        'ix_chat_sessions_user1_started', 'ix_chat_sessions_user2_started',
+        'ix_chat_sessions_started_at', 'ix_chat_sessions_ended_started', 'ix_chat_sessions_session_type',
+        'ix_messages_session_timestamp',
+        'ix_notifications_user_read_created',
+        'ix_reports_status_created', 'ix_reports_reported_user_id',
+        'ix_password_reset_requests_ip_requested',
+        'ix_audit_logs_created_at'
+    )
+
+
+@migration(3, 'default_admin_accounts')
+def default_admin_accounts(conn):
+    users = User.__table__
+    if conn.execute(users.select().where(users.c.email == 'admin@shadowtalk.com')).first() is None:
+        conn.execute(users.insert().values(
+            email='admin@shadowtalk.com',
+            password=generate_password_hash('admin123'),
+            username='admin',
+            display_name='Administrator',
+            is_verified=True,
+            is_profile_complete=True
+        ))
+        print("Default admin user created!")
+
+    admins = Admin.__table__
+    if conn.execute(admins.select().where(admins.c.username == 'admin@shadowtalk.com')).first() is None:
+        conn.execute(admins.insert().values(
+            username='admin@shadowtalk.com',
+            password=generate_password_hash('admin123'),
+            is_super_admin=True
+        ))
+        print("Default admin panel account created: admin@shadowtalk.com")
+
+
+@migration(4, 'chat_session_message_counters')
+def chat_session_message_counters(conn):
+    add_column(conn, 'chat_sessions', ChatSession.__table__.c.message_count)
+    add_column(conn, 'chat_sessions', ChatSession.__table__.c.last_message_id)
+
+    sessions = ChatSession.__table__
+    messages = Message.__table__
+    session_messages = messages.c.chat_session_id == sessions.c.id
+    conn.execute(update(sessions).values(
+        message_count=select(func.count()).where(session_messages).scalar_subquery(),
+        last_message_id=select(messages.c.id).where(session_messages).order_by(
+            messages.c.timestamp.desc(), messages.c.id.desc()
+        ).limit(1).scalar_subquery()
+    ))
+
+
+@migration(5, 'user_chat_stats')
+def user_chat_stats(conn):
+    UserChatStats.__table__.create(conn, checkfirst=True)
+    backfill_user_stats(conn)
+
+
+@migration(6, 'stats_rollups')
+def stats_rollups(conn):
+    StatsRollup.__table__.create(conn, checkfirst=True)
+    backfill_rollups(conn)
+
+
+@migration(7, 'user_warnings_user_index')
+def user_warnings_user_index(conn):
+    create_indexes(conn, 'ix_user_warnings_user_id')
+
+
+@migration(8, 'media_blob_store')
+def media_blob_store(conn):
+    """Move inline base64 media from the messages table into the blob store"""
+    store = BlobStore(current_app.config['MEDIA_STORE_FOLDER'])
+    messages = Message.__table__
+    last_id = 0
+    migrated = 0
+    skipped = 0
+
+    while True:
+        # Walk the table in id order so each batch loads only a few payloads
+        rows = conn.execute(
+            select(messages.c.id, messages.c.media_type, messages.c.media_data).where(
+                messages.c.id > last_id,
+                messages.c.media_data.isnot(None),
+                ~messages.c.media_data.startswith(BLOB_REF_PREFIX)
+            ).order_by(messages.c.id).limit(MEDIA_MIGRATION_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+
+        for message_id, media_type, media_data in rows:
+            last_id = message_id
+            mime_type, data = parse_data_url(media_data)
+            if data is None:
+                skipped += 1
+                continue
+
+            digest = store.put(data, media_type or mime_type)
+            conn.execute(update(messages).where(messages.c.id == message_id).values(media_data=blob_ref(digest)))
+            migrated += 1
+
+    if migrated or skipped:
+        print(f"Moved {migrated} media messages to {store.root} ({skipped} skipped)")
+
+
+# Runner
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+        "version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+def applied_versions(engine=None):
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.execute(text(f"SELECT version FROM {VERSION_TABLE}"))}
+
+
+def pending_migrations(engine=None):
+    applied = applied_versions(engine)
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def run_migrations(engine=None):
+    """Apply pending migrations, each in its own transaction; returns ``(version, name)`` applied.
+
+    Call inside an app context, once per deploy (``flask --app app migrate``)
+    rather than from every worker.
+    """
+    engine = engine or db.engine
+    applied = applied_versions(engine)
+    done = []
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(
+                text(f"INSERT INTO {VERSION_TABLE} (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {'version': version, 'name': name, 'applied_at': datetime.utcnow()}
+            )
+        print(f"Applied migration {version:04d} {name}")
+        done.append((version, name))
+    return done
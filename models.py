@@ -11,6 +11,11 @@ def generate_uuid():
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users' 
+    __table_args__ = (
+        db.Index('ix_users_created_at', 'created_at'),
+        db.Index('ix_users_last_login', 'last_login'),
+        db.Index('ix_users_is_banned', 'is_banned'),
+    )
 
     id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -67,6 +72,9 @@ class User(UserMixin, db.Model):
 
 class OTP(db.Model):
     __tablename__ = 'otps'
+    __table_args__ = (
+        db.Index('ix_otps_email_otp', 'email', 'otp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
@@ -77,6 +85,14 @@ class OTP(db.Model):
 
 class ChatSession(db.Model):
     __tablename__ = 'chat_sessions'
+    __table_args__ = (
+        # Each side of the user1/user2 OR in the history query has its own index
+        db.Index('ix_chat_sessions_user1_started', 'user1_id', 'started_at'),
+        db.Index('ix_chat_sessions_user2_started', 'user2_id', 'started_at'),
+        db.Index('ix_chat_sessions_started_at', 'started_at'),
+        db.Index('ix_chat_sessions_ended_started', 'ended_at', 'started_at'),
+        db.Index('ix_chat_sessions_session_type', 'session_type'),
+    )
     
     id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
     user1_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
@@ -87,13 +103,24 @@ class ChatSession(db.Model):
     duration = db.Column(db.Integer)  # in seconds
     end_reason = db.Column(db.String(50))
     last_activity = db.Column(db.DateTime, default=datetime.utcnow)
+    # Kept up to date by the message write path so history pages need no per-session queries
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_message_id = db.Column(db.Integer)
     
     # Relationships with explicit foreign keys
     user1 = db.relationship('User', foreign_keys=[user1_id], backref='initiated_chats')
     user2 = db.relationship('User', foreign_keys=[user2_id], backref='received_chats')
+    last_message = db.relationship(
+        'Message',
+        primaryjoin='foreign(ChatSession.last_message_id) == Message.id',
+        viewonly=True
+    )
 
 class Message(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_session_timestamp', 'chat_session_id', 'timestamp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     chat_session_id = db.Column(db.String(36), db.ForeignKey('chat_sessions.id'), nullable=False)
@@ -130,6 +157,9 @@ class Connection(db.Model):
 
 class Notification(db.Model):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_user_read_created', 'user_id', 'is_read', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
@@ -146,6 +176,10 @@ class Notification(db.Model):
 
 class Report(db.Model):
     __tablename__ = 'reports'
+    __table_args__ = (
+        db.Index('ix_reports_status_created', 'status', 'created_at'),
+        db.Index('ix_reports_reported_user_id', 'reported_user_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     reporter_id = db.Column(db.String(36), db.ForeignKey('users.id'))
@@ -174,6 +208,9 @@ class Admin(db.Model):
 
 class PasswordResetRequest(db.Model):
     __tablename__ = 'password_reset_requests'
+    __table_args__ = (
+        db.Index('ix_password_reset_requests_ip_requested', 'ip_address', 'requested_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
@@ -187,6 +224,9 @@ class PasswordResetRequest(db.Model):
 
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
+    __table_args__ = (
+        db.Index('ix_audit_logs_created_at', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     admin_id = db.Column(db.Integer, db.ForeignKey('admins.id'))
@@ -222,6 +262,9 @@ class ModerationQueue(db.Model):
 
 class UserWarningLog(db.Model):
     __tablename__ = 'user_warnings'
+    __table_args__ = (
+        db.Index('ix_user_warnings_user_id', 'user_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
@@ -288,22 +331,6 @@ class SystemSettings(db.Model):
     # Relationships
     updated_by_admin = db.relationship('Admin', backref='system_settings')
 
-# Initialize database
-def init_db():
-    db.create_all()
-    
-    # Create default admin user if not exists
-    from werkzeug.security import generate_password_hash
-    admin_user = Admin.query.filter_by(username='admin').first()
-    if not admin_user:
-        admin_user = Admin(
-            username='admin',
-            password=generate_password_hash('admin123'),
-            is_super_admin=True
-        )
-        db.session.add(admin_user)
-        db.session.commit()
-
 class GlobalStats(db.Model):
     __tablename__ = 'global_stats'
     
@@ -316,3 +343,36 @@ class GlobalStats(db.Model):
     
     def __repr__(self):
         return f'<GlobalStats {self.date}: {self.total_matches} matches>'
+
+class IdSequence(db.Model):
+    __tablename__ = 'id_sequences'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<IdSequence {self.name}: {self.next_value}>'
+
+class StatsRollup(db.Model):
+    """Platform counters per hour, per day and in total, maintained by rollups.py"""
+    __tablename__ = 'stats_rollups'
+    
+    period = db.Column(db.String(10), primary_key=True)  # 'hour', 'day' or 'total'
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    metric = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    
+    def __repr__(self):
+        return f'<StatsRollup {self.period} {self.bucket_start} {self.metric}: {self.value}>'
+
+class UserChatStats(db.Model):
+    """Running chat totals per user, updated as sessions start, end and get messages"""
+    __tablename__ = 'user_chat_stats'
+    
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), primary_key=True)
+    total_chats = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_messages = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_seconds = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # of ended chats
+    
+    def __repr__(self):
+        return f'<UserChatStats {self.user_id}: {self.total_chats} chats>'
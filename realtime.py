@@ -0,0 +1,328 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import or_
+
+from deadlines import DeadlineHeap
+from models import Connection
+
+# Users looked up per Connection query while resolving status recipients
+RECIPIENT_QUERY_CHUNK = 500
+
+
+class PresenceBroadcaster:
+    """Coalesced online/offline notifications.
+
+    Connects, disconnects and heartbeat expiries only record the user's
+    latest status. ``flush``, run every ``interval`` seconds, sends at most
+    one ``online_count_update`` broadcast and one ``user_online_status`` per
+    changed user, addressed to the online users related to them (their chat
+    partner and their connections) instead of every socket. A reconnect storm
+    of N users therefore costs O(N * related users) emits instead of O(N^2).
+    Each count change is claimed in the shared chat state, so with several
+    workers only one of them broadcasts it.
+    """
+
+    def __init__(self, app, socketio, chat_state, interval=1.0):
+        self._app = app
+        self._socketio = socketio
+        self._chat_state = chat_state
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}  # user_id -> latest status change
+        self._metrics = {
+            'status_changes': 0,
+            'status_flushed': 0,
+            'status_events': 0,
+            'count_broadcasts': 0,
+            'flushes': 0
+        }
+
+    def user_online(self, user_id, display_name):
+        self._record(user_id, display_name, 'online')
+
+    def user_offline(self, user_id, display_name):
+        self._record(user_id, display_name, 'offline')
+
+    def _record(self, user_id, display_name, status):
+        with self._lock:
+            self._pending[user_id] = {
+                'user_id': user_id,
+                'display_name': display_name,
+                'status': status,
+                'timestamp': datetime.utcnow().isoformat()
+            }
+            self._metrics['status_changes'] += 1
+
+    def metrics(self):
+        """Fan-out counters since start"""
+        with self._lock:
+            metrics = dict(self._metrics)
+            pending = len(self._pending)
+        # Changes superseded by a later change of the same user before a flush
+        metrics['coalesced'] = metrics['status_changes'] - metrics['status_flushed'] - pending
+        return metrics
+
+    def flush(self):
+        """Send the status changes recorded since the last flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._metrics['flushes'] += 1
+            self._metrics['status_flushed'] += len(pending)
+
+        count = self._chat_state.claim_online_count_update()
+        if count is not None:
+            self._socketio.emit('online_count_update', {
+                'count': count,
+                'timestamp': datetime.utcnow().isoformat()
+            })
+            with self._lock:
+                self._metrics['count_broadcasts'] += 1
+
+        if not pending:
+            return
+
+        sent = 0
+        for user_id, recipients in self._recipients(list(pending)).items():
+            for recipient in recipients:
+                self._socketio.emit('user_online_status', pending[user_id], room=recipient)
+                sent += 1
+        with self._lock:
+            self._metrics['status_events'] += sent
+
+    def _recipients(self, user_ids):
+        """Online users related to each user, through an active chat or a connection"""
+        related = {user_id: set() for user_id in user_ids}
+        for user_id in user_ids:
+            chat_data = self._chat_state.get_chat(user_id)
+            if chat_data:
+                related[user_id].add(chat_data['partner'])
+
+        with self._app.app_context():
+            for start in range(0, len(user_ids), RECIPIENT_QUERY_CHUNK):
+                chunk = user_ids[start:start + RECIPIENT_QUERY_CHUNK]
+                connections = Connection.query.with_entities(Connection.user1_id, Connection.user2_id).filter(
+                    or_(Connection.user1_id.in_(chunk), Connection.user2_id.in_(chunk))
+                ).all()
+                for user1_id, user2_id in connections:
+                    if user1_id in related:
+                        related[user1_id].add(user2_id)
+                    if user2_id in related:
+                        related[user2_id].add(user1_id)
+
+        return {
+            user_id: [recipient for recipient in recipients if self._chat_state.is_online(recipient)]
+            for user_id, recipients in related.items()
+        }
+
+
+class TypingTracker:
+    """Server-side typing state per sender and chat session.
+
+    The first ``start`` of a burst sends ``partner_typing``; further starts
+    within ``window`` seconds only push the idle deadline back. ``stop``, or
+    ``idle_timeout`` seconds without a start (see ``expire``), sends a single
+    ``partner_stopped_typing``, so a client that never sends its stop event
+    does not leave the indicator stuck. Nothing here touches the database.
+    """
+
+    def __init__(self, socketio, window=3.0, idle_timeout=5.0):
+        self._socketio = socketio
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._typing = {}  # (session_id, user_id) -> typing state
+        self._idle = DeadlineHeap()  # (session_id, user_id) -> time typing stops
+        self._metrics = {
+            'starts_received': 0,
+            'stops_received': 0,
+            'typing_sent': 0,
+            'stopped_sent': 0,
+            'expired': 0
+        }
+
+    def start(self, session_id, user_id, partner_id, user_name):
+        now = time.monotonic()
+        key = (session_id, user_id)
+        with self._lock:
+            self._metrics['starts_received'] += 1
+            state = self._typing.get(key)
+            if state is None:
+                state = self._typing[key] = {'partner_id': partner_id, 'sent_at': None}
+            self._idle.set(key, now + self.idle_timeout)
+
+            if state['sent_at'] is not None and now - state['sent_at'] < self.window:
+                return False
+            state['sent_at'] = now
+            self._metrics['typing_sent'] += 1
+
+        self._socketio.emit('partner_typing', {
+            'session_id': session_id,
+            'user_id': user_id,
+            'user_name': user_name,
+            'timestamp': datetime.utcnow().isoformat()
+        }, room=partner_id)
+        return True
+
+    def stop(self, session_id, user_id):
+        key = (session_id, user_id)
+        with self._lock:
+            self._metrics['stops_received'] += 1
+            state = self._typing.pop(key, None)
+            self._idle.discard(key)
+            if state is None:
+                return False
+            self._metrics['stopped_sent'] += 1
+
+        self._send_stopped(session_id, user_id, state['partner_id'])
+        return True
+
+    def expire(self):
+        """Send partner_stopped_typing for senders idle longer than ``idle_timeout``"""
+        with self._lock:
+            expired = []
+            for key in self._idle.pop_due(time.monotonic()):
+                state = self._typing.pop(key, None)
+                if state is not None:
+                    expired.append((key, state['partner_id']))
+            self._metrics['expired'] += len(expired)
+            self._metrics['stopped_sent'] += len(expired)
+
+        for (session_id, user_id), partner_id in expired:
+            self._send_stopped(session_id, user_id, partner_id)
+        return len(expired)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['typing_now'] = len(self._typing)
+        return metrics
+
+    def _send_stopped(self, session_id, user_id, partner_id):
+        self._socketio.emit('partner_stopped_typing', {
+            'session_id': session_id,
+            'user_id': user_id,
+            'timestamp': datetime.utcnow().isoformat()
+        }, room=partner_id)
+
+
+# Signal payload fields passed through to the partner unchanged
+SIGNAL_FIELDS = ('offer', 'answer', 'candidate', 'signal')
+
+# Locks that keep each sender's signals in order, shared by hashing the sender
+SIGNAL_ORDER_STRIPES = 64
+
+
+class SignalRelay:
+    """WebRTC signaling relay between chat partners.
+
+    Offers and answers are forwarded immediately. Trickle ICE candidates
+    from one sender are held for ``batch_window`` seconds and forwarded as
+    a single ``ice_candidates`` signal, since a call setup produces dozens
+    of them in quick succession. Any pending candidates are flushed before
+    the sender's next offer or answer, so the partner sees signals in order:
+    a batch is taken and sent under the sender's ordering lock, whether by
+    ``relay`` or by the background thread.
+    """
+
+    def __init__(self, socketio, batch_window=0.005):
+        self._socketio = socketio
+        self.batch_window = batch_window
+        self._cond = threading.Condition()
+        self._order_locks = [threading.Lock() for _ in range(SIGNAL_ORDER_STRIPES)]
+        self._pending = {}  # (session_id, user_id) -> candidate batch
+        self._thread = None
+        self._metrics = {
+            'signals': 0,
+            'candidates': 0,
+            'emits': 0
+        }
+
+    def relay(self, session_id, user_id, partner_id, data):
+        signal = {
+            'session_id': session_id,
+            'from_user_id': user_id,
+            'type': data.get('type')
+        }
+        for field in SIGNAL_FIELDS:
+            if field in data:
+                signal[field] = data[field]
+
+        key = (session_id, user_id)
+        with self._cond:
+            self._metrics['signals'] += 1
+            if signal['type'] == 'ice_candidate' and self.batch_window > 0:
+                self._metrics['candidates'] += 1
+                batch = self._pending.get(key)
+                if batch is None:
+                    self._pending[key] = {
+                        'partner_id': partner_id,
+                        'due': time.monotonic() + self.batch_window,
+                        'candidates': [signal.get('candidate')]
+                    }
+                    self._ensure_thread()
+                    self._cond.notify()
+                else:
+                    batch['candidates'].append(signal.get('candidate'))
+                return
+
+        with self._order_lock(key):
+            with self._cond:
+                batch = self._pending.pop(key, None)
+            if batch:
+                self._send_candidates(key, batch)
+            self._emit(signal, partner_id)
+
+    def metrics(self):
+        with self._cond:
+            return dict(self._metrics)
+
+    def _order_lock(self, key):
+        # Taken before self._cond, never while holding it
+        return self._order_locks[hash(key) % SIGNAL_ORDER_STRIPES]
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='signal-relay', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [key for key, batch in self._pending.items() if batch['due'] <= now]
+                if not due:
+                    self._cond.wait(min(batch['due'] for batch in self._pending.values()) - now)
+                    continue
+
+            for key in due:
+                with self._order_lock(key):
+                    with self._cond:
+                        # relay may have sent the batch, and a new one may not be due yet
+                        batch = self._pending.get(key)
+                        if batch is None or batch['due'] > now:
+                            continue
+                        del self._pending[key]
+                    try:
+                        self._send_candidates(key, batch)
+                    except Exception as e:
+                        print(f"Error relaying ICE candidates for session {key[0]}: {str(e)}")
+
+    def _send_candidates(self, key, batch):
+        session_id, user_id = key
+        candidates = batch['candidates']
+        signal = {'session_id': session_id, 'from_user_id': user_id}
+        if len(candidates) == 1:
+            signal.update(type='ice_candidate', candidate=candidates[0])
+        else:
+            signal.update(type='ice_candidates', candidates=candidates)
+        self._emit(signal, batch['partner_id'])
+
+    def _emit(self, signal, partner_id):
+        signal['timestamp'] = datetime.utcnow().isoformat()
+        self._socketio.emit('webrtc_signal', signal, room=partner_id)
+        with self._cond:
+            self._metrics['emits'] += 1
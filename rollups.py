@@ -0,0 +1,269 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, func, inspect, select, update
+
+from database import upsert_insert
+from models import db, ChatSession, Connection, Message, Notification, Report, StatsRollup, User
+
+# bucket_start of the all-time rows
+TOTAL_BUCKET = datetime(1970, 1, 1)
+
+# Gauges describe current state, so they are kept as totals only. Each
+# function gives what one row contributes with the attribute values ``v``
+# returns; an insert adds that, a delete subtracts it and an update adds
+# the difference between the new and the old values.
+GAUGES = {
+    User: (('is_banned',), lambda v: {
+        'users': 1,
+        'users_banned': int(bool(v('is_banned')))
+    }),
+    ChatSession: (('ended_at', 'duration'), lambda v: {
+        'chat_sessions_active': int(v('ended_at') is None),
+        'chat_sessions_timed': int(v('duration') is not None),
+        'chat_seconds': v('duration') or 0
+    }),
+    Report: (('status',), lambda v: {
+        'reports_pending': int(v('status') == 'pending'),
+        'reports_resolved': int(v('status') == 'resolved')
+    }),
+    Connection: ((), lambda v: {'connections': 1}),
+    Notification: (('is_read',), lambda v: {'notifications_unread': int(not v('is_read'))}),
+}
+
+# Events are counted when the row is inserted, in the hour and day of its
+# timestamp column as well as in the total, and taken out of the same
+# buckets when it is deleted, so the counters match a backfill. The function
+# names the metrics a row counts towards, reading the listed attributes
+# through ``v``.
+EVENTS = {
+    User: ('created_at', (), lambda v: ['signups']),
+    ChatSession: ('started_at', ('session_type',), lambda v: ['chat_sessions', f"chat_sessions_{v('session_type')}"]),
+    Message: ('timestamp', (), lambda v: ['messages']),
+    Report: ('created_at', (), lambda v: ['reports']),
+}
+
+
+def hour_start(at):
+    return at.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(at):
+    return datetime.combine(at.date(), time())
+
+
+def add_event(deltas, metric, at, amount=1):
+    """Count ``amount`` of an event metric at ``at`` into a deltas Counter"""
+    if at is None:
+        # Rows without a timestamp only count towards the total, as in a backfill
+        deltas[('total', TOTAL_BUCKET, metric)] += amount
+        return
+    deltas[('hour', hour_start(at), metric)] += amount
+    deltas[('day', day_start(at), metric)] += amount
+    deltas[('total', TOTAL_BUCKET, metric)] += amount
+
+
+def apply_deltas(conn, deltas):
+    """Add a Counter of ``(period, bucket_start, metric)`` deltas to stats_rollups"""
+    rows = [
+        {'period': period, 'bucket_start': bucket_start, 'metric': metric, 'value': value}
+        for (period, bucket_start, metric), value in deltas.items() if value
+    ]
+    if not rows:
+        return
+
+    rollups = StatsRollup.__table__
+    upsert = upsert_insert(rollups, conn.dialect.name)
+    if upsert is not None:
+        conn.execute(upsert.on_conflict_do_update(
+            index_elements=['period', 'bucket_start', 'metric'],
+            set_={'value': rollups.c.value + upsert.excluded.value}
+        ), rows)
+        return
+
+    for row in rows:
+        result = conn.execute(
+            update(rollups)
+            .where(rollups.c.period == row['period'])
+            .where(rollups.c.bucket_start == row['bucket_start'])
+            .where(rollups.c.metric == row['metric'])
+            .values(value=rollups.c.value + row['value'])
+        )
+        if not result.rowcount:
+            conn.execute(rollups.insert(), row)
+
+
+def record_events(conn, metric, timestamps):
+    """Count one event per timestamp, for rows written with Core rather than the ORM"""
+    deltas = Counter()
+    for at in timestamps:
+        add_event(deltas, metric, at or datetime.utcnow())
+    apply_deltas(conn, deltas)
+
+
+# ORM tracking
+
+def _current_values(obj):
+    return lambda key: getattr(obj, key)
+
+
+def _previous_values(obj):
+    state = inspect(obj)
+
+    def value(key):
+        history = state.attrs[key].history
+        if history.deleted:
+            return history.deleted[0]
+        if history.unchanged:
+            return history.unchanged[0]
+        return getattr(obj, key)
+    return value
+
+
+def _gauge_deltas(deltas, contributions, sign):
+    for metric, amount in contributions.items():
+        deltas[('total', TOTAL_BUCKET, metric)] += sign * amount
+
+
+def _before_flush(session, flush_context, instances):
+    # Updates and deletes are diffed before the flush, while deleted rows
+    # can still be loaded
+    deltas = session.info['rollup_deltas'] = Counter()
+    for obj in session.dirty:
+        model = type(obj)
+        if model not in GAUGES:
+            continue
+        keys, contributions = GAUGES[model]
+        state = inspect(obj)
+        if not any(state.attrs[key].history.has_changes() for key in keys):
+            continue
+        _gauge_deltas(deltas, contributions(_current_values(obj)), 1)
+        _gauge_deltas(deltas, contributions(_previous_values(obj)), -1)
+
+    for obj in session.deleted:
+        model = type(obj)
+        if model in GAUGES:
+            _gauge_deltas(deltas, GAUGES[model][1](_previous_values(obj)), -1)
+        if model in EVENTS:
+            column, _, metrics = EVENTS[model]
+            values = _previous_values(obj)
+            for metric in metrics(values):
+                add_event(deltas, metric, values(column), -1)
+
+
+def _after_flush(session, flush_context):
+    # Inserts are counted after the flush, once column defaults are filled in
+    deltas = session.info.pop('rollup_deltas', None) or Counter()
+    for obj in session.new:
+        model = type(obj)
+        if model in GAUGES:
+            _gauge_deltas(deltas, GAUGES[model][1](_current_values(obj)), 1)
+        if model in EVENTS:
+            column, _, metrics = EVENTS[model]
+            for metric in metrics(_current_values(obj)):
+                add_event(deltas, metric, getattr(obj, column) or datetime.utcnow())
+    apply_deltas(session.connection(), deltas)
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+def install_rollup_tracking(session):
+    """Keep stats_rollups up to date with every ORM flush of ``session``.
+
+    The counters change in the same transaction as the rows they count,
+    including deletes. Rows inserted with Core bypass this and call
+    ``record_events`` instead; rows of tracked models must not be deleted
+    with Core.
+    """
+    for model, (keys, _) in GAUGES.items():
+        for key in keys:
+            # Make the ORM load the old value on change, so updates can be diffed
+            event.listen(getattr(model, key), 'set', _load_old_value, active_history=True, retval=True)
+    event.listen(session, 'before_flush', _before_flush)
+    event.listen(session, 'after_flush', _after_flush)
+
+
+# Reading
+
+def totals(*metrics):
+    """All-time values of the given metrics in one query, 0 for those never recorded"""
+    rollups = StatsRollup.__table__
+    rows = db.session.execute(
+        select(rollups.c.metric, rollups.c.value)
+        .where(rollups.c.period == 'total')
+        .where(rollups.c.bucket_start == TOTAL_BUCKET)
+        .where(rollups.c.metric.in_(metrics))
+    ).all()
+    values = dict.fromkeys(metrics, 0)
+    values.update(rows)
+    return values
+
+
+def series(metric, period, since):
+    """``{bucket_start: value}`` of one metric for buckets starting at or after ``since``"""
+    rollups = StatsRollup.__table__
+    rows = db.session.execute(
+        select(rollups.c.bucket_start, rollups.c.value)
+        .where(rollups.c.period == period)
+        .where(rollups.c.metric == metric)
+        .where(rollups.c.bucket_start >= since)
+        .order_by(rollups.c.bucket_start)
+    ).all()
+    return dict(rows)
+
+
+def daily_sum(metric, days, now=None):
+    """Sum of a metric over today and the ``days`` days before it"""
+    since = day_start(now or datetime.utcnow()) - timedelta(days=days)
+    return sum(series(metric, 'day', since).values())
+
+
+def prune_hourly(before):
+    """Drop hourly buckets older than ``before``; daily buckets and totals are kept"""
+    rollups = StatsRollup.__table__
+    result = db.session.execute(
+        rollups.delete()
+        .where(rollups.c.period == 'hour')
+        .where(rollups.c.bucket_start < before)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+# Backfill
+
+def backfill_rollups(conn, batch_size=10000):
+    """Rebuild stats_rollups from the source tables; returns the number of rows written.
+
+    Event buckets are computed from the timestamp columns in batches, so
+    memory depends on the number of buckets, not rows. Run it while the app
+    is not writing, or changes made during the backfill may be lost.
+    """
+    deltas = Counter()
+    for model, (column, keys, metrics) in EVENTS.items():
+        columns = [getattr(model, column)] + [getattr(model, key) for key in keys]
+        result = conn.execution_options(yield_per=batch_size).execute(select(*columns))
+        for row in result:
+            at = row[0]
+            for metric in metrics(dict(zip(keys, row[1:])).get):
+                add_event(deltas, metric, at)
+
+    def total(metric, query):
+        deltas[('total', TOTAL_BUCKET, metric)] += conn.execute(query).scalar() or 0
+
+    count = func.count()
+    total('users', select(count).select_from(User))
+    total('users_banned', select(count).select_from(User).where(User.is_banned.is_(True)))
+    total('chat_sessions_active', select(count).select_from(ChatSession).where(ChatSession.ended_at.is_(None)))
+    total('chat_sessions_timed', select(func.count(ChatSession.duration)))
+    total('chat_seconds', select(func.sum(ChatSession.duration)))
+    total('reports_pending', select(count).select_from(Report).where(Report.status == 'pending'))
+    total('reports_resolved', select(count).select_from(Report).where(Report.status == 'resolved'))
+    total('connections', select(count).select_from(Connection))
+    total('notifications_unread', select(count).select_from(Notification).where(Notification.is_read.isnot(True)))
+
+    conn.execute(StatsRollup.__table__.delete())
+    apply_deltas(conn, deltas)
+    return len([value for value in deltas.values() if value])
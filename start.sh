@@ -1,3 +1,5 @@
 #!/bin/bash
 echo "🚀 Starting ShadowTalk Production Server"
+echo "Applying database migrations"
+flask --app app migrate || exit 1
 exec gunicorn --config deploy/gunicorn.conf.py app:app
@@ -0,0 +1,780 @@
+import calendar
+import json
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from deadlines import DeadlineHeap
+from matchmaking import MatchQueue, normalize_interests, plan_matches
+
+# Redis is optional; without it all state stays inside a single process
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+CHAT_TYPES = ('text', 'video')
+
+# How long a worker may hold the matchmaking lock before it expires
+MATCHMAKING_LOCK_MS = 5000
+
+# Most deadlines a Redis expiry script handles per call
+EXPIRE_BATCH_SIZE = 1000
+
+
+class ChatState:
+    """Presence, waiting queues and active chats shared by every socket handler.
+
+    Handlers run concurrently under ``async_mode='threading'``, alongside the
+    matchmaking tick and the cleanup task. Every read-modify-write therefore
+    goes through one re-entrant lock and is exposed as a single atomic method:
+    a user can only be claimed by one chat session, and only one caller gets
+    to tear a given chat down.
+
+    Heartbeats, queue joins and chat activity are also indexed by time in
+    DeadlineHeaps, so the ``expire_*`` methods only touch what has expired.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._online_users = set()
+        self._last_seen = DeadlineHeap()  # user_id -> last heartbeat
+        self._unflushed_seen = {}  # user_id -> last heartbeat not yet written to the database
+        self._broadcast_count = None  # online count last claimed for a broadcast
+        self._active_chats = {}  # user_id -> chat data
+        self._chat_activity = DeadlineHeap()  # user_id -> last activity in their chat
+        self._media_pending = DeadlineHeap()  # user_id -> start of a video chat without their media
+        self._waiting_users = {chat_type: MatchQueue() for chat_type in CHAT_TYPES}
+        self._waiting_since = {chat_type: DeadlineHeap() for chat_type in CHAT_TYPES}  # user_id -> join time
+
+    # Presence
+
+    def add_online_user(self, user_id):
+        with self._lock:
+            self._online_users.add(user_id)
+            return len(self._online_users)
+
+    def remove_online_user(self, user_id):
+        with self._lock:
+            self._online_users.discard(user_id)
+            self._last_seen.discard(user_id)
+            self._unflushed_seen.pop(user_id, None)
+            return len(self._online_users)
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._online_users
+
+    def online_count(self):
+        with self._lock:
+            return len(self._online_users)
+
+    def claim_online_count_update(self):
+        """Online count if it changed since the last claimed update, else None"""
+        with self._lock:
+            count = len(self._online_users)
+            if count == self._broadcast_count:
+                return None
+            self._broadcast_count = count
+            return count
+
+    def touch(self, user_id, seen_at):
+        """Record a heartbeat; it is written to the database by the next flush"""
+        with self._lock:
+            self._last_seen.set(user_id, seen_at)
+            self._unflushed_seen[user_id] = seen_at
+
+    def take_unflushed_seen(self):
+        """Heartbeats recorded since the last call, as user_id -> timestamp"""
+        with self._lock:
+            seen, self._unflushed_seen = self._unflushed_seen, {}
+            return seen
+
+    def expire_presence(self, cutoff):
+        """Online user ids whose last heartbeat is at or before ``cutoff``.
+
+        Each stale user is returned once; the caller takes them offline.
+        """
+        with self._lock:
+            return [user_id for user_id in self._last_seen.pop_due(cutoff) if user_id in self._online_users]
+
+    # Waiting queues
+
+    def enqueue(self, chat_type, entry):
+        """Queue a user for ``chat_type``, removing them from every other queue.
+
+        Returns the user's 1-based queue position.
+        """
+        joined_at = datetime.fromisoformat(entry['joined_at'])
+        with self._lock:
+            for ctype, queue in self._waiting_users.items():
+                queue.remove(entry['user_id'])
+                self._waiting_since[ctype].discard(entry['user_id'])
+            self._waiting_users[chat_type].push(entry)
+            self._waiting_since[chat_type].set(entry['user_id'], joined_at)
+            return self._waiting_users[chat_type].position(entry['user_id'])
+
+    def dequeue(self, user_id, chat_type=None):
+        """Remove a user from one queue, or from all queues when no type is given"""
+        chat_types = [chat_type] if chat_type else CHAT_TYPES
+        with self._lock:
+            removed = []
+            for ctype in chat_types:
+                removed.append(self._waiting_users[ctype].remove(user_id))
+                self._waiting_since[ctype].discard(user_id)
+            return any(entry is not None for entry in removed)
+
+    def queue_position(self, chat_type, user_id):
+        with self._lock:
+            return self._waiting_users[chat_type].position(user_id)
+
+    def queue_length(self, chat_type):
+        with self._lock:
+            return len(self._waiting_users[chat_type])
+
+    def set_media_ready(self, user_id, media_type=None):
+        """Mark a user's media as ready, whether they are still queued or already in a video chat"""
+        with self._lock:
+            queued = self._waiting_users['video'].set_media_ready(user_id, media_type) is not None
+            chat_data = self._active_chats.get(user_id)
+            if chat_data and chat_data['chat_type'] == 'video':
+                chat_data['media_ready'] = True
+                self._media_pending.discard(user_id)
+                return True
+            return queued
+
+    def expire_waiting(self, cutoff):
+        """Drop queue entries that joined at or before ``cutoff``; returns counts per chat type"""
+        expired = {}
+        with self._lock:
+            for chat_type, queue in self._waiting_users.items():
+                stale = self._waiting_since[chat_type].pop_due(cutoff)
+                expired[chat_type] = sum(1 for user_id in stale if queue.remove(user_id) is not None)
+        return expired
+
+    # Matching
+
+    def claim_matches(self, chat_type, max_pairs=None):
+        """Pair waiting users and register their chats in one atomic step.
+
+        Returns ``(user1_data, user2_data, session_id)`` tuples. The session id
+        is allocated here so the chat is visible in the active-chat table
+        before the database row exists.
+        """
+        claimed = []
+        started_at = datetime.utcnow()
+
+        with self._lock:
+            queue = self._waiting_users[chat_type]
+            # A user who searched again without ending their chat cannot be
+            # matched twice. Dropping them before planning, like the Redis
+            # claim does, means no partner has to be requeued behind users
+            # who joined later.
+            for entry in queue.snapshot():
+                if entry['user_id'] in self._active_chats:
+                    queue.remove(entry['user_id'])
+                    self._waiting_since[chat_type].discard(entry['user_id'])
+
+            pairs = plan_matches(queue, max_pairs=max_pairs, video=(chat_type == 'video'))
+
+            for user1_data, user2_data in pairs:
+                session_id = str(uuid.uuid4())
+                for user_data, partner_data in [(user1_data, user2_data), (user2_data, user1_data)]:
+                    user_id = user_data['user_id']
+                    chat_data = {
+                        'session_id': session_id,
+                        'partner': partner_data['user_id'],
+                        'start_time': started_at,
+                        'chat_type': chat_type
+                    }
+                    if chat_type == 'video':
+                        chat_data['media_ready'] = user_data.get('media_ready', False)
+                        if not chat_data['media_ready']:
+                            self._media_pending.set(user_id, started_at)
+                    self._active_chats[user_id] = chat_data
+                    self._chat_activity.set(user_id, started_at)
+                    self._waiting_since[chat_type].discard(user_id)
+
+                claimed.append((user1_data, user2_data, session_id))
+
+        return claimed
+
+    # Active chats
+
+    def get_chat(self, user_id):
+        """Copy of the user's active chat data, or None"""
+        with self._lock:
+            chat_data = self._active_chats.get(user_id)
+            return dict(chat_data) if chat_data else None
+
+    def in_chat(self, user_id):
+        with self._lock:
+            return user_id in self._active_chats
+
+    def touch_chat(self, user_id, active_at):
+        """Record activity in the user's chat, postponing its expiry for both sides"""
+        with self._lock:
+            chat_data = self._active_chats.get(user_id)
+            if chat_data:
+                self._chat_activity.set(user_id, active_at)
+                self._chat_activity.set(chat_data['partner'], active_at)
+
+    def end_chat(self, user_id):
+        """Remove a user's chat and their partner's side of it.
+
+        Returns a copy of the user's chat data with ``partner_active`` telling
+        whether the partner was still in the chat, or None if another caller
+        already ended it.
+        """
+        with self._lock:
+            chat_data = self._active_chats.pop(user_id, None)
+            if chat_data is None:
+                return None
+            self._chat_activity.discard(user_id)
+            self._media_pending.discard(user_id)
+
+            partner_chat = self._active_chats.get(chat_data['partner'])
+            partner_active = bool(partner_chat and partner_chat['session_id'] == chat_data['session_id'])
+            if partner_active:
+                del self._active_chats[chat_data['partner']]
+                self._chat_activity.discard(chat_data['partner'])
+                self._media_pending.discard(chat_data['partner'])
+
+            ended = dict(chat_data)
+            ended['partner_active'] = partner_active
+            return ended
+
+    def expire_chats(self, cutoff):
+        """User ids whose chat has had no activity since ``cutoff``; the caller ends them"""
+        with self._lock:
+            return [user_id for user_id in self._chat_activity.pop_due(cutoff) if user_id in self._active_chats]
+
+    def expire_media_wait(self, cutoff):
+        """User ids in a video chat started at or before ``cutoff`` whose media never became ready"""
+        with self._lock:
+            return [user_id for user_id in self._media_pending.pop_due(cutoff) if user_id in self._active_chats]
+
+    def active_chat_count(self):
+        """Number of active chat sessions (pairs of users)"""
+        with self._lock:
+            return len(self._active_chats) // 2
+
+
+# Sessions kept in the per-process membership cache before the oldest are evicted
+SESSION_CACHE_SIZE = 10000
+
+
+class SessionCache:
+    """Per-process cache of chat session membership keyed by session id.
+
+    Holds the two participants and whether the session has ended, so hot
+    socket events (messages, typing, signaling) can find the partner without
+    querying ``chat_sessions``. Sessions are added when they are created and
+    marked ended when this process ends them; misses fall back to the
+    database via ``load``. Ended flags are not shared between workers.
+    """
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session_id -> session data
+        self._max_size = max_size
+
+    def add(self, session_id, user1_id, user2_id, ended=False):
+        with self._lock:
+            self._sessions[session_id] = {
+                'partners': {user1_id: user2_id, user2_id: user1_id},
+                'ended': ended
+            }
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self._max_size:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def load(self, session_id, loader):
+        """Cached session data, calling ``loader`` to fetch the ChatSession on a miss"""
+        session = self.get(session_id)
+        if session is not None or not session_id:
+            return session
+
+        chat_session = loader(session_id)
+        if chat_session is None:
+            return None
+        self.add(session_id, chat_session.user1_id, chat_session.user2_id, ended=chat_session.ended_at is not None)
+        return self.get(session_id)
+
+    def mark_ended(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session['ended'] = True
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+# Lua scripts run atomically inside Redis, so no other worker can observe or
+# interleave with a half-applied queue or chat update.
+
+# KEYS: seq, target hash, target order, target joined, then (hash, order, media) per chat type.
+# ARGV: user, entry json, join time. Join times of other queues are left to expire lazily.
+_ENQUEUE_SCRIPT = """
+for i = 5, #KEYS, 3 do
+    redis.call('HDEL', KEYS[i], ARGV[1])
+    redis.call('ZREM', KEYS[i + 1], ARGV[1])
+    redis.call('HDEL', KEYS[i + 2], ARGV[1])
+end
+local seq = redis.call('INCR', KEYS[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[3], seq, ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+return redis.call('ZRANK', KEYS[3], ARGV[1]) + 1
+"""
+
+# KEYS: hash, media, chats, media pending
+_MEDIA_READY_SCRIPT = """
+local ready = 0
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    ready = 1
+end
+local raw = redis.call('HGET', KEYS[3], ARGV[1])
+if raw then
+    local chat = cjson.decode(raw)
+    if chat['chat_type'] == 'video' then
+        chat['media_ready'] = true
+        redis.call('HSET', KEYS[3], ARGV[1], cjson.encode(chat))
+        redis.call('ZREM', KEYS[4], ARGV[1])
+        ready = 1
+    end
+end
+return ready
+"""
+
+# KEYS: joined, hash, order, media. ARGV: cutoff, limit. Returns the number of entries dropped.
+_EXPIRE_WAITING_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local expired = 0
+for _, user_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], user_id)
+    expired = expired + redis.call('HDEL', KEYS[2], user_id)
+    redis.call('ZREM', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[4], user_id)
+end
+return expired
+"""
+
+# KEYS: online, last broadcast count. Returns the online count if it differs
+# from the last one claimed, so only one worker broadcasts each change.
+_CLAIM_COUNT_SCRIPT = """
+local count = redis.call('SCARD', KEYS[1])
+if redis.call('GET', KEYS[2]) == tostring(count) then
+    return false
+end
+redis.call('SET', KEYS[2], count)
+return count
+"""
+
+# KEYS: deadlines, members. ARGV: cutoff, limit, mode. Pops due deadlines and
+# returns those still relevant: online users ('online'), users still in a
+# chat ('chat') or in a video chat without their media ('media').
+_EXPIRE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local expired = {}
+for _, user_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], user_id)
+    if ARGV[3] == 'online' then
+        if redis.call('SISMEMBER', KEYS[2], user_id) == 1 then
+            table.insert(expired, user_id)
+        end
+    else
+        local raw = redis.call('HGET', KEYS[2], user_id)
+        if raw then
+            local chat = cjson.decode(raw)
+            if ARGV[3] == 'chat' or (chat['chat_type'] == 'video' and not chat['media_ready']) then
+                table.insert(expired, user_id)
+            end
+        end
+    end
+end
+return expired
+"""
+
+# KEYS: chats, activity. ARGV: user, time. Touches both sides of the user's chat.
+_TOUCH_CHAT_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], cjson.decode(raw)['partner'])
+return 1
+"""
+
+# KEYS: chats, hash, order, media, activity, media pending.
+# ARGV: user1, user2, chat1, chat2, start time, then whether each user's media is pending.
+# Returns 1 when the pair was claimed. Users who entered a chat since the
+# plan was made are dropped from the queue; their partner keeps their place.
+_CLAIM_SCRIPT = """
+local busy = false
+for i = 1, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        redis.call('ZREM', KEYS[3], ARGV[i])
+        redis.call('HDEL', KEYS[4], ARGV[i])
+        busy = true
+    elseif redis.call('HEXISTS', KEYS[2], ARGV[i]) == 0 then
+        busy = true
+    end
+end
+if busy then
+    return 0
+end
+for i = 1, 2 do
+    redis.call('HDEL', KEYS[2], ARGV[i])
+    redis.call('ZREM', KEYS[3], ARGV[i])
+    redis.call('HDEL', KEYS[4], ARGV[i])
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+    redis.call('ZADD', KEYS[5], ARGV[5], ARGV[i])
+    if ARGV[i + 5] == '1' then
+        redis.call('ZADD', KEYS[6], ARGV[5], ARGV[i])
+    end
+end
+return 1
+"""
+
+# KEYS: chats, activity, media pending. Returns {chat json, partner_active} or nil
+_END_CHAT_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return nil
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+local chat = cjson.decode(raw)
+local partner_raw = redis.call('HGET', KEYS[1], chat['partner'])
+if partner_raw and cjson.decode(partner_raw)['session_id'] == chat['session_id'] then
+    redis.call('HDEL', KEYS[1], chat['partner'])
+    redis.call('ZREM', KEYS[2], chat['partner'])
+    redis.call('ZREM', KEYS[3], chat['partner'])
+    return {raw, 1}
+end
+return {raw, 0}
+"""
+
+# KEYS: lock. ARGV: token
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisChatState:
+    """Redis-backed ChatState shared by every worker process.
+
+    Queue entries and chat data are stored as JSON; every multi-key update
+    runs as a Lua script. Matchmaking is serialized across workers with a
+    short-lived lock: whichever worker holds it loads the waiting queue into
+    a local MatchQueue, plans the batch and claims each pair atomically, so
+    users who left or were matched elsewhere in the meantime are skipped.
+    Deadlines live in sorted sets scored by time; each expiry script pops
+    what is due, so exactly one worker handles any expired item.
+    """
+
+    def __init__(self, client, prefix='shadowtalk'):
+        self._redis = client
+        self._prefix = prefix
+        self._enqueue_script = client.register_script(_ENQUEUE_SCRIPT)
+        self._media_ready_script = client.register_script(_MEDIA_READY_SCRIPT)
+        self._claim_script = client.register_script(_CLAIM_SCRIPT)
+        self._end_chat_script = client.register_script(_END_CHAT_SCRIPT)
+        self._expire_waiting_script = client.register_script(_EXPIRE_WAITING_SCRIPT)
+        self._expire_script = client.register_script(_EXPIRE_SCRIPT)
+        self._touch_chat_script = client.register_script(_TOUCH_CHAT_SCRIPT)
+        self._release_lock_script = client.register_script(_RELEASE_LOCK_SCRIPT)
+        self._claim_count_script = client.register_script(_CLAIM_COUNT_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(redis.Redis.from_url(url, decode_responses=True), **kwargs)
+
+    def _key(self, *parts):
+        return ':'.join((self._prefix,) + parts)
+
+    def _queue_keys(self, chat_type):
+        return (
+            self._key('waiting', chat_type),
+            self._key('waiting', chat_type, 'order'),
+            self._key('waiting', chat_type, 'media')
+        )
+
+    @staticmethod
+    def _dump_entry(entry):
+        return json.dumps({key: value for key, value in entry.items() if key != 'interest_set'})
+
+    @staticmethod
+    def _load_entry(raw, media_type=None):
+        entry = json.loads(raw)
+        entry['interest_set'] = normalize_interests(entry.get('interests'))
+        if media_type is not None:
+            entry['media_ready'] = True
+            entry['media_type'] = media_type or None
+        return entry
+
+    @staticmethod
+    def _dump_chat(chat_data):
+        chat_data = dict(chat_data)
+        chat_data['start_time'] = chat_data['start_time'].isoformat()
+        return json.dumps(chat_data)
+
+    @staticmethod
+    def _load_chat(raw):
+        chat_data = json.loads(raw)
+        chat_data['start_time'] = datetime.fromisoformat(chat_data['start_time'])
+        return chat_data
+
+    # Presence
+
+    def add_online_user(self, user_id):
+        pipe = self._redis.pipeline()
+        pipe.sadd(self._key('online'), user_id)
+        pipe.scard(self._key('online'))
+        return pipe.execute()[-1]
+
+    def remove_online_user(self, user_id):
+        pipe = self._redis.pipeline()
+        pipe.srem(self._key('online'), user_id)
+        pipe.zrem(self._key('presence'), user_id)
+        pipe.hdel(self._key('presence', 'unflushed'), user_id)
+        pipe.scard(self._key('online'))
+        return pipe.execute()[-1]
+
+    def is_online(self, user_id):
+        return bool(self._redis.sismember(self._key('online'), user_id))
+
+    def online_count(self):
+        return self._redis.scard(self._key('online'))
+
+    def claim_online_count_update(self):
+        """Online count if it changed since the last claimed update, else None.
+
+        The claim is shared by every worker, so exactly one of them gets each change.
+        """
+        return self._claim_count_script(keys=[self._key('online'), self._key('online', 'broadcast_count')])
+
+    def touch(self, user_id, seen_at):
+        """Record a heartbeat; it is written to the database by the next flush"""
+        pipe = self._redis.pipeline()
+        pipe.zadd(self._key('presence'), {user_id: _epoch(seen_at)})
+        pipe.hset(self._key('presence', 'unflushed'), user_id, seen_at.isoformat())
+        pipe.execute()
+
+    def take_unflushed_seen(self):
+        """Heartbeats recorded since the last call, as user_id -> timestamp"""
+        key = self._key('presence', 'unflushed')
+        pipe = self._redis.pipeline()
+        pipe.hgetall(key)
+        pipe.delete(key)
+        seen, _ = pipe.execute()
+        return {user_id: datetime.fromisoformat(value) for user_id, value in seen.items()}
+
+    def expire_presence(self, cutoff):
+        """Online user ids whose last heartbeat is at or before ``cutoff``.
+
+        Each stale user is returned once; the caller takes them offline.
+        """
+        return self._expire_script(
+            keys=[self._key('presence'), self._key('online')],
+            args=[_epoch(cutoff), EXPIRE_BATCH_SIZE, 'online']
+        )
+
+    # Waiting queues
+
+    def enqueue(self, chat_type, entry):
+        """Queue a user for ``chat_type``, removing them from every other queue.
+
+        Returns the user's 1-based queue position.
+        """
+        hash_key, order_key, _ = self._queue_keys(chat_type)
+        keys = [self._key('waiting', 'seq'), hash_key, order_key, self._key('waiting', chat_type, 'joined')]
+        for ctype in CHAT_TYPES:
+            keys.extend(self._queue_keys(ctype))
+        joined_at = _epoch(datetime.fromisoformat(entry['joined_at']))
+        return self._enqueue_script(keys=keys, args=[entry['user_id'], self._dump_entry(entry), joined_at])
+
+    def dequeue(self, user_id, chat_type=None):
+        """Remove a user from one queue, or from all queues when no type is given"""
+        chat_types = [chat_type] if chat_type else CHAT_TYPES
+        pipe = self._redis.pipeline()
+        for ctype in chat_types:
+            hash_key, order_key, media_key = self._queue_keys(ctype)
+            pipe.hdel(hash_key, user_id)
+            pipe.zrem(order_key, user_id)
+            pipe.hdel(media_key, user_id)
+        return any(pipe.execute()[0::3])
+
+    def queue_position(self, chat_type, user_id):
+        rank = self._redis.zrank(self._queue_keys(chat_type)[1], user_id)
+        return None if rank is None else rank + 1
+
+    def queue_length(self, chat_type):
+        return self._redis.zcard(self._queue_keys(chat_type)[1])
+
+    def set_media_ready(self, user_id, media_type=None):
+        """Mark a user's media as ready, whether they are still queued or already in a video chat"""
+        hash_key, _, media_key = self._queue_keys('video')
+        keys = [hash_key, media_key, self._key('chats'), self._key('chats', 'media_pending')]
+        return bool(self._media_ready_script(keys=keys, args=[user_id, media_type or '']))
+
+    def _load_queue(self, chat_type):
+        """Waiting entries for ``chat_type``, oldest first"""
+        hash_key, order_key, media_key = self._queue_keys(chat_type)
+        pipe = self._redis.pipeline()
+        pipe.zrange(order_key, 0, -1)
+        pipe.hgetall(hash_key)
+        pipe.hgetall(media_key)
+        order, entries, media = pipe.execute()
+        return [
+            self._load_entry(entries[user_id], media.get(user_id))
+            for user_id in order if user_id in entries
+        ]
+
+    def expire_waiting(self, cutoff):
+        """Drop queue entries that joined at or before ``cutoff``; returns counts per chat type"""
+        expired = {}
+        for chat_type in CHAT_TYPES:
+            keys = [self._key('waiting', chat_type, 'joined')] + list(self._queue_keys(chat_type))
+            expired[chat_type] = self._expire_waiting_script(keys=keys, args=[_epoch(cutoff), EXPIRE_BATCH_SIZE])
+        return expired
+
+    # Matching
+
+    def claim_matches(self, chat_type, max_pairs=None):
+        """Pair waiting users and register their chats.
+
+        Returns ``(user1_data, user2_data, session_id)`` tuples, or nothing if
+        another worker is currently running matchmaking.
+        """
+        lock_key = self._key('matchmaking', 'lock')
+        token = str(uuid.uuid4())
+        if not self._redis.set(lock_key, token, nx=True, px=MATCHMAKING_LOCK_MS):
+            return []
+
+        try:
+            queue = MatchQueue()
+            for entry in self._load_queue(chat_type):
+                queue.push(entry)
+            pairs = plan_matches(queue, max_pairs=max_pairs, video=(chat_type == 'video'))
+            if not pairs:
+                return []
+
+            started_at = datetime.utcnow()
+            keys = [self._key('chats')] + list(self._queue_keys(chat_type)) + [
+                self._key('chats', 'activity'),
+                self._key('chats', 'media_pending')
+            ]
+            planned = []
+            pipe = self._redis.pipeline(transaction=False)
+            for user1_data, user2_data in pairs:
+                session_id = str(uuid.uuid4())
+                chats = []
+                media_pending = []
+                for user_data, partner_data in [(user1_data, user2_data), (user2_data, user1_data)]:
+                    chat_data = {
+                        'session_id': session_id,
+                        'partner': partner_data['user_id'],
+                        'start_time': started_at,
+                        'chat_type': chat_type
+                    }
+                    if chat_type == 'video':
+                        chat_data['media_ready'] = user_data.get('media_ready', False)
+                    chats.append(self._dump_chat(chat_data))
+                    media_pending.append('1' if chat_type == 'video' and not chat_data['media_ready'] else '0')
+
+                self._claim_script(
+                    keys=keys,
+                    args=[user1_data['user_id'], user2_data['user_id']] + chats + [_epoch(started_at)] + media_pending,
+                    client=pipe
+                )
+                planned.append((user1_data, user2_data, session_id))
+
+            return [match for match, claimed in zip(planned, pipe.execute()) if claimed]
+        finally:
+            self._release_lock_script(keys=[lock_key], args=[token])
+
+    # Active chats
+
+    def get_chat(self, user_id):
+        """Copy of the user's active chat data, or None"""
+        raw = self._redis.hget(self._key('chats'), user_id)
+        return self._load_chat(raw) if raw else None
+
+    def in_chat(self, user_id):
+        return bool(self._redis.hexists(self._key('chats'), user_id))
+
+    def touch_chat(self, user_id, active_at):
+        """Record activity in the user's chat, postponing its expiry for both sides"""
+        self._touch_chat_script(
+            keys=[self._key('chats'), self._key('chats', 'activity')],
+            args=[user_id, _epoch(active_at)]
+        )
+
+    def end_chat(self, user_id):
+        """Remove a user's chat and their partner's side of it.
+
+        Returns the user's chat data with ``partner_active`` telling whether
+        the partner was still in the chat, or None if another caller already
+        ended it.
+        """
+        keys = [self._key('chats'), self._key('chats', 'activity'), self._key('chats', 'media_pending')]
+        result = self._end_chat_script(keys=keys, args=[user_id])
+        if not result:
+            return None
+
+        ended = self._load_chat(result[0])
+        ended['partner_active'] = bool(result[1])
+        return ended
+
+    def expire_chats(self, cutoff):
+        """User ids whose chat has had no activity since ``cutoff``; the caller ends them"""
+        return self._expire_script(
+            keys=[self._key('chats', 'activity'), self._key('chats')],
+            args=[_epoch(cutoff), EXPIRE_BATCH_SIZE, 'chat']
+        )
+
+    def expire_media_wait(self, cutoff):
+        """User ids in a video chat started at or before ``cutoff`` whose media never became ready"""
+        return self._expire_script(
+            keys=[self._key('chats', 'media_pending'), self._key('chats')],
+            args=[_epoch(cutoff), EXPIRE_BATCH_SIZE, 'media']
+        )
+
+    def active_chat_count(self):
+        """Number of active chat sessions (pairs of users)"""
+        return self._redis.hlen(self._key('chats')) // 2
+
+
+def _epoch(timestamp):
+    """Seconds since the epoch for a naive UTC datetime"""
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def create_chat_state(redis_url=None):
+    """Redis-backed state when a Redis URL is configured, in-process state otherwise"""
+    if redis_url:
+        if REDIS_AVAILABLE:
+            print(f"Using Redis chat state at {redis_url}")
+            return RedisChatState.from_url(redis_url)
+        print("REDIS_URL is set but the redis package is not installed; using in-process chat state")
+    return ChatState()
@@ -21,6 +21,24 @@ let messageQueue = [];
 let pendingMessages = new Map();
 let unreadMessages = new Set();
 
+// Media uploads
+const MEDIA_UPLOAD_MAX_RETRIES = 5;
+const MEDIA_UPLOAD_RETRY_DELAY = 1000;
+
+// Image renditions answer 202 while they are generated; previews retry this often
+const MEDIA_PREVIEW_RETRIES = 10;
+const MEDIA_PREVIEW_RETRY_DELAY = 1000;
+
+// Delivery and read receipts, sent as one high-water mark per burst.
+// Marks are { id, timestamp } and compared in send order, (timestamp, id)
+const RECEIPT_FLUSH_DELAY = 100;
+let pendingReceipts = {
+  sessionId: null,
+  delivered: null,
+  read: null,
+  timer: null,
+};
+
 // User Settings
 const USER_SETTINGS = {
   soundEnabled: true,
@@ -429,26 +447,16 @@ function sendMediaMessage(file) {
   if (!currentSessionId || !file) return;
 
   const tempId = generateTempId();
-  const reader = new FileReader();
-
-  reader.onload = function (e) {
-    const fileData = e.target.result;
 
-    // Show upload preview
-    showMediaPreview(file, tempId);
+  // Show upload preview
+  showMediaPreview(file, tempId);
 
-    // Send via socket
-    socket.emit("send_media", {
-      session_id: currentSessionId,
-      file_data: fileData,
-      file_name: file.name,
-      file_type: file.type,
-      file_size: file.size,
-      temp_id: tempId,
-    });
-  };
-
-  reader.readAsDataURL(file);
+  // Upload over HTTP in chunks so the chat socket stays free
+  uploadMediaFile(file, currentSessionId, tempId)
+    .then((data) => handleMediaSent(data))
+    .catch((error) =>
+      handleMediaError({ temp_id: tempId, error: error.message })
+    );
 }
 
 // Message Event Handlers
@@ -482,13 +490,10 @@ function handleNewMessage(data) {
   }
 
   // Send delivery confirmation
-  socket.emit("message_delivered", {
-    message_id: data.id,
-    session_id: data.session_id,
-  });
+  queueMessageReceipt("delivered", data.id, data.timestamp, data.session_id);
 
   // Mark as read if chat is active
-  markMessageAsRead(data.id, data.session_id);
+  markMessageAsRead(data.id, data.timestamp, data.session_id);
 }
 
 function handleMessageSent(data) {
@@ -503,6 +508,7 @@ function handleMessageSent(data) {
     pendingMessages.delete(data.temp_id);
     pendingMessages.set(data.message_id, {
       ...messageData,
+      tempId: data.temp_id,
       status: "sent",
     });
   }
@@ -510,7 +516,24 @@ function handleMessageSent(data) {
 
 function handleMessageDeliveryStatus(data) {
   console.log("📨 Message delivery status:", data);
-  updateMessageStatus(data.message_id, data.status);
+
+  if (data.up_to_id === undefined) {
+    updateMessageStatus(data.message_id, data.status);
+    return;
+  }
+
+  // Summary status: applies to every own message up to the high-water mark
+  pendingMessages.forEach((message, messageId) => {
+    if (
+      typeof messageId !== "number" ||
+      messageId > data.up_to_id ||
+      message.status === "read"
+    ) {
+      return;
+    }
+    message.status = data.status;
+    updateMessageStatus(message.tempId || messageId, data.status);
+  });
 }
 
 function handleMessageError(data) {
@@ -968,11 +991,27 @@ function addMediaMessage(data, type) {
         <div class="message-time">${formattedTime}</div>
     `;
 
+  const preview = messageElement.querySelector("img.media-preview");
+  if (preview) {
+    retryMediaPreview(preview, data.preview_url);
+  }
+
   messagesContainer.appendChild(messageElement);
   scrollToBottom();
   removeWelcomeMessage();
 }
 
+function retryMediaPreview(img, url) {
+  let attempts = 0;
+  img.addEventListener("error", () => {
+    if (attempts >= MEDIA_PREVIEW_RETRIES) return;
+    attempts++;
+    setTimeout(() => {
+      img.src = `${url}${url.includes("?") ? "&" : "?"}retry=${attempts}`;
+    }, MEDIA_PREVIEW_RETRY_DELAY);
+  });
+}
+
 function updateMessageStatus(messageId, status) {
   const statusElement = document.getElementById(`status-${messageId}`);
   if (!statusElement) return;
@@ -1353,6 +1392,82 @@ function showMediaPreview(file, tempId) {
   removeWelcomeMessage();
 }
 
+function updateMediaUploadProgress(tempId, fraction) {
+  const progressFill = document.querySelector(
+    `[data-temp-id="${tempId}"] .progress-fill`
+  );
+  if (progressFill) {
+    progressFill.style.width = `${Math.round(fraction * 100)}%`;
+  }
+}
+
+// Chunked media upload, resumable after a dropped connection
+async function uploadMediaFile(file, sessionId, tempId) {
+  const upload = await mediaUploadRequest("/api/media/uploads", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      session_id: sessionId,
+      file_name: file.name,
+      file_type: file.type,
+      file_size: file.size,
+      temp_id: tempId,
+    }),
+  });
+
+  let received = upload.received;
+  let retries = 0;
+
+  while (received < file.size) {
+    const chunk = file.slice(received, received + upload.chunk_size);
+
+    try {
+      const result = await mediaUploadRequest(
+        `/api/media/uploads/${upload.upload_id}?offset=${received}`,
+        { method: "PUT", body: chunk }
+      );
+      received = result.received;
+      retries = 0;
+      updateMediaUploadProgress(tempId, received / file.size);
+    } catch (error) {
+      // The server already has a different amount; continue from there
+      if (error.status === 409 && typeof error.received === "number") {
+        received = error.received;
+        continue;
+      }
+      if (error.status && error.status < 500) throw error;
+      if (++retries > MEDIA_UPLOAD_MAX_RETRIES) throw error;
+
+      // Wait for the connection to come back, then resume from the server's offset
+      await new Promise((resolve) =>
+        setTimeout(resolve, MEDIA_UPLOAD_RETRY_DELAY * retries)
+      );
+      const status = await mediaUploadRequest(
+        `/api/media/uploads/${upload.upload_id}`
+      ).catch(() => null);
+      if (status) received = status.received;
+    }
+  }
+
+  return mediaUploadRequest(
+    `/api/media/uploads/${upload.upload_id}/complete`,
+    { method: "POST" }
+  );
+}
+
+async function mediaUploadRequest(url, options = {}) {
+  const response = await fetch(url, { credentials: "same-origin", ...options });
+  const data = await response.json().catch(() => ({}));
+
+  if (!response.ok) {
+    const error = new Error(data.error || `Upload failed (${response.status})`);
+    error.status = response.status;
+    error.received = data.received;
+    throw error;
+  }
+  return data;
+}
+
 // Suggested Replies
 function generateSuggestedReplies(message) {
   if (!USER_SETTINGS.suggestReplies) return;
@@ -1464,6 +1579,7 @@ function processMessageQueue() {
 }
 
 function clearMessageQueue() {
+  flushMessageReceipts();
   messageQueue = [];
   pendingMessages.clear();
   unreadMessages.clear();
@@ -1685,16 +1801,68 @@ function getChatFilters() {
 }
 
 // Message read tracking
-function markMessageAsRead(messageId, sessionId) {
+function markMessageAsRead(messageId, timestamp, sessionId) {
   if (unreadMessages.has(messageId)) {
-    socket.emit("message_read", {
-      message_id: messageId,
-      session_id: sessionId,
-    });
+    queueMessageReceipt("read", messageId, timestamp, sessionId);
     unreadMessages.delete(messageId);
   }
 }
 
+// Message ids from different workers are not in send order, so marks are
+// ordered by the server's ISO timestamp first. Timestamps in the same
+// format compare correctly as strings.
+function isLaterReceipt(mark, current) {
+  if (!current) return true;
+  if (mark.timestamp !== current.timestamp) {
+    return (mark.timestamp || "") > (current.timestamp || "");
+  }
+  return mark.id > current.id;
+}
+
+function queueMessageReceipt(status, messageId, timestamp, sessionId) {
+  if (pendingReceipts.sessionId !== sessionId) {
+    flushMessageReceipts();
+    pendingReceipts.sessionId = sessionId;
+  }
+
+  const mark = { id: messageId, timestamp: timestamp };
+  if (isLaterReceipt(mark, pendingReceipts[status])) {
+    pendingReceipts[status] = mark;
+  }
+
+  if (!pendingReceipts.timer) {
+    pendingReceipts.timer = setTimeout(
+      flushMessageReceipts,
+      RECEIPT_FLUSH_DELAY
+    );
+  }
+}
+
+function flushMessageReceipts() {
+  clearTimeout(pendingReceipts.timer);
+  pendingReceipts.timer = null;
+
+  if (!pendingReceipts.sessionId) return;
+
+  if (pendingReceipts.delivered) {
+    socket.emit("messages_delivered", {
+      session_id: pendingReceipts.sessionId,
+      up_to_id: pendingReceipts.delivered.id,
+      up_to_timestamp: pendingReceipts.delivered.timestamp,
+    });
+  }
+  if (pendingReceipts.read) {
+    socket.emit("messages_read", {
+      session_id: pendingReceipts.sessionId,
+      up_to_id: pendingReceipts.read.id,
+      up_to_timestamp: pendingReceipts.read.timestamp,
+    });
+  }
+
+  pendingReceipts.delivered = null;
+  pendingReceipts.read = null;
+}
+
 // Export functions for global access
 window.startChat = startChat;
 window.startGlobalChat = startGlobalChat;
@@ -1211,6 +1211,14 @@ async function handleSignal(data) {
         console.log("Received ICE candidate");
         await peerConnection.addIceCandidate(data.candidate);
         break;
+
+      case "ice_candidates":
+        // Candidates sent close together arrive as one batch
+        console.log("Received", data.candidates.length, "ICE candidates");
+        for (const candidate of data.candidates) {
+          await peerConnection.addIceCandidate(candidate);
+        }
+        break;
     }
   } catch (error) {
     console.error("Error handling signal:", error);
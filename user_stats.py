@@ -0,0 +1,95 @@
+from sqlalchemy import func, select, union_all, update
+
+from database import upsert_insert
+from models import db, ChatSession, UserChatStats
+
+# Statements run in the caller's db.session transaction, so totals change
+# together with the rows they count
+
+
+def record_chats_started(user_ids):
+    """Count a new chat for each user id (repeat an id for several chats)"""
+    added = {}
+    for user_id in user_ids:
+        added[user_id] = added.get(user_id, 0) + 1
+    if not added:
+        return
+
+    stats = UserChatStats.__table__
+    insert_missing = upsert_insert(stats, db.session.get_bind().dialect.name)
+    if insert_missing is not None:
+        db.session.execute(
+            insert_missing.on_conflict_do_nothing(index_elements=['user_id']),
+            [{'user_id': user_id} for user_id in added]
+        )
+    else:
+        existing = set(db.session.execute(
+            select(stats.c.user_id).where(stats.c.user_id.in_(list(added)))
+        ).scalars())
+        missing = [{'user_id': user_id} for user_id in added if user_id not in existing]
+        if missing:
+            db.session.execute(stats.insert(), missing)
+
+    db.session.execute(
+        update(stats)
+        .where(stats.c.user_id == db.bindparam('stats_user_id'))
+        .values(total_chats=stats.c.total_chats + db.bindparam('added')),
+        [{'stats_user_id': user_id, 'added': count} for user_id, count in added.items()]
+    )
+
+
+def record_messages(session_counts):
+    """Add persisted messages to both participants; ``session_counts`` maps session id to count"""
+    if not session_counts:
+        return
+    stats = UserChatStats.__table__
+    sessions = ChatSession.__table__
+    participants = union_all(
+        select(sessions.c.user1_id).where(sessions.c.id == db.bindparam('session_id')),
+        select(sessions.c.user2_id).where(sessions.c.id == db.bindparam('session_id'))
+    )
+    db.session.execute(
+        update(stats)
+        .where(stats.c.user_id.in_(participants))
+        .values(total_messages=stats.c.total_messages + db.bindparam('added')),
+        [{'session_id': session_id, 'added': count} for session_id, count in session_counts.items()]
+    )
+
+
+def record_chat_ended(chat_session):
+    """Add an ended session's duration to both participants"""
+    if not chat_session.duration:
+        return
+    stats = UserChatStats.__table__
+    db.session.execute(
+        update(stats)
+        .where(stats.c.user_id.in_([chat_session.user1_id, chat_session.user2_id]))
+        .values(total_seconds=stats.c.total_seconds + chat_session.duration)
+    )
+
+
+def backfill_user_stats(conn):
+    """Recompute every user's totals from chat_sessions; returns the number of users.
+
+    Message totals come from the sessions' denormalized message_count, so
+    this reads chat_sessions only. Run it while no chats are being written,
+    or updates made during the backfill may be counted twice or lost.
+    """
+    stats = UserChatStats.__table__
+    sessions = ChatSession.__table__
+    participants = union_all(
+        select(sessions.c.user1_id.label('user_id'), sessions.c.message_count, sessions.c.duration),
+        select(sessions.c.user2_id.label('user_id'), sessions.c.message_count, sessions.c.duration)
+    ).subquery()
+    totals = select(
+        participants.c.user_id,
+        func.count(),
+        func.coalesce(func.sum(participants.c.message_count), 0),
+        func.coalesce(func.sum(participants.c.duration), 0)
+    ).where(participants.c.user_id.isnot(None)).group_by(participants.c.user_id)
+
+    conn.execute(stats.delete())
+    conn.execute(stats.insert().from_select(
+        ['user_id', 'total_chats', 'total_messages', 'total_seconds'], totals
+    ))
+    return conn.execute(select(func.count()).select_from(stats)).scalar()